@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Antigravity simulator - a stand-in IDE for running and load-testing the proxy without the real one
+- Agent Tab on a 909x port: HTML with a base64 `window.chatParams` pointing at the
+  language_server, plus a JS bundle and a stylesheet
+- A child process started as `language_server_linux_x64 ... --csrf_token ... --workspace_id ...`
+  (what the proxy's discovery looks for), serving Connect RPCs over HTTP or HTTPS on a random
+  port: unary calls answer {}, *Stream* calls send token messages at a set rate, and calls
+  without the right x-codeium-csrf-token get 403. It also listens on an extension server port
+  that does not speak HTTP, like the real one
+- Scripted restarts move the language_server to new ports with a new token ("lsp"), the
+  Agent Tab to the next 909x port ("ide"), or both ("all")
+
+Usage: python3 antigravity_sim.py [--ui-port 9090] [--https] [--tokens-per-sec 50]
+                                  [--restart-every 30] [--script 10:lsp,25:ide,40:all]
+                                  [--state /tmp/antigravity-sim.json]
+"""
+import argparse
+import base64
+import http.server
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+UI_PORTS = (9090, 9091, 9092)           # Agent Tab ports, in the order "ide" restarts move through them
+LANGUAGE_SERVER_NAME = 'language_server_linux_x64'
+WORKSPACE_ID = 'file_home_user_project'
+TOKENS_PER_SEC = 50                     # Stream messages per second (0 = as fast as possible)
+STREAM_TOKENS = 100                     # Messages per stream call
+ASSET_KB = 512                          # Size of the Agent Tab JS bundle
+HTTPS_REQUIRED = b'Client sent an HTTP request to an HTTPS server.\n'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing listening on {port}')
+
+
+def envelope(message, flags=0):
+    """One Connect streaming message"""
+    data = json.dumps(message).encode()
+    return bytes([flags]) + len(data).to_bytes(4, 'big') + data
+
+
+# --- Fake language_server (runs in the child process) ---
+
+class LanguageServerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'language_server'
+
+    def setup(self):
+        self.plain_to_tls = False
+        if self.server.tls is not None:
+            # Answer plain HTTP on the TLS port the way the Go server does, so protocol probes are quick
+            self.request.settimeout(5)
+            if self.request.recv(1, socket.MSG_PEEK) not in (b'\x16', b''):
+                self.plain_to_tls = True
+            else:
+                self.request = self.server.tls.wrap_socket(self.request, server_side=True)
+        super().setup()
+
+    def handle(self):
+        if self.plain_to_tls:
+            self.wfile.write(b'HTTP/1.0 400 Bad Request\r\nContent-Type: text/plain\r\n'
+                             b'Content-Length: %d\r\n\r\n%s' % (len(HTTPS_REQUIRED), HTTPS_REQUIRED))
+            return
+        super().handle()
+
+    def do_GET(self):
+        self.reply(404, 'text/plain; charset=utf-8', b'404 page not found\n')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        content_type = self.headers.get('Content-Type', '')
+        if self.headers.get('x-codeium-csrf-token') != self.server.csrf_token:
+            return self.reply(403, 'application/json', b'{"code":"permission_denied","message":"invalid CSRF token"}')
+        if not content_type.startswith('application/connect+') and 'Stream' not in method:
+            return self.reply(200, 'application/json', b'{}')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/connect+json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        gap = 1 / self.server.tokens_per_sec if self.server.tokens_per_sec else 0
+        for i in range(self.server.stream_tokens):
+            self.write_chunk(envelope({'delta': f'token{i} ', 'request_bytes': len(body)}))
+            if gap:
+                time.sleep(gap)
+        self.write_chunk(envelope({}, flags=0x02))  # End of stream
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LanguageServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Failed handshakes and dropped clients are expected
+
+
+def run_language_server(args):
+    server = LanguageServer(('127.0.0.1', args.server_port), LanguageServerHandler)
+    server.csrf_token = args.csrf_token
+    server.tokens_per_sec = args.tokens_per_sec
+    server.stream_tokens = args.stream_tokens
+    server.tls = None
+    if args.cert:
+        server.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server.tls.load_cert_chain(args.cert, args.key)
+    # Extension server port: accepts and hangs up, so discovery has to pick the right port
+    extension = socket.create_server(('127.0.0.1', args.extension_server_port))
+
+    def refuse():
+        while True:
+            extension.accept()[0].close()
+    threading.Thread(target=refuse, daemon=True).start()
+    server.serve_forever()
+
+
+# --- Fake Agent Tab (runs in the simulator process) ---
+
+class AgentTabHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        sim = self.server.sim
+        if self.path.split('?')[0] in ('/', '/index.html'):
+            body, content_type, cache = sim.agent_tab_html(), 'text/html; charset=utf-8', 'no-cache'
+        elif self.path == '/static/agent.js':
+            body, content_type, cache = sim.bundle, 'application/javascript', 'public, max-age=3600'
+        elif self.path == '/static/agent.css':
+            body, content_type, cache = sim.stylesheet, 'text/css', 'public, max-age=3600'
+        else:
+            body, content_type, cache = b'Not Found', 'text/plain', 'no-store'
+        self.send_response(200 if cache != 'no-store' else 404)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Simulator:
+    """Agent Tab + language_server child, with restarts that move ports and rotate the token"""
+
+    def __init__(self, ui_ports=UI_PORTS, https=False, tokens_per_sec=TOKENS_PER_SEC,
+                 stream_tokens=STREAM_TOKENS, asset_kb=ASSET_KB, state_path=None):
+        self.ui_ports = tuple(ui_ports)
+        self.https = https
+        self.tokens_per_sec = tokens_per_sec
+        self.stream_tokens = stream_tokens
+        self.state_path = state_path
+        self.bundle = b'/* agent bundle */\n' + b'x' * (asset_kb * 1024)
+        self.stylesheet = b'body { background: #1e1e1e; color: #ccc; }\n' * 64
+        self.workdir = tempfile.mkdtemp(prefix='antigravity-sim-')
+        # Discovery matches the process by name - run Python under the language_server's name
+        self.executable = os.path.join(self.workdir, LANGUAGE_SERVER_NAME)
+        os.symlink(sys.executable, self.executable)
+        self.cert = self.key = None
+        if https:
+            self.cert, self.key = os.path.join(self.workdir, 'cert.pem'), os.path.join(self.workdir, 'key.pem')
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', self.key,
+                            '-out', self.cert, '-days', '30', '-subj', '/CN=127.0.0.1'],
+                           capture_output=True, check=True)
+        self.ui_index = 0
+        self.ui_server = None
+        self.process = None
+        self.lsp_port = self.extension_port = None
+        self.csrf_token = None
+        self.restarts = {'lsp': 0, 'ide': 0}
+
+    @property
+    def ui_port(self):
+        return self.ui_ports[self.ui_index]
+
+    def start(self):
+        self.start_language_server()
+        self.start_agent_tab()
+        return self
+
+    def start_language_server(self):
+        self.lsp_port, self.extension_port = free_port(), free_port()
+        self.csrf_token = str(uuid.uuid4())
+        args = [self.executable, os.path.abspath(__file__), 'lsp', '--enable_lsp',
+                '--csrf_token', self.csrf_token, '--workspace_id', WORKSPACE_ID,
+                '--extension_server_port', self.extension_port, '--server_port', self.lsp_port,
+                '--tokens_per_sec', self.tokens_per_sec, '--stream_tokens', self.stream_tokens]
+        if self.https:
+            args += ['--cert', self.cert, '--key', self.key]
+        self.process = subprocess.Popen([str(a) for a in args])
+        wait_for_port(self.lsp_port)
+        wait_for_port(self.extension_port)
+        self.save_state()
+
+    def stop_language_server(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def start_agent_tab(self):
+        http.server.ThreadingHTTPServer.allow_reuse_address = True
+        self.ui_server = http.server.ThreadingHTTPServer(('127.0.0.1', self.ui_port), AgentTabHandler)
+        self.ui_server.daemon_threads = True
+        self.ui_server.sim = self
+        threading.Thread(target=self.ui_server.serve_forever, daemon=True).start()
+        self.save_state()
+
+    def stop_agent_tab(self):
+        if self.ui_server is not None:
+            self.ui_server.shutdown()
+            self.ui_server.server_close()
+            self.ui_server = None
+
+    def restart(self, target='all'):
+        """'lsp': new ports and token; 'ide': Agent Tab moves to the next port; 'all': both"""
+        if target in ('ide', 'all'):
+            self.stop_agent_tab()
+        if target in ('lsp', 'all'):
+            self.stop_language_server()
+            self.start_language_server()
+            self.restarts['lsp'] += 1
+        if target in ('ide', 'all'):
+            self.ui_index = (self.ui_index + 1) % len(self.ui_ports)
+            self.start_agent_tab()
+            self.restarts['ide'] += 1
+
+    def stop(self):
+        self.stop_agent_tab()
+        self.stop_language_server()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def state(self):
+        return {'ui_port': self.ui_port, 'lsp_port': self.lsp_port, 'extension_port': self.extension_port,
+                'https': self.https, 'csrf_token': self.csrf_token, 'workspace_id': WORKSPACE_ID,
+                'pid': self.process.pid if self.process else None, 'restarts': dict(self.restarts)}
+
+    def save_state(self):
+        if self.state_path:
+            tmp = self.state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.state(), f)
+            os.replace(tmp, self.state_path)
+
+    def agent_tab_html(self):
+        scheme = 'https' if self.https else 'http'
+        params = {'languageServerUrl': f'{scheme}://127.0.0.1:{self.lsp_port}/',
+                  'httpLanguageServerUrl': f'{scheme}://127.0.0.1:{self.lsp_port}/',
+                  'csrfToken': self.csrf_token, 'workspaceId': WORKSPACE_ID,
+                  'extensionServerPort': self.extension_port, 'ideName': 'antigravity'}
+        chat_params = base64.b64encode(json.dumps(params).encode()).decode()
+        return (f'<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n<title>Agent</title>\n'
+                f'<link rel="stylesheet" href="/static/agent.css">\n'
+                f'<script src="/static/agent.js" defer></script>\n</head>\n'
+                f'<body>\n<div id="root"></div>\n'
+                f"<script>window.chatParams = '{chat_params}';</script>\n"
+                f'</body>\n</html>\n').encode()
+
+
+def parse_script(text):
+    """'10:lsp,25:ide' -> [(10.0, 'lsp'), (25.0, 'ide')]"""
+    events = []
+    for item in filter(None, (text or '').split(',')):
+        when, target = item.split(':')
+        if target not in ('lsp', 'ide', 'all'):
+            raise ValueError(f'unknown restart target {target!r} (lsp, ide or all)')
+        events.append((float(when), target))
+    return sorted(events)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'lsp':
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--enable_lsp', action='store_true')
+        parser.add_argument('--csrf_token', required=True)
+        parser.add_argument('--workspace_id')
+        parser.add_argument('--extension_server_port', type=int, required=True)
+        parser.add_argument('--server_port', type=int, required=True)
+        parser.add_argument('--tokens_per_sec', type=float, default=TOKENS_PER_SEC)
+        parser.add_argument('--stream_tokens', type=int, default=STREAM_TOKENS)
+        parser.add_argument('--cert')
+        parser.add_argument('--key')
+        return run_language_server(parser.parse_args(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ui-port', type=int, action='append',
+                        help='Agent Tab port; repeat to set the order "ide" restarts move through')
+    parser.add_argument('--https', action='store_true', help='language_server speaks HTTPS (needs openssl)')
+    parser.add_argument('--tokens-per-sec', type=float, default=TOKENS_PER_SEC)
+    parser.add_argument('--stream-tokens', type=int, default=STREAM_TOKENS)
+    parser.add_argument('--asset-kb', type=int, default=ASSET_KB)
+    parser.add_argument('--restart-every', type=float, help='restart everything every N seconds')
+    parser.add_argument('--script', help='restarts as SECONDS:TARGET,... with TARGET lsp, ide or all')
+    parser.add_argument('--state', help='keep the current ports and token in this JSON file')
+    args = parser.parse_args()
+
+    sim = Simulator(ui_ports=args.ui_port or UI_PORTS, https=args.https, tokens_per_sec=args.tokens_per_sec,
+                    stream_tokens=args.stream_tokens, asset_kb=args.asset_kb, state_path=args.state)
+    try:
+        sim.start()
+        print(f"[SIM] {json.dumps(sim.state())}", flush=True)
+        started = time.monotonic()
+        events = parse_script(args.script)
+        next_periodic = args.restart_every
+        while True:
+            elapsed = time.monotonic() - started
+            if events and elapsed >= events[0][0]:
+                sim.restart(events.pop(0)[1])
+            elif next_periodic and elapsed >= next_periodic:
+                sim.restart('all')
+                next_periodic += args.restart_every
+            else:
+                time.sleep(0.1)
+                continue
+            print(f"[SIM] {json.dumps(sim.state())}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
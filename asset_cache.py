@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Two-tier cache for Agent Tab static assets (JS, CSS, fonts, images)
+- Memory LRU in front of an on-disk store that survives proxy restarts
+- Honours the IDE's Cache-Control (max-age, no-cache, no-store) and Vary
+- Stale entries are revalidated with If-None-Match / If-Modified-Since
+- 404s are remembered briefly (memory only)
+- The disk tier keeps a running byte total and is only trimmed once that passes its limit
+- Everything is purged when the IDE build fingerprint changes
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import gravity_log as log
+
+ASSET_CACHE_DIR = os.path.expanduser('~/.cache/gravityremote/assets')
+ASSET_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+ASSET_DISK_MAX_BYTES = 512 * 1024 * 1024
+ASSET_DISK_TRIM_TO = 0.9            # Share of the disk limit a trim evicts down to
+ASSET_MAX_BODY = 16 * 1024 * 1024   # Bigger responses are passed through uncached
+NEGATIVE_TTL = 30                   # Seconds a 404 is answered from memory
+
+# Upstream headers not stored (framing, per-response, or re-added by the proxy)
+ASSET_SKIP_HEADERS = ('content-length', 'transfer-encoding', 'content-encoding', 'connection', 'keep-alive',
+                      'date', 'server', 'etag', 'age', 'access-control-allow-origin',
+                      'access-control-allow-credentials')
+
+BUILD_MARKER = 'BUILD'
+
+
+class CachedAsset:
+    """One stored response plus what is needed to decide freshness and revalidate it"""
+
+    def __init__(self, status, headers, body, etag=None, last_modified=None, max_age=0, stored_at=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.max_age = max_age
+        self.stored_at = time.time() if stored_at is None else stored_at
+
+    def is_fresh(self, now=None):
+        return ((now or time.time()) - self.stored_at) < self.max_age
+
+    def header(self, name):
+        return next((v for k, v in self.headers if k.lower() == name), None)
+
+    def to_meta(self):
+        return {'status': self.status, 'headers': self.headers, 'etag': self.etag,
+                'last_modified': self.last_modified, 'max_age': self.max_age, 'stored_at': self.stored_at}
+
+
+def parse_cache_control(value):
+    """Cache-Control directives as {name: value or True}"""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else True
+    return directives
+
+
+def freshness(headers):
+    """Seconds the response may be served without asking the IDE, or None if it must not be stored"""
+    get = {k.lower(): v for k, v in headers}.get
+    cc = parse_cache_control(get('cache-control'))
+    if 'no-store' in cc or 'private' in cc or get('set-cookie'):
+        return None  # Not for a cache shared by every device
+    vary = [v.strip().lower() for v in (get('vary') or '').split(',') if v.strip()]
+    if any(v not in ('accept-encoding', 'origin') for v in vary):
+        return None  # Varies on something we do not key on
+    if 'no-cache' in cc:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if re.fullmatch(r'\d+', str(cc.get(name, ''))):
+            return int(cc[name])
+    return 0
+
+
+class AssetCache:
+    """Memory LRU + disk store keyed by request path, scoped to one IDE build"""
+
+    def __init__(self, directory=ASSET_CACHE_DIR, memory_max=ASSET_MEMORY_MAX_BYTES, disk_max=ASSET_DISK_MAX_BYTES):
+        self.directory = directory
+        self.memory_max = memory_max
+        self.disk_max = disk_max
+        self.build = None
+        self._memory = {}
+        self._memory_bytes = 0
+        self._disk_bytes = None  # Running total of the disk tier, counted on first write
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'revalidated': 0, 'negative_hits': 0,
+                      'stores': 0, 'purges': 0}
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    # --- Build scoping ---
+
+    def set_build(self, fingerprint):
+        """Purge both tiers if the IDE build differs from the one the cache was filled by"""
+        if not fingerprint or fingerprint == self.build:
+            return False
+        previous = self.build
+        if previous is None:
+            previous = self._read_marker()
+        self.build = fingerprint
+        if previous == fingerprint:
+            return False
+        self.purge()
+        return True
+
+    def _read_marker(self):
+        try:
+            with open(os.path.join(self.directory, BUILD_MARKER)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def purge(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._disk_bytes = 0
+            self.stats['purges'] += 1
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if self.build is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, BUILD_MARKER), 'w') as f:
+                f.write(self.build)
+        except OSError as e:
+            log.error(f"[CACHE] Cannot write {self.directory}: {e}")
+
+    # --- Lookup / store ---
+
+    def get(self, path):
+        with self._lock:
+            entry = self._memory.pop(path, None)
+            if entry is not None:
+                self._memory[path] = entry
+                return entry
+        entry = self._load(path)
+        if entry is not None:
+            self.count('disk_hits')
+            self._remember(path, entry)
+        return entry
+
+    @staticmethod
+    def may_store(status, headers, length=None):
+        """Whether a response with these headers would be kept (decided before its body is read)"""
+        max_age = freshness(headers)
+        if status == 404:
+            return max_age is not None
+        get = {k.lower(): v for k, v in headers}.get
+        if status != 200 or max_age is None or (length or 0) > ASSET_MAX_BODY:
+            return False
+        # Otherwise it could neither be served fresh nor revalidated
+        return bool(max_age or get('etag') or get('last-modified'))
+
+    def store(self, path, status, headers, body):
+        """Keep a response if the IDE allows it - returns the entry or None"""
+        if not self.may_store(status, headers, len(body)):
+            return None
+        if status == 404:
+            entry = CachedAsset(status, self._kept(headers), body, max_age=NEGATIVE_TTL)
+            self._remember(path, entry)
+            return entry
+        max_age = freshness(headers)
+        get = {k.lower(): v for k, v in headers}.get
+        entry = CachedAsset(status, self._kept(headers), body, get('etag'), get('last-modified'), max_age)
+        self._remember(path, entry)
+        self._save(path, entry)
+        self.count('stores')
+        return entry
+
+    def refresh(self, path, entry, headers):
+        """Upstream answered 304 - restart the freshness clock with its (possibly updated) headers"""
+        max_age = freshness(headers)
+        entry.max_age = entry.max_age if max_age is None else max_age
+        entry.stored_at = time.time()
+        self._save(path, entry)
+        return entry
+
+    def forget(self, path):
+        with self._lock:
+            entry = self._memory.pop(path, None)
+            if entry is not None:
+                self._memory_bytes -= len(entry.body)
+        filename = self._file(path)
+        try:
+            size = os.stat(filename).st_size
+            os.unlink(filename)
+        except OSError:
+            return
+        self._count_disk(-size)
+
+    @staticmethod
+    def _kept(headers):
+        return [(k, v) for k, v in headers if k.lower() not in ASSET_SKIP_HEADERS]
+
+    def _remember(self, path, entry):
+        with self._lock:
+            old = self._memory.pop(path, None)
+            if old is not None:
+                self._memory_bytes -= len(old.body)
+            self._memory[path] = entry
+            self._memory_bytes += len(entry.body)
+            while self._memory_bytes > self.memory_max and len(self._memory) > 1:
+                oldest = next(iter(self._memory))
+                self._memory_bytes -= len(self._memory.pop(oldest).body)
+
+    # --- Disk tier: one file per path, JSON metadata line then the body ---
+
+    def _file(self, path):
+        return os.path.join(self.directory, hashlib.sha1(path.encode()).hexdigest())
+
+    def _save(self, path, entry):
+        if entry.status != 200 or self.build is None:
+            return  # Without a build fingerprint a restart could not tell whether entries are stale
+        filename = self._file(path)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            meta = json.dumps(dict(entry.to_meta(), path=path)).encode() + b'\n'
+            tmp = f'{filename}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(meta)
+                f.write(entry.body)
+            try:
+                replaced = os.stat(filename).st_size
+            except OSError:
+                replaced = 0
+            os.replace(tmp, filename)
+        except OSError as e:
+            log.error(f"[CACHE] Disk write failed: {e}")
+            return
+        if self._count_disk(len(meta) + len(entry.body) - replaced) > self.disk_max:
+            self._trim_disk()
+
+    def _count_disk(self, delta):
+        """Apply a size change to the disk total - returns the new total"""
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += delta
+                return self._disk_bytes
+        # First write since start: count what is on disk once (this write and earlier runs' files)
+        total = sum(size for _, size, _ in self._disk_files())
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = total
+            return self._disk_bytes
+
+    def _load(self, path):
+        if self.build is None:
+            return None
+        try:
+            with open(self._file(path), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('path') != path:
+            return None
+        return CachedAsset(meta['status'], [tuple(h) for h in meta['headers']], body, meta['etag'],
+                           meta['last_modified'], meta['max_age'], meta['stored_at'])
+
+    def _disk_files(self):
+        """[(mtime, size, name)] for the entries on disk"""
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return files
+        for name in names:
+            if name == BUILD_MARKER:
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        return files
+
+    def _trim_disk(self):
+        """Over the limit: evict the oldest files down to ASSET_DISK_TRIM_TO of it, and re-sync the total"""
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max * ASSET_DISK_TRIM_TO
+        for _, size, name in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
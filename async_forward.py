@@ -0,0 +1,687 @@
+#!/usr/bin/env python3
+"""
+Asyncio engine for the Antigravity Remote Access Proxy
+- Serves the UI (8890), LSP (8891) and mobile (8892) listeners from one event loop
+- No thread per connection: idle long-polls and LSP streams cost a coroutine, not an OS thread
+- Same routing, CSRF injection and HTML patching as tcp_forward.ProxyHandler; every response
+  streams through, without the threaded engine's caches, compression or coalescing
+- Serves /__gravity/metrics too (request counts and durations)
+- Routing state comes from tcp_forward's globals, kept fresh by its health_check_loop
+
+Run with:  python3 tcp_forward.py --async   (or python3 async_forward.py)
+"""
+import asyncio
+import email.utils
+import http
+import sys
+import threading
+import time
+
+import tcp_forward
+import gravity_log as log
+from upstream_pool import POOL_IDLE_TIMEOUT, POOL_MAX_IDLE_PER_TARGET, lsp_ssl_context
+
+MAX_HEADER_BYTES = 64 * 1024   # Request/response head size limit
+STREAM_CHUNK = 64 * 1024       # Largest single read when relaying a body
+
+
+class ProtocolError(Exception):
+    """Malformed HTTP from the browser or the upstream"""
+
+
+async def read_head(reader):
+    """Read a request/response head: (start_line, [(name, value), ...])"""
+    data = await reader.readuntil(b'\r\n\r\n')
+    lines = data.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ProtocolError(f'bad header line: {line!r}')
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def get_header(headers, name, default=None):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return default
+
+
+def is_chunked(headers):
+    return 'chunked' in get_header(headers, 'Transfer-Encoding', '').lower()
+
+
+class IdleWatchdog:
+    """Aborts a connection after `timeout` seconds without progress - one timer instead of a wait_for per read"""
+
+    def __init__(self, writer, timeout):
+        self.writer = writer
+        self.timeout = timeout
+        self.loop = asyncio.get_running_loop()
+        self.last_progress = self.loop.time()
+        self.handle = self.loop.call_later(timeout, self._check)
+
+    def touch(self):
+        self.last_progress = self.loop.time()
+
+    def _check(self):
+        idle = self.loop.time() - self.last_progress
+        if idle >= self.timeout:
+            self.writer.transport.abort()
+        else:
+            self.handle = self.loop.call_later(self.timeout - idle, self._check)
+
+    def cancel(self):
+        self.handle.cancel()
+
+
+async def iter_body(reader, headers, until_close=False, watchdog=None):
+    """Yield body pieces framed by Content-Length, chunked encoding or (for responses) connection close"""
+    touch = watchdog.touch if watchdog is not None else (lambda: None)
+
+    if is_chunked(headers):
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                raise ConnectionResetError('connection closed inside chunked body')
+            size = int(size_line.split(b';')[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            remaining = size
+            while remaining:
+                piece = await reader.read(min(remaining, STREAM_CHUNK))
+                if not piece:
+                    raise ConnectionResetError('connection closed inside chunked body')
+                touch()
+                remaining -= len(piece)
+                yield piece
+            await reader.readexactly(2)
+        return
+
+    length = get_header(headers, 'Content-Length')
+    if length is not None:
+        remaining = int(length)
+        while remaining > 0:
+            piece = await reader.read(min(remaining, STREAM_CHUNK))
+            if not piece:
+                raise ConnectionResetError('connection closed before end of body')
+            touch()
+            remaining -= len(piece)
+            yield piece
+        return
+
+    if until_close:
+        while True:
+            piece = await reader.read(STREAM_CHUNK)
+            if not piece:
+                return
+            touch()
+            yield piece
+
+
+class StreamedBody:
+    """Browser request body relayed upstream piece by piece as it arrives (twin of tcp_forward.RequestBodyReader)
+    - a Content-Length body keeps its length, a chunked one is re-chunked"""
+
+    def __init__(self, reader, headers, limit=None):
+        self.reader = reader
+        self.headers = headers
+        self.chunked = is_chunked(headers)
+        self.length = None if self.chunked else int(get_header(headers, 'Content-Length'))
+        self.limit = tcp_forward.MAX_REQUEST_BODY if limit is None else limit
+        self.received = 0
+        self.done = False
+
+    def framing(self):
+        """Upstream framing header for this body"""
+        return ('Transfer-Encoding', 'chunked') if self.chunked else ('Content-Length', str(self.length))
+
+    async def send(self, writer):
+        """Relay the body to the upstream - browser-side failures raise tcp_forward.RequestBodyError,
+        upstream-side ones their own connection errors"""
+        pieces = iter_body(self.reader, self.headers)
+        while True:
+            try:
+                piece = await pieces.__anext__()
+            except StopAsyncIteration:
+                break
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                raise tcp_forward.RequestBodyError(f'browser request body: {e}') from None
+            self.received += len(piece)
+            if self.received > self.limit:
+                raise tcp_forward.RequestBodyTooLarge(f'Request body over {self.limit} bytes')
+            writer.write(b'%X\r\n%s\r\n' % (len(piece), piece) if self.chunked else piece)
+            await writer.drain()
+        if self.chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        self.done = True
+
+
+def response_has_body(method, status):
+    return method != 'HEAD' and status >= 200 and status not in (204, 304)
+
+
+class AsyncUpstreamPool:
+    """Asyncio twin of upstream_pool.UpstreamPool - idle (reader, writer) pairs per (scheme, host, port)"""
+
+    def __init__(self, max_idle_per_target=POOL_MAX_IDLE_PER_TARGET, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle_per_target = max_idle_per_target
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'discarded': 0}
+
+    @staticmethod
+    def key(host, port, https=False):
+        return ('https' if https else 'http', host, port)
+
+    @staticmethod
+    def _alive(reader, writer):
+        return not reader.at_eof() and not writer.is_closing()
+
+    async def acquire(self, host, port, https=False, fresh=False):
+        """Return (reader, writer, reused)"""
+        if not fresh:
+            idle = self._idle.get(self.key(host, port, https), [])
+            now = time.monotonic()
+            while idle:
+                reader, writer, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout and self._alive(reader, writer):
+                    self.stats['reused'] += 1
+                    return reader, writer, True
+                self.stats['evicted'] += 1
+                writer.close()
+        self.stats['created'] += 1
+        if https:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=lsp_ssl_context(), server_hostname=host, limit=MAX_HEADER_BYTES)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_HEADER_BYTES)
+        return reader, writer, False
+
+    def release(self, host, port, https, reader, writer):
+        idle = self._idle.setdefault(self.key(host, port, https), [])
+        if len(idle) < self.max_idle_per_target and self._alive(reader, writer):
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            self.discard(writer)
+
+    def discard(self, writer):
+        self.stats['discarded'] += 1
+        writer.close()
+
+    def evict(self, live_ports=None):
+        """Close idle connections that timed out, died, or point at a port routing moved away from"""
+        now = time.monotonic()
+        closed = 0
+        for key, idle in self._idle.items():
+            keep = []
+            for reader, writer, last_used in idle:
+                if (now - last_used > self.idle_timeout or not self._alive(reader, writer)
+                        or (live_ports is not None and key[2] not in live_ports)):
+                    writer.close()
+                    closed += 1
+                else:
+                    keep.append((reader, writer, last_used))
+            self._idle[key] = keep
+        self.stats['evicted'] += closed
+        return closed
+
+    def idle_count(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+
+class AsyncProxy:
+    """One coroutine per browser connection, HTTP/1.1 keep-alive on both sides"""
+
+    def __init__(self, pool=None):
+        self.pool = pool or AsyncUpstreamPool()
+        self.active_connections = 0
+
+    async def handle_client(self, reader, writer):
+        listen_port = writer.get_extra_info('sockname')[1]
+        client_ip = (writer.get_extra_info('peername') or ('?',))[0]
+        requests_handled = 0
+        self.active_connections += 1
+        tcp_forward.METRICS.inc('gravity_connections_active')
+        try:
+            while requests_handled < tcp_forward.KEEPALIVE_MAX_REQUESTS:
+                try:
+                    start_line, headers = await asyncio.wait_for(
+                        read_head(reader), tcp_forward.KEEPALIVE_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break  # Idle keep-alive expired or browser went away
+                except (asyncio.LimitOverrunError, ValueError, ProtocolError):
+                    await self.send_simple(writer, 400, b'Bad request', close=True)
+                    break
+                parts = start_line.split(' ')
+                if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+                    await self.send_simple(writer, 400, b'Bad request', close=True)
+                    break
+                method, path, version = parts
+                requests_handled += 1
+
+                connection = get_header(headers, 'Connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = 'close' not in connection
+                else:
+                    keep_alive = 'keep-alive' in connection
+                if requests_handled >= tcp_forward.KEEPALIVE_MAX_REQUESTS:
+                    keep_alive = False
+
+                request = (method, path, version, headers)
+                started = time.perf_counter()
+                status, keep_alive = await self.handle_request(request, reader, writer, listen_port, keep_alive)
+                tcp_forward.first_request_served()
+                self.record_request(listen_port, path, status, started)
+                self.log_request(client_ip, start_line, status)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, ProtocolError):
+            pass  # Browser hung up or sent a malformed body - nothing more to say on this connection
+        finally:
+            self.active_connections -= 1
+            tcp_forward.METRICS.inc('gravity_connections_active', value=-1)
+            writer.close()
+
+    @staticmethod
+    def record_request(listen_port, path, status, started):
+        """Request count and duration (byte counts and phase timing are threaded-engine only)"""
+        if path == tcp_forward.METRICS_PATH:
+            return
+        labels = (('route', tcp_forward.route_name(listen_port, path.startswith('/exa.'))),)
+        tcp_forward.METRICS.inc('gravity_requests_total', labels + (('status', str(status or 0)),))
+        tcp_forward.METRICS.observe('gravity_request_duration_seconds', time.perf_counter() - started, labels)
+
+    def log_request(self, client_ip, start_line, status):
+        log.info(f'[REQ] {client_ip} - "{start_line}" {status} -')
+
+    def head_bytes(self, status, headers, version, keep_alive, requests_left=None):
+        try:
+            reason = http.HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        lines = [f'HTTP/1.1 {status} {reason}', f'Date: {email.utils.formatdate(usegmt=True)}']
+        lines.extend(f'{k}: {v}' for k, v in headers)
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif version == 'HTTP/1.1':
+            lines.append(f'Keep-Alive: timeout={tcp_forward.KEEPALIVE_IDLE_TIMEOUT}')
+        else:
+            lines.append('Connection: keep-alive')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def send_simple(self, writer, status, body, close=False, version='HTTP/1.1', extra=()):
+        headers = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))]
+        headers.extend(extra)
+        writer.write(self.head_bytes(status, headers, version, keep_alive=not close) + body)
+        await writer.drain()
+
+    async def handle_request(self, request, reader, writer, listen_port, keep_alive):
+        """Proxy one request - returns (status, keep_alive)"""
+        method, path, version, _ = request
+        if path == tcp_forward.METRICS_PATH and method == 'GET':
+            return await self.send_metrics(writer, version, keep_alive)
+        # The routing version this request sticks to, even if the health check switches meanwhile
+        lease = tcp_forward.ROUTING.pin()
+        try:
+            return await self.proxy(request, reader, writer, listen_port, keep_alive, lease)
+        finally:
+            lease.release()
+
+    async def send_metrics(self, writer, version, keep_alive):
+        """Prometheus scrape - only for clients on this machine"""
+        client_ip = (writer.get_extra_info('peername') or ('?',))[0]
+        if not client_ip.startswith(('127.', '::1', '::ffff:127.')):
+            await self.send_simple(writer, 404, b'Not found', close=not keep_alive, version=version)
+            return 404, keep_alive
+        body = tcp_forward.METRICS.render()
+        headers = [('Content-Type', tcp_forward.METRICS_CONTENT_TYPE), ('Content-Length', str(len(body))),
+                   ('Cache-Control', 'no-store')]
+        writer.write(self.head_bytes(200, headers, version, keep_alive) + body)
+        await writer.drain()
+        return 200, keep_alive
+
+    async def proxy(self, request, reader, writer, listen_port, keep_alive, lease):
+        method, path, version, headers = request
+
+        if tcp_forward.is_upgrade_request(headers):
+            # WebSocket handshake - becomes a raw tunnel after the upstream's 101
+            return await self.tunnel_upgrade(request, reader, writer, listen_port, lease.route)
+
+        # Request body - small ones are read whole (retryable), large or chunked ones stream upstream as they
+        # arrive; oversized uploads are refused before they are read where possible
+        length = get_header(headers, 'Content-Length', '')
+        if length.isdigit() and int(length) > tcp_forward.MAX_REQUEST_BODY:
+            await self.send_simple(writer, 413, b'Request body too large', close=True, version=version)
+            return 413, False
+        if get_header(headers, 'Expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if is_chunked(headers) or (length.isdigit() and int(length) > tcp_forward.REQUEST_BUFFER_LIMIT):
+            body = StreamedBody(reader, headers)
+        else:
+            body = b''.join([piece async for piece in iter_body(reader, headers)])
+
+        if method == 'OPTIONS':
+            await self.send_simple(writer, 200, b'', close=not keep_alive, version=version, extra=[
+                ('Access-Control-Allow-Origin', '*'),
+                ('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS'),
+                ('Access-Control-Allow-Headers', '*'),
+                ('Access-Control-Allow-Credentials', 'true'),
+            ])
+            return 200, keep_alive
+
+        target_host, target_port, is_lsp_request = tcp_forward.route_request(path, listen_port, lease.route)
+        upstream_headers = tcp_forward.forward_headers(
+            [(k, v) for k, v in headers if k.lower() not in ('content-length', 'transfer-encoding')],
+            target_host, target_port, is_lsp_request, route=lease.route)
+        if isinstance(body, StreamedBody):
+            name, value = body.framing()
+            upstream_headers[name] = value
+        elif body or method in ('POST', 'PUT'):
+            upstream_headers['Content-Length'] = str(len(body))
+
+        response_started = False
+        up_writer = None
+        watchdog = None
+        try:
+            (up_reader, up_writer, status, up_headers), (target_host, target_port, use_https) = \
+                await self.open_upstream_failover(method, path, listen_port, is_lsp_request, upstream_headers, body,
+                                                  lease)
+            watchdog = IdleWatchdog(up_writer, tcp_forward.UPSTREAM_TIMEOUT)
+            upstream_reusable = (get_header(up_headers, 'Connection', '').lower() != 'close')
+            has_body = response_has_body(method, status)
+            framed = is_chunked(up_headers) or get_header(up_headers, 'Content-Length') is not None
+            if has_body and not framed:
+                upstream_reusable = False  # Body ends when the upstream closes
+
+            is_html = (listen_port in (tcp_forward.UI_PORT, tcp_forward.MOBILE_PORT)
+                       and 'text/html' in get_header(up_headers, 'Content-Type', ''))
+            # Every response streams as it arrives - the Agent Tab document goes through the rewriter,
+            # Connect streams are relayed one whole message at a time
+            patcher = relay = None
+            if is_html and has_body and not is_lsp_request:
+                patcher = tcp_forward.html_patcher(mobile=(listen_port == tcp_forward.MOBILE_PORT),
+                                                   incoming_port=listen_port, route=lease.route)
+            elif is_lsp_request and has_body and tcp_forward.is_connect_stream(get_header(up_headers, 'Content-Type')):
+                relay = tcp_forward.EnvelopeRelay(path, tcp_forward.CONNECT_STATS)
+            # Re-frame as chunked when there is no length (or the rewriter changes it)
+            chunked = has_body and (patcher is not None or get_header(up_headers, 'Content-Length') is None)
+            if chunked and version != 'HTTP/1.1':
+                keep_alive = False
+                chunked = False
+            dropped = ('transfer-encoding', 'connection', 'keep-alive')
+            if patcher is not None:
+                dropped += ('content-length',)
+            out_headers = [(k, v) for k, v in up_headers if k.lower() not in dropped]
+            if chunked:
+                out_headers.append(('Transfer-Encoding', 'chunked'))
+            out_headers += [('Access-Control-Allow-Origin', '*'), ('Access-Control-Allow-Credentials', 'true')]
+            writer.write(self.head_bytes(status, out_headers, version, keep_alive))
+            response_started = True
+            await writer.drain()
+            if has_body:
+                async for piece in iter_body(up_reader, up_headers, until_close=True, watchdog=watchdog):
+                    if patcher is not None:
+                        piece = patcher.feed(piece)
+                    elif relay is not None:
+                        piece = relay.feed(piece)
+                    await self.write_piece(writer, piece, chunked)
+                if patcher is not None:
+                    await self.write_piece(writer, patcher.close(), chunked)
+                elif relay is not None:
+                    await self.write_piece(writer, relay.close(), chunked)
+                    tcp_forward.log_connect_stream(relay)
+                if chunked:
+                    writer.write(b'0\r\n\r\n')
+                    await writer.drain()
+
+            if up_writer is not None:
+                if upstream_reusable:
+                    self.pool.release(target_host, target_port, use_https, up_reader, up_writer)
+                else:
+                    self.pool.discard(up_writer)
+                up_writer = None
+            return status, keep_alive
+        except tcp_forward.RequestBodyTooLarge as e:
+            log.error(f"[ERROR] {e}")
+            # The rest of the upload is never read
+            await self.send_simple(writer, 413, b'Request body too large', close=True, version=version)
+            return 413, False
+        except tcp_forward.RequestBodyError as e:
+            log.error(f"[ERROR] {path}: {e}")
+            # Where the next request starts is unknown - answer if the browser is still there, then hang up
+            try:
+                await self.send_simple(writer, 400, str(e).encode(), close=True, version=version)
+            except (ConnectionError, OSError):
+                pass
+            return 400, False
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError,
+                ProtocolError, ValueError) as e:
+            log.error(f"[ERROR] {e}")
+            if response_started:
+                # Too late for an error page - drop the connection so the client sees a truncated body
+                return 502, False
+            await self.send_simple(writer, 502, str(e).encode(), close=True, version=version)
+            return 502, False
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if up_writer is not None:
+                self.pool.discard(up_writer)
+
+    @staticmethod
+    async def write_piece(writer, data, chunked):
+        # An empty chunk would end a chunked body early
+        if not data:
+            return
+        writer.write(b'%X\r\n%s\r\n' % (len(data), data) if chunked else data)
+        await writer.drain()
+
+    async def tunnel_upgrade(self, request, reader, writer, listen_port, route):
+        """Forward an Upgrade handshake, then pipe raw bytes both ways - returns (status, keep_alive=False)"""
+        method, path, version, headers = request
+        host, port, is_lsp_request = tcp_forward.route_request(path, listen_port, route)
+        https = is_lsp_request and route.lsp_https
+        try:
+            up_reader, up_writer = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=lsp_ssl_context() if https else None,
+                server_hostname=host if https else None, limit=MAX_HEADER_BYTES), tcp_forward.UPSTREAM_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.error(f"[ERROR] {e}")
+            await self.send_simple(writer, 502, str(e).encode(), close=True, version=version)
+            return 502, False
+        try:
+            upstream_headers = tcp_forward.forward_headers(headers, host, port, is_lsp_request, upgrade=True,
+                                                           route=route)
+            head = f'{method} {path} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in upstream_headers.items())
+            up_writer.write((head + '\r\n').encode('latin-1'))
+            await up_writer.drain()
+
+            start_line, up_headers = await asyncio.wait_for(read_head(up_reader), tcp_forward.UPSTREAM_TIMEOUT)
+            status = int(start_line.split(' ', 2)[1])
+            raw_head = start_line + '\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in up_headers) + '\r\n'
+            writer.write(raw_head.encode('latin-1'))
+            await writer.drain()
+            if status != 101:
+                # Upstream refused to switch - relay its answer and hang up
+                async for piece in iter_body(up_reader, up_headers, until_close=True):
+                    writer.write(piece)
+                    await writer.drain()
+                return status, False
+
+            counts = {'up': 0, 'down': 0}
+            last_activity = [time.monotonic()]
+
+            async def pipe(src, dst, direction):
+                try:
+                    while True:
+                        data = await src.read(STREAM_CHUNK)
+                        if not data:
+                            break
+                        dst.write(data)
+                        await dst.drain()
+                        counts[direction] += len(data)
+                        last_activity[0] = time.monotonic()
+                except (ConnectionError, OSError):
+                    pass
+
+            async def idle_guard():
+                while True:
+                    await asyncio.sleep(min(5, tcp_forward.TUNNEL_IDLE_TIMEOUT))
+                    if time.monotonic() - last_activity[0] > tcp_forward.TUNNEL_IDLE_TIMEOUT:
+                        return
+
+            with tcp_forward.TUNNEL_STATS_LOCK:
+                tcp_forward.TUNNEL_STATS['opened'] += 1
+                tcp_forward.TUNNEL_STATS['active'] += 1
+            started = time.monotonic()
+            tasks = [asyncio.ensure_future(pipe(reader, up_writer, 'up')),
+                     asyncio.ensure_future(pipe(up_reader, writer, 'down')),
+                     asyncio.ensure_future(idle_guard())]
+            try:
+                # Either side closing (or the idle guard firing) ends the tunnel
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                with tcp_forward.TUNNEL_STATS_LOCK:
+                    tcp_forward.TUNNEL_STATS['active'] -= 1
+                    tcp_forward.TUNNEL_STATS['bytes_up'] += counts['up']
+                    tcp_forward.TUNNEL_STATS['bytes_down'] += counts['down']
+            log.info(f"[TUNNEL] {path} closed after {time.monotonic() - started:.0f}s "
+                  f"(up {counts['up']} B, down {counts['down']} B)")
+            return 101, False
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError,
+                ProtocolError, ValueError) as e:
+            log.error(f"[ERROR] {e}")
+            return 502, False
+        finally:
+            up_writer.close()
+
+    async def open_upstream_failover(self, method, path, listen_port, is_lsp_request, headers, body, lease):
+        """open_upstream, riding out an IDE / language_server restart like ProxyHandler.open_upstream_failover
+        - returns (open_upstream result, (host, port, https) actually used)"""
+        kind = 'lsp' if is_lsp_request else 'ui'
+        deadline = None
+        while True:
+            route = lease.route
+            host, port, _ = tcp_forward.route_request(path, listen_port, route)
+            https = is_lsp_request and route.lsp_https
+            headers['Host'] = f'{host}:{port}'
+            if is_lsp_request and route.csrf_token:
+                headers['x-codeium-csrf-token'] = route.csrf_token
+            try:
+                result = await self.open_upstream(method, path, host, port, https, headers, body)
+            except (ConnectionRefusedError, ConnectionResetError) as e:
+                deadline = tcp_forward.failover_retry(kind, (host, port), e, method,
+                                                      not isinstance(body, StreamedBody), deadline)
+                if deadline is None:
+                    raise
+                # Discovery blocks (probes, /proc) - keep it off the event loop
+                await asyncio.to_thread(tcp_forward.rediscover)
+                # Nothing was relayed yet, so the retry moves to the newest routing version
+                if tcp_forward.route_request(path, listen_port, lease.renew())[:2] == (host, port):
+                    await asyncio.sleep(tcp_forward.FAILOVER_RETRY_INTERVAL)
+                continue
+            if deadline is not None:
+                tcp_forward.METRICS.inc('gravity_failover_requests_total', (('outcome', 'recovered'),))
+            tcp_forward.failover_ended(kind, (host, port))
+            return result, (host, port, https)
+
+    async def open_upstream(self, method, path, host, port, https, headers, body):
+        """Send the request on a pooled connection, retrying once if a reused one went stale"""
+        head = f'{method} {path} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        streamed = isinstance(body, StreamedBody)
+        payload = head.encode('latin-1') + (b'' if streamed else body)
+        for attempt in range(2):
+            reader, writer, reused = await self.pool.acquire(host, port, https=https, fresh=attempt > 0)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                if streamed:
+                    await body.send(writer)
+                while True:
+                    start_line, up_headers = await asyncio.wait_for(read_head(reader), tcp_forward.UPSTREAM_TIMEOUT)
+                    status = int(start_line.split(' ', 2)[1])
+                    if status >= 200 or status == 101:
+                        return reader, writer, status, up_headers
+                    # Interim 1xx (e.g. 100 Continue) - wait for the real response
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                self.pool.discard(writer)
+                # The IDE may close an idle keep-alive connection just as we reuse it
+                # (a streamed body is already partly consumed and cannot be sent again)
+                if not reused or method not in tcp_forward.IDEMPOTENT_METHODS or streamed:
+                    raise ConnectionResetError(f'upstream {host}:{port} closed the connection')
+            except BaseException:
+                self.pool.discard(writer)
+                raise
+        raise ConnectionResetError(f'upstream {host}:{port} closed the connection')
+
+
+async def evict_loop(proxy):
+    """Age out idle upstream connections and drop ones to ports the health check switched away from"""
+    while True:
+        await asyncio.sleep(10)
+        route = tcp_forward.ROUTING.current
+        live_ports = {route.ui_target[1], route.lsp_port}
+        proxy.pool.evict(live_ports)
+
+
+async def serve(ports, host='0.0.0.0', proxy=None, ready=None):
+    """Start one listener per port on the running loop and serve forever"""
+    proxy = proxy or AsyncProxy()
+    servers = []
+    for port in ports:
+        server = await asyncio.start_server(proxy.handle_client, host, port,
+                                            limit=MAX_HEADER_BYTES, reuse_address=True)
+        servers.append(server)
+    if ready is not None:
+        ready(servers)
+    evictor = asyncio.ensure_future(evict_loop(proxy))
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        evictor.cancel()
+        for server in servers:
+            server.close()
+
+
+def main():
+    warm = tcp_forward.load_routing()
+
+    def ready(servers):
+        # Listeners are bound: clients queue from here on, even while a cold start detects routing
+        tcp_forward.start_routing(warm)
+        route = tcp_forward.ROUTING.current
+        lsp_protocol = 'https' if route.lsp_https else 'http'
+        log.write("=" * 60)
+        log.write("Antigravity Remote Access Proxy v2.5 (asyncio engine)")
+        log.write("=" * 60)
+        log.write(f"External IP: {route.external_ip}")
+        log.write(f"IDE Port: {route.ui_target[1]} ({'last known' if warm else 'auto-detected'})")
+        log.write(f"LSP Port: {route.lsp_port} ({lsp_protocol})")
+        token = route.csrf_token
+        log.write(f"CSRF Token: {token[:16] if token else 'NOT FOUND'}...")
+        log.write(f"\nListening on {tcp_forward.UI_PORT} (UI), {tcp_forward.LSP_PORT} (LSP), "
+              f"{tcp_forward.MOBILE_PORT} (mobile) - one event loop")
+        # Discovery stays blocking, so it keeps its own thread
+        threading.Thread(target=tcp_forward.health_check_loop, daemon=True).start()
+        log.write("\nPress Ctrl+C to stop\n")
+
+    try:
+        asyncio.run(serve([tcp_forward.UI_PORT, tcp_forward.LSP_PORT, tcp_forward.MOBILE_PORT], ready=ready))
+    except KeyboardInterrupt:
+        log.write("Stopping...")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Benchmark: threaded ProxyHandler vs asyncio engine (async_forward.py)
+- Runs a fake Agent Tab / language_server and each proxy engine in its own process
+- Measures keep-alive asset throughput and latency (p50/p99)
+- Then holds N idle LSP streams open and reports proxy threads, RSS and asset latency under that load
+
+Usage: python3 bench_engines.py [--requests 3000] [--concurrency 50] [--streams 200]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from async_forward import iter_body, read_head
+
+ASSET = b'/* bundle */' + b'x' * (32 * 1024)
+HTML = ("<html><head></head><body><script>window.chatParams = '"
+        + base64.b64encode(json.dumps({'languageServerUrl': 'https://127.0.0.1:1/'}).encode()).decode()
+        + "';</script></body></html>").encode()
+
+
+# --- Fake upstream (Agent Tab + language_server on one port) ---
+
+async def upstream_client(reader, writer):
+    try:
+        while True:
+            start_line, headers = await read_head(reader)
+            async for _ in iter_body(reader, headers):
+                pass
+            path = start_line.split(' ')[1]
+            if path.endswith('/Stream'):
+                # Long-lived agent stream: one chunk, then hold the call open
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/connect+json\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n')
+                await writer.drain()
+                await asyncio.sleep(3600)
+                return
+            body, content_type = (HTML, 'text/html') if path == '/' else (ASSET, 'application/javascript')
+            writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_upstream(port):
+    async def serve():
+        server = await asyncio.start_server(upstream_client, '127.0.0.1', port, backlog=1024)
+        await server.serve_forever()
+    asyncio.run(serve())
+
+
+def run_proxy(engine, upstream_port, listen_port, workers):
+    import tcp_forward
+    tcp_forward.UI_PORT = listen_port
+    tcp_forward.ROUTING.update(ui_target=('127.0.0.1', upstream_port), lsp_port=upstream_port,
+                               lsp_https=False, csrf_token='bench-token')
+    tcp_forward.log.LOG.set_level('OFF')  # [PATCH] lines would dominate the profile
+
+    if engine == 'threaded':
+        class Handler(tcp_forward.ProxyHandler):
+            def log_message(self, format, *args):
+                pass
+        tcp_forward.ThreadedHTTPServer.request_queue_size = 1024
+        # One worker per client and held stream, so the comparison measures threads rather than load shedding
+        tcp_forward.ThreadedHTTPServer.pool = tcp_forward.WorkerPool(size=workers, queue_size=1024, name='bench')
+        tcp_forward.ThreadedHTTPServer(('127.0.0.1', listen_port), Handler).serve_forever()
+    else:
+        import async_forward
+
+        class Proxy(async_forward.AsyncProxy):
+            def log_request(self, client_ip, start_line, status):
+                pass
+        asyncio.run(async_forward.serve([listen_port], host='127.0.0.1', proxy=Proxy()))
+
+
+# --- Load generator ---
+
+async def fetch(reader, writer, method, path):
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: 0\r\n\r\n'.encode())
+    await writer.drain()
+    _, headers = await read_head(reader)
+    async for _ in iter_body(reader, headers):
+        pass
+
+
+async def asset_load(port, total, concurrency):
+    latencies = []
+    remaining = [total]
+
+    async def worker():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=1 << 20)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                path = '/' if remaining[0] % 20 == 0 else '/asset.js'
+                start = time.perf_counter()
+                await fetch(reader, writer, 'GET', path)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def open_streams(port, count):
+    streams = []
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /exa.Bench/Stream HTTP/1.1\r\nHost: bench\r\nContent-Length: 2\r\n\r\n{}')
+        await writer.drain()
+        await read_head(reader)
+        streams.append(writer)
+    return streams
+
+
+def process_status(pid):
+    fields = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.strip()
+    return int(fields['Threads']), int(fields['VmRSS'].split()[0]) // 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing listening on {port}')
+
+
+def spawn(*args):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + [str(a) for a in args])
+
+
+def bench_engine(engine, upstream_port, args):
+    port = free_port()
+    proc = spawn('proxy', engine, upstream_port, port, args.streams + args.concurrency + 8)
+    try:
+        wait_for_port(port)
+        result = asyncio.run(asset_load(port, args.requests, args.concurrency))
+
+        async def under_streams():
+            streams = await open_streams(port, args.streams)
+            await asyncio.sleep(0.5)
+            threads, rss = process_status(proc.pid)
+            loaded = await asset_load(port, args.requests // 4, min(args.concurrency, 10))
+            for writer in streams:
+                writer.close()
+            return threads, rss, loaded
+
+        threads, rss, loaded = asyncio.run(under_streams())
+        result.update({'threads': threads, 'rss_mb': rss,
+                       'p50_streams_ms': loaded['p50_ms'], 'p99_streams_ms': loaded['p99_ms']})
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'upstream':
+        return run_upstream(int(sys.argv[2]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'proxy':
+        return run_proxy(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--streams', type=int, default=200)
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = spawn('upstream', upstream_port)
+    try:
+        wait_for_port(upstream_port)
+        print(f"{args.requests} keep-alive GETs x {args.concurrency} clients, then {args.streams} held LSP streams\n")
+        print(f"{'engine':<10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'threads':>9}{'RSS MB':>8}"
+              f"{'p50*':>8}{'p99*':>8}")
+        for engine in ('threaded', 'asyncio'):
+            r = bench_engine(engine, upstream_port, args)
+            print(f"{engine:<10}{r['rps']:>9.0f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['threads']:>9}"
+                  f"{r['rss_mb']:>8}{r['p50_streams_ms']:>8.2f}{r['p99_streams_ms']:>8.2f}")
+        print("\n* asset latency while the LSP streams are held open")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmark: LSP latency under a concurrent Agent Tab asset load, with and without priority scheduling
+- One client (127.0.0.1) keeps --loaders connections pulling large uncacheable bundles
+- Another client (127.0.0.2) opens agent streams and sends Cancel RPCs one after another
+- Reports time to the first stream message and RPC round trip (p50/p99), and asset throughput
+
+Usage: python3 bench_priority.py [--seconds 8] [--loaders 16] [--bundle-kb 2048]
+"""
+import argparse
+import http.client
+import http.server
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from bench_engines import free_port, wait_for_port
+
+ENVELOPE = b'\x00\x00\x00\x00\x0f{"token":"hi"}\n'
+
+
+# --- Fake upstream: Agent Tab bundles + language_server ---
+
+def run_upstream(port, bundle_kb):
+    piece = b'x' * 65536
+    pieces = max(1, bundle_kb // 64)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # Headers and body go out as separate writes
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/javascript')
+            self.send_header('Cache-Control', 'no-store')
+            self.send_header('Content-Length', str(pieces * len(piece)))
+            self.end_headers()
+            for _ in range(pieces):
+                self.wfile.write(piece)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if 'Stream' in self.path:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/connect+json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.write(b'%X\r\n%s\r\n0\r\n\r\n' % (len(ENVELOPE), ENVELOPE))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    http.server.ThreadingHTTPServer.request_queue_size = 256
+    http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+def run_proxy(upstream_port, listen_port):
+    import tcp_forward
+    tcp_forward.UI_PORT = listen_port
+    tcp_forward.ROUTING.update(ui_target=('127.0.0.1', upstream_port), lsp_port=upstream_port,
+                               lsp_https=False, csrf_token='bench-token')
+    tcp_forward.log.LOG.set_level('OFF')
+
+    class Handler(tcp_forward.ProxyHandler):
+        def log_message(self, format, *args):
+            pass
+    tcp_forward.ThreadedHTTPServer(('127.0.0.1', listen_port), Handler).serve_forever()
+
+
+def spawn(*args, priority=True):
+    env = dict(os.environ)
+    if not priority:
+        env['GRAVITY_NO_PRIORITY'] = '1'
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + [str(a) for a in args], env=env)
+
+
+# --- Clients ---
+
+def run_loaders(port, loaders, seconds):
+    """Asset load in its own process, so it does not compete with the LSP client for the GIL"""
+    stop, counter = threading.Event(), []
+
+    def loader():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        n = 0
+        while not stop.is_set():
+            n += 1
+            conn.request('GET', f'/bundle/{n}.js')
+            counter.append(len(conn.getresponse().read()))
+        conn.close()
+    threads = [threading.Thread(target=loader) for _ in range(loaders)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    print(sum(counter))
+
+
+def lsp_session(port, stop, first_message, rpc):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30, source_address=('127.0.0.2', 0))
+    while not stop.is_set():
+        started = time.perf_counter()
+        conn.request('POST', '/exa.Bench/StreamChat', b'{}', {'Content-Type': 'application/connect+json'})
+        response = conn.getresponse()
+        response.read(len(ENVELOPE))
+        first_message.append(time.perf_counter() - started)
+        response.read()
+        started = time.perf_counter()
+        conn.request('POST', '/exa.Bench/CancelCascade', b'{}', {'Content-Type': 'application/json'})
+        conn.getresponse().read()
+        rpc.append(time.perf_counter() - started)
+        time.sleep(0.02)
+    conn.close()
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+
+def bench_mode(priority, upstream_port, args):
+    port = free_port()
+    proc = spawn('proxy', upstream_port, port, priority=priority)
+    try:
+        wait_for_port(port)
+        load = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'load', str(port), str(args.loaders),
+                                 str(args.seconds)], stdout=subprocess.PIPE)
+        time.sleep(0.5)  # Let the bulk load get going first
+        stop = threading.Event()
+        first_message, rpc = [], []
+        session = threading.Thread(target=lsp_session, args=(port, stop, first_message, rpc))
+        session.start()
+        time.sleep(args.seconds - 1)
+        stop.set()
+        session.join()
+        loaded = int(load.communicate()[0])
+        return {'stream_p50': statistics.median(first_message) * 1000, 'stream_p99': percentile(first_message, 0.99),
+                'rpc_p50': statistics.median(rpc) * 1000, 'rpc_p99': percentile(rpc, 0.99),
+                'asset_mb_s': loaded / 1e6 / args.seconds}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'upstream':
+        return run_upstream(int(sys.argv[2]), int(sys.argv[3]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'proxy':
+        return run_proxy(int(sys.argv[2]), int(sys.argv[3]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'load':
+        return run_loaders(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=8)
+    parser.add_argument('--loaders', type=int, default=16)
+    parser.add_argument('--bundle-kb', type=int, default=2048)
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = spawn('upstream', upstream_port, args.bundle_kb)
+    try:
+        wait_for_port(upstream_port)
+        print(f"{args.loaders} connections pulling {args.bundle_kb} KB bundles, one agent session on another client\n")
+        print(f"{'scheduler':<11}{'stream p50':>11}{'p99':>8}{'rpc p50':>9}{'p99':>8}{'assets MB/s':>13}")
+        for mode, priority in (('off', False), ('priority', True)):
+            r = bench_mode(priority, upstream_port, args)
+            print(f"{mode:<11}{r['stream_p50']:>11.1f}{r['stream_p99']:>8.1f}{r['rpc_p50']:>9.1f}"
+                  f"{r['rpc_p99']:>8.1f}{r['asset_mb_s']:>13.0f}")
+        print("\nlatencies in ms")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
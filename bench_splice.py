@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark: large passthrough bodies with and without zero-copy splice (zerocopy.py)
+- Runs a fake upstream serving one big uncacheable blob and the threaded proxy in its own process
+- Pulls --gigabytes through the proxy on one keep-alive connection, once per mode
+- Reports throughput and proxy CPU seconds per GB (from /proc/<pid>/stat)
+
+Usage: python3 bench_splice.py [--gigabytes 1] [--body-mb 64]
+"""
+import argparse
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+
+from bench_engines import free_port, wait_for_port
+
+CHUNK = 1024 * 1024
+
+
+# --- Fake upstream: GET /blob -> body_mb of zeros, never cacheable ---
+
+def run_upstream(port, body_mb):
+    payload = bytes(CHUNK)
+    header = (f'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n'
+              f'Cache-Control: no-store\r\nContent-Length: {body_mb * CHUNK}\r\n\r\n').encode()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                self.wfile.write(header)
+                for _ in range(body_mb):
+                    self.wfile.write(payload)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+def run_proxy(upstream_port, listen_port):
+    import tcp_forward
+    tcp_forward.UI_PORT = listen_port
+    tcp_forward.ROUTING.update(ui_target=('127.0.0.1', upstream_port))
+    tcp_forward.log.LOG.set_level('OFF')
+
+    class Handler(tcp_forward.ProxyHandler):
+        def log_message(self, format, *args):
+            pass
+    tcp_forward.ThreadedHTTPServer(('127.0.0.1', listen_port), Handler).serve_forever()
+
+
+def spawn(*args, splice=True):
+    env = dict(os.environ)
+    if not splice:
+        env['GRAVITY_NO_SPLICE'] = '1'
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + [str(a) for a in args], env=env)
+
+
+# --- Client ---
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def fetch(sock, buf):
+    """One GET /blob on a kept-alive connection - returns body bytes"""
+    sock.sendall(b'GET /blob HTTP/1.1\r\nHost: bench\r\n\r\n')
+    head = b''
+    while b'\r\n\r\n' not in head:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('proxy closed the connection')
+        head += data
+    head, _, rest = head.partition(b'\r\n\r\n')
+    length = next(int(line.split(b':', 1)[1]) for line in head.split(b'\r\n')
+                  if line.lower().startswith(b'content-length:'))
+    remaining = length - len(rest)
+    while remaining:
+        n = sock.recv_into(buf, min(len(buf), remaining))
+        if not n:
+            raise ConnectionError('truncated body')
+        remaining -= n
+    return length
+
+
+def bench_mode(splice, upstream_port, args):
+    port = free_port()
+    proc = spawn('proxy', upstream_port, port, splice=splice)
+    try:
+        wait_for_port(port)
+        buf = bytearray(CHUNK)
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            fetch(sock, buf)  # Warm the upstream pool
+            cpu_before, started, total = cpu_seconds(proc.pid), time.perf_counter(), 0
+            while total < args.gigabytes * 1024 ** 3:
+                total += fetch(sock, buf)
+            elapsed, cpu = time.perf_counter() - started, cpu_seconds(proc.pid) - cpu_before
+        gb = total / 1024 ** 3
+        return {'gb': gb, 'mb_s': total / CHUNK / elapsed, 'cpu_per_gb': cpu / gb}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'upstream':
+        return run_upstream(int(sys.argv[2]), int(sys.argv[3]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'proxy':
+        return run_proxy(int(sys.argv[2]), int(sys.argv[3]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--gigabytes', type=float, default=1)
+    parser.add_argument('--body-mb', type=int, default=64)
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = spawn('upstream', upstream_port, args.body_mb)
+    try:
+        wait_for_port(upstream_port)
+        print(f"{args.gigabytes:g} GB through the proxy as {args.body_mb} MB responses\n")
+        print(f"{'mode':<10}{'MB/s':>9}{'CPU s/GB':>10}")
+        for mode, splice in (('copy', False), ('splice', True)):
+            r = bench_mode(splice, upstream_port, args)
+            print(f"{mode:<10}{r['mb_s']:>9.0f}{r['cpu_per_gb']:>10.2f}")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
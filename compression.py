@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Downstream compression for tcp_forward
+- Negotiates gzip (and brotli when the module is installed) from Accept-Encoding
+- Only text-like bodies above a minimum size that the IDE did not already encode
+- Compressed variants are cached by content so each asset is compressed once
+- Tracks bytes in/out and CPU time for the health log
+"""
+import hashlib
+import threading
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024  # Smaller bodies gain less than the header costs
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher levels cost far more CPU for a few percent
+COMPRESSED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ETAG_ENCODING_MARK = '-gr-'  # Sets ETags the proxy gave a compressed variant apart from the IDE's own
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/x-javascript', 'application/json',
+                      'application/xml', 'application/wasm', 'image/svg+xml', 'application/manifest+json')
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encoding):
+    """Best encoding we support from an Accept-Encoding header, or None"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(content_type, content_encoding=None, length=None):
+    """Text-like, not already encoded, and big enough to be worth it (length None = unknown)"""
+    if content_encoding and content_encoding.strip().lower() != 'identity':
+        return False
+    if length is not None and length < MIN_COMPRESS_SIZE:
+        return False
+    content_type = (content_type or '').lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.split(';')[0].endswith(('+json', '+xml'))
+
+
+def encoded_etag(etag, encoding):
+    """Distinct strong validator per representation: "abc" -> "abc-gr-gzip\""""
+    if not etag or not encoding:
+        return etag
+    if etag.endswith('"'):
+        return f'{etag[:-1]}{ETAG_ENCODING_MARK}{encoding}"'
+    return f'{etag}{ETAG_ENCODING_MARK}{encoding}'
+
+
+def strip_etag_encoding(value):
+    """Undo encoded_etag on an If-None-Match header before it goes upstream - other ETags are left alone"""
+    if not value or ETAG_ENCODING_MARK not in value:
+        return value
+    tags = []
+    for tag in value.split(','):
+        tag = tag.strip()
+        for encoding in ('br', 'gzip'):
+            suffix = f'{ETAG_ENCODING_MARK}{encoding}"'
+            if tag.endswith(suffix):
+                tag = tag[:-len(suffix)] + '"'
+                break
+        tags.append(tag)
+    return ', '.join(tags)
+
+
+def vary_with_encoding(vary):
+    """The upstream Vary value (None if absent) with Accept-Encoding merged in, listed once"""
+    fields = [f.strip() for f in (vary or '').split(',') if f.strip()]
+    if any(f == '*' or f.lower() == 'accept-encoding' for f in fields):
+        return ', '.join(fields)
+    return ', '.join(fields + ['Accept-Encoding'])
+
+
+class StreamCompressor:
+    """Incremental encoder - with progressive=True every feed() is flushed so pages render as they arrive"""
+
+    def __init__(self, encoding, stats=None, progressive=True):
+        self.encoding = encoding
+        self.stats = stats
+        self.progressive = progressive
+        self.output = None  # Set to a list to keep a copy of everything produced
+        if encoding == 'br':
+            self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def _run(self, fn, size_in):
+        started = time.thread_time()
+        out = fn()
+        if self.output is not None:
+            self.output.append(out)
+        if self.stats is not None:
+            self.stats.record(size_in, len(out), time.thread_time() - started)
+        return out
+
+    def feed(self, data):
+        if not data:
+            return b''
+        if self.encoding == 'br':
+            if not self.progressive:
+                return self._run(lambda: self._obj.process(data), len(data))
+            return self._run(lambda: self._obj.process(data) + self._obj.flush(), len(data))
+        if not self.progressive:
+            return self._run(lambda: self._obj.compress(data), len(data))
+        return self._run(lambda: self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH), len(data))
+
+    def finish(self):
+        return self._run(self._obj.finish if self.encoding == 'br' else self._obj.flush, 0)
+
+
+class Compressor:
+    """One-shot compression with a content-addressed LRU of results"""
+
+    def __init__(self, max_cache_bytes=COMPRESSED_CACHE_MAX_BYTES):
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = {}
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0,
+                      'cache_hits': 0, 'skipped': 0}
+
+    def record(self, bytes_in, bytes_out, cpu_seconds, response=False):
+        with self._lock:
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            self.stats['cpu_seconds'] += cpu_seconds
+            if response:
+                self.stats['responses'] += 1
+
+    def skipped(self):
+        with self._lock:
+            self.stats['skipped'] += 1
+
+    def encode(self, body, encoding, cache_key=None):
+        """Compressed body - cache_key (e.g. an ETag) avoids hashing; default is the body's digest"""
+        key = (cache_key or hashlib.sha1(body).hexdigest(), encoding)
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached is not None:
+                self._cache[key] = cached
+                self.stats['cache_hits'] += 1
+                return cached
+        started = time.thread_time()
+        if encoding == 'br':
+            out = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            out = obj.compress(body) + obj.flush()
+        self.record(len(body), len(out), time.thread_time() - started, response=True)
+        self._keep(key, out)
+        return out
+
+    def adopt(self, body, encoding, encoded, cache_key=None):
+        """Cache output produced elsewhere (a streamed response) as the encoding of body"""
+        self._keep((cache_key or hashlib.sha1(body).hexdigest(), encoding), encoded)
+
+    def _keep(self, key, out):
+        with self._lock:
+            if key not in self._cache and len(out) <= self.max_cache_bytes // 4:
+                self._cache[key] = out
+                self._cache_bytes += len(out)
+                while self._cache_bytes > self.max_cache_bytes:
+                    oldest = next(iter(self._cache))
+                    self._cache_bytes -= len(self._cache.pop(oldest))
+
+    def streaming(self, encoding, progressive=True):
+        with self._lock:
+            self.stats['responses'] += 1
+        return StreamCompressor(encoding, stats=self, progressive=progressive)
+
+    def summary(self):
+        with self._lock:
+            s = dict(self.stats)
+        s['ratio'] = s['bytes_out'] / s['bytes_in'] if s['bytes_in'] else 1.0
+        return s
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Connect / gRPC-web aware relay for language_server streams
+- Streaming bodies are a series of envelopes: 1 flag byte, 4-byte big-endian length, payload
+- Every message is forwarded as soon as it is complete, and never split across writes
+- Per-stream message counts, bytes and inter-message gaps
+"""
+import collections
+import struct
+import threading
+import time
+
+MAX_ENVELOPE_BYTES = 64 * 1024 * 1024  # A bigger length means this is not envelope framing - pass through
+RECENT_STREAMS = 20  # Summaries kept for the stats view
+
+ENVELOPE_HEADER = struct.Struct('>BI')
+FLAG_END_STREAM = 0x02  # Connect end-of-stream message (trailers / error)
+FLAG_TRAILERS = 0x80    # gRPC-web trailers frame
+
+
+def is_connect_stream(content_type):
+    """Connect or gRPC-web streaming body (the base64 grpc-web-text variant is not framed on the wire)"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type.startswith('application/connect+'):
+        return True
+    return content_type.startswith('application/grpc-web') and not content_type.startswith('application/grpc-web-text')
+
+
+class EnvelopeRelay:
+    """feed() upstream bytes in, get back only complete envelopes; close() returns any trailing partial"""
+
+    def __init__(self, path='', stats=None):
+        self.path = path
+        self.stats = stats
+        self.passthrough = False
+        self.ended = False
+        self.messages = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.first_message = None  # Seconds from stream start to the first message
+        self.last_message = None
+        self.gap_total = 0.0
+        self.gap_max = 0.0
+        self._buf = bytearray()
+
+    def feed(self, data):
+        if self.passthrough:
+            return data
+        self._buf += data
+        end = 0
+        now = time.monotonic()
+        while len(self._buf) - end >= ENVELOPE_HEADER.size:
+            flags, length = ENVELOPE_HEADER.unpack_from(self._buf, end)
+            if length > MAX_ENVELOPE_BYTES:
+                # Not envelope framing after all - stop parsing and relay bytes as they come
+                self.passthrough = True
+                out = bytes(self._buf)
+                self._buf.clear()
+                return out
+            if len(self._buf) - end - ENVELOPE_HEADER.size < length:
+                break  # Rest of this message is still on its way
+            end += ENVELOPE_HEADER.size + length
+            self._message(flags, length, now)
+        out = bytes(self._buf[:end])
+        del self._buf[:end]
+        return out
+
+    def _message(self, flags, length, now):
+        if flags & (FLAG_END_STREAM | FLAG_TRAILERS):
+            self.ended = True
+            return
+        self.messages += 1
+        self.bytes += length
+        if self.last_message is None:
+            self.first_message = now - self.started
+        else:
+            gap = now - self.last_message
+            self.gap_total += gap
+            self.gap_max = max(self.gap_max, gap)
+        self.last_message = now
+
+    def close(self):
+        leftover = bytes(self._buf)
+        self._buf.clear()
+        if self.stats is not None:
+            self.stats.record(self)
+        return leftover
+
+    def summary(self):
+        gaps = self.messages - 1
+        return {
+            'path': self.path,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'duration': time.monotonic() - self.started,
+            'first_message': self.first_message,
+            'gap_avg': self.gap_total / gaps if gaps > 0 else 0.0,
+            'gap_max': self.gap_max,
+            'ended': self.ended,
+            'passthrough': self.passthrough,
+        }
+
+
+class ConnectStreamStats:
+    """Totals across all relayed streams, plus the last few per-stream summaries"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {'streams': 0, 'messages': 0, 'bytes': 0, 'gap_total': 0.0, 'gap_count': 0,
+                       'gap_max': 0.0, 'unframed': 0}
+        self.recent = collections.deque(maxlen=RECENT_STREAMS)
+
+    def record(self, relay):
+        summary = relay.summary()
+        with self._lock:
+            self.totals['streams'] += 1
+            self.totals['messages'] += relay.messages
+            self.totals['bytes'] += relay.bytes
+            self.totals['gap_total'] += relay.gap_total
+            self.totals['gap_count'] += max(relay.messages - 1, 0)
+            self.totals['gap_max'] = max(self.totals['gap_max'], relay.gap_max)
+            if relay.passthrough:
+                self.totals['unframed'] += 1
+            self.recent.append(summary)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.totals), list(self.recent)
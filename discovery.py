@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+In-process discovery of the IDE's language_server from /proc (Linux)
+- Replaces `ps aux` + `ss -tunlp`: no forks, no scan of text output
+- One pass returns the workspace language_server's PID, loopback listening ports and CSRF token
+- Command lines are parsed once per process (cached by PID and executable, so a PID that
+  is reused or exec()s is read again); only the socket table is re-read every time
+"""
+import os
+import threading
+
+PROC = '/proc'
+LOOPBACK = ('0100007F', '0000000000000000FFFF00000100007F')  # 127.0.0.1 in /proc/net/tcp and tcp6
+TCP_LISTEN = '0A'
+
+
+class LanguageServer:
+    __slots__ = ('pid', 'exe', 'argv', 'csrf_token', 'workspace_id', 'started', 'ports')
+
+    def __init__(self, pid, exe, argv, csrf_token, workspace_id, started):
+        self.pid = pid
+        self.exe = exe
+        self.argv = argv
+        self.csrf_token = csrf_token
+        self.workspace_id = workspace_id
+        self.started = started      # Clock ticks since boot - newest server wins
+        self.ports = []
+
+    def __repr__(self):
+        return f'LanguageServer(pid={self.pid}, ports={self.ports}, workspace_id={self.workspace_id!r})'
+
+
+def flag_value(argv, name):
+    """Value of --name VALUE or --name=VALUE, or None"""
+    for i, arg in enumerate(argv):
+        if arg == name and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return None
+
+
+def read_listening_ports(proc=PROC):
+    """{socket inode: port} for TCP sockets listening on 127.0.0.1"""
+    ports = {}
+    for table in ('tcp', 'tcp6'):
+        try:
+            with open(f'{proc}/net/{table}') as f:
+                next(f)  # Header
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 10 or fields[3] != TCP_LISTEN:
+                        continue
+                    address, port = fields[1].split(':')
+                    if address in LOOPBACK:
+                        ports[fields[9]] = int(port, 16)
+        except (OSError, StopIteration):
+            pass
+    return ports
+
+
+class Discovery:
+    def __init__(self, proc=PROC):
+        self.proc = proc
+        self._lock = threading.Lock()
+        self._cache = {}            # pid -> (exe link, LanguageServer or None)
+        self.stats = {'scans': 0, 'parsed': 0, 'cached': 0}
+
+    def _exe(self, pid):
+        try:
+            return os.readlink(f'{self.proc}/{pid}/exe')
+        except OSError:
+            return None  # Exited, kernel thread, or another user's process
+
+    def _parse(self, pid, exe):
+        try:
+            with open(f'{self.proc}/{pid}/cmdline', 'rb') as f:
+                argv = f.read().decode('utf-8', 'replace').split('\0')[:-1]
+        except OSError:
+            return None
+        if not argv or 'language_server' not in os.path.basename(argv[0]):
+            return None
+        token = flag_value(argv, '--csrf_token')
+        if not token:
+            return None
+        try:
+            with open(f'{self.proc}/{pid}/stat') as f:
+                started = int(f.read().rsplit(')', 1)[1].split()[19])
+        except (OSError, IndexError, ValueError):
+            started = 0
+        return LanguageServer(int(pid), exe or argv[0], argv, token, flag_value(argv, '--workspace_id'), started)
+
+    def language_servers(self):
+        """Every language_server with a CSRF token on its command line"""
+        found, seen = [], set()
+        with self._lock:
+            self.stats['scans'] += 1
+            try:
+                pids = [p for p in os.listdir(self.proc) if p.isdigit()]
+            except OSError:
+                return []
+            for pid in pids:
+                seen.add(pid)
+                exe = self._exe(pid)
+                cached = self._cache.get(pid)
+                if cached is not None and cached[0] == exe:
+                    self.stats['cached'] += 1
+                    server = cached[1]
+                else:
+                    self.stats['parsed'] += 1
+                    server = self._parse(pid, exe)
+                    self._cache[pid] = (exe, server)
+                if server is not None:
+                    found.append(server)
+            for pid in list(self._cache):
+                if pid not in seen:
+                    del self._cache[pid]
+        return found
+
+    def ports_of(self, pid, listening=None):
+        """Loopback TCP ports the process listens on, in the order it opened them"""
+        listening = read_listening_ports(self.proc) if listening is None else listening
+        fd_dir = f'{self.proc}/{pid}/fd'
+        ports = []
+        try:
+            fds = sorted(os.listdir(fd_dir), key=int)
+        except OSError:
+            return ports
+        for fd in fds:
+            try:
+                link = os.readlink(f'{fd_dir}/{fd}')
+            except OSError:
+                continue
+            if link.startswith('socket:['):
+                port = listening.get(link[8:-1])
+                if port is not None and port not in ports:
+                    ports.append(port)
+        return ports
+
+    def find_language_server(self):
+        """The workspace language_server (newest if several, else any) with its ports - or None"""
+        servers = self.language_servers()
+        if not servers:
+            return None
+        server = max(servers, key=lambda s: (s.workspace_id is not None, s.started))
+        server.ports = self.ports_of(server.pid)
+        return server
+
+
+DISCOVERY = Discovery()
+
+
+def find_language_server():
+    return DISCOVERY.find_language_server()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Non-blocking log output shared by the proxy, mobile and websocket servers
+- Callers only filter by level and put the line on a bounded queue; one background thread
+  formats and writes it in batches, so a slow terminal or disk never stalls a request
+  thread or the event loop (when the queue is full, lines are dropped and counted)
+- Identical messages repeated more than REPEAT_BURST times in REPEAT_WINDOW seconds are
+  folded into one "repeated N more times" line
+- With GRAVITY_LOG_FILE set, output goes to that file and rotates at LOG_MAX_BYTES
+
+Usage: import gravity_log as log; log.info("[HEALTH] ..."); log.error(f"[ERROR] {e}")
+"""
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR, OFF = 10, 20, 30, 40, 100
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR, 'OFF': OFF}
+
+LOG_LEVEL = os.environ.get('GRAVITY_LOG_LEVEL', 'INFO')   # [REQ] lines are INFO; WARNING hides them
+LOG_FILE = os.environ.get('GRAVITY_LOG_FILE') or None    # None = stdout
+LOG_MAX_BYTES = 10 * 1024 * 1024    # Rotate the log file at this size
+LOG_BACKUPS = 3                     # Rotated files kept as <file>.1 ... <file>.3
+LOG_QUEUE = 10000                   # Lines waiting for the writer before new ones are dropped
+LOG_BATCH = 512                     # Lines written per batch
+REPEAT_BURST = 5                    # Identical messages written per window ...
+REPEAT_WINDOW = 10                  # ... of this many seconds
+
+_FLUSH = object()
+
+
+class AsyncLog:
+    """Lines are queued by the caller and written by a background thread (started on first use)"""
+
+    def __init__(self, path=LOG_FILE, level=LOG_LEVEL, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 queue_size=LOG_QUEUE, repeat_burst=REPEAT_BURST, repeat_window=REPEAT_WINDOW, name='log'):
+        self.path = path
+        self.set_level(level)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.repeat_burst = repeat_burst
+        self.repeat_window = repeat_window
+        self.name = name
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._size = 0
+        self._repeats = {}          # message -> [window start, times seen]; writer thread only
+        self._swept = 0.0
+        self.stats = {'written': 0, 'dropped': 0, 'suppressed': 0, 'rotations': 0}
+
+    def set_level(self, level):
+        self.level = level if isinstance(level, int) else LEVELS.get(str(level).upper(), INFO)
+
+    # --- Caller side: never blocks ---
+
+    def log(self, level, message):
+        if level >= self.level:
+            self._put((time.time(), level, message))
+
+    def debug(self, message):
+        self.log(DEBUG, message)
+
+    def info(self, message):
+        self.log(INFO, message)
+
+    def warning(self, message):
+        self.log(WARNING, message)
+
+    def error(self, message):
+        self.log(ERROR, message)
+
+    def write(self, text):
+        """Queue text as is - no timestamp, level filter or repeat folding (banners, JSON lines)"""
+        self._put((None, None, text))
+
+    def _put(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.stats['dropped'] += 1  # Approximate under contention - only reported
+
+    def flush(self, timeout=2):
+        """Wait (up to timeout) until everything queued so far has been written"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put((None, _FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)  # Write out what is still queued when the process exits
+
+    # --- Writer thread ---
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                batch = []
+            try:
+                while len(batch) < LOG_BATCH:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                sys.stderr.write(f"[LOG] {self.name} writer failed: {e}\n")
+
+    def _write_batch(self, batch):
+        now = time.time()
+        lines, waiters = [], []
+        if now - self._swept >= 1 or len(self._repeats) > 4096:
+            self._sweep(now, lines)
+        for stamp, level, message in batch:
+            if level is _FLUSH:
+                waiters.append(message)
+            elif stamp is None:
+                lines.append(message if message.endswith('\n') else message + '\n')
+            elif self._admit(stamp, message, lines):
+                lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp))} {message}\n")
+        if lines:
+            self._emit(''.join(lines), len(lines))
+        for done in waiters:
+            done.set()
+
+    def _admit(self, stamp, message, lines):
+        """False for repeats beyond the burst in the current window (they are only counted)"""
+        if not self.repeat_burst:
+            return True
+        seen = self._repeats.get(message)
+        if seen is None or stamp - seen[0] >= self.repeat_window:
+            if seen is not None:
+                self._fold(message, seen, lines)
+            self._repeats[message] = [stamp, 1]
+            return True
+        seen[1] += 1
+        if seen[1] > self.repeat_burst:
+            self.stats['suppressed'] += 1
+            return False
+        return True
+
+    def _sweep(self, now, lines):
+        self._swept = now
+        for message, seen in list(self._repeats.items()):
+            if now - seen[0] >= self.repeat_window:
+                del self._repeats[message]
+                self._fold(message, seen, lines)
+
+    def _fold(self, message, seen, lines):
+        repeated = seen[1] - self.repeat_burst
+        if repeated > 0:
+            lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} [LOG] last message repeated {repeated} more "
+                         f"times in {self.repeat_window}s: {message[:120]}\n")
+
+    def _emit(self, text, count):
+        if self.path is None:
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                self.stats['written'] += count
+            except (OSError, ValueError):
+                self.stats['dropped'] += count
+            return
+        data = text.encode('utf-8', 'replace')
+        try:
+            if self._file is None:
+                self._open()
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self.stats['written'] += count
+        except OSError as e:
+            self.stats['dropped'] += count
+            self._file = None
+            sys.stderr.write(f"[LOG] Cannot write {self.path}: {e}\n")
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.truncate(self.path, 0)
+        self.stats['rotations'] += 1
+        self._open()
+
+
+LOG = AsyncLog(name='gravity-log')
+
+
+# Module-level shortcuts look LOG up at call time, so it can be swapped (tests, benchmarks)
+
+def debug(message):
+    LOG.log(DEBUG, message)
+
+
+def info(message):
+    LOG.log(INFO, message)
+
+
+def warning(message):
+    LOG.log(WARNING, message)
+
+
+def error(message):
+    LOG.log(ERROR, message)
+
+
+def write(text):
+    LOG.write(text)
@@ -5,6 +5,8 @@
 
 SCRIPT_DIR="/home/absolut7/Documents/26apps/gravityremote"
 LOG_FILE="/tmp/hayat-proxy.log"
+# The proxy writes its own (rotated) log; crashes still land in LOG_FILE
+export GRAVITY_LOG_FILE="/tmp/gravity-proxy.log"
 
 echo "🌙 HAYAT Proxy Starting - $(date)" >> $LOG_FILE
 
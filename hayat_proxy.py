@@ -14,11 +14,12 @@ import subprocess
 import time
 import os
 import sys
-import re
 import signal
 import socket
 import threading
 
+from discovery import find_language_server
+
 # Configuration
 CHECK_INTERVAL = 10      # Seconds between health checks
 RESTART_DELAY = 5        # Seconds to wait before restart
@@ -56,35 +57,13 @@ class HayatProxy:
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] {message}")
     
-    def get_csrf_token(self):
-        """Extract CSRF token from language_server process"""
-        try:
-            result = subprocess.run(['ps', 'aux'], capture_output=True, text=True, timeout=5)
-            for line in result.stdout.split('\n'):
-                if 'language_server' in line and 'csrf_token' in line and 'workspace_id' in line:
-                    match = re.search(r'csrf_token\s+([a-f0-9-]+)', line)
-                    if match:
-                        return match.group(1)
-        except Exception as e:
-            self.log(f"[WARN] Failed to get CSRF: {e}")
-        return None
-    
-    def get_lsp_port(self):
-        """Find the LSP port that responds to HTTPS"""
-        try:
-            result = subprocess.run(['ss', '-tlnp'], capture_output=True, text=True, timeout=5)
-            ports = []
-            for line in result.stdout.split('\n'):
-                if 'language_server' in line:
-                    match = re.search(r'127\.0\.0\.1:(\d+)', line)
-                    if match:
-                        ports.append(int(match.group(1)))
-            
-            # Return the first port (usually the main LSP)
-            return ports[0] if ports else None
-        except Exception as e:
-            self.log(f"[WARN] Failed to get LSP port: {e}")
-        return None
+    def get_ide_config(self):
+        """(CSRF token, first loopback port) of the workspace language_server - one /proc scan for both"""
+        server = find_language_server()
+        if server is None:
+            return None, None
+        csrf = server.csrf_token if server.workspace_id else None
+        return csrf, server.ports[0] if server.ports else None
     
     def check_port_bound(self, port):
         """Check if our proxy is bound to a port"""
@@ -97,6 +76,15 @@ class HayatProxy:
         except:
             return False
     
+    def wait_for_port(self, port, bound=True, timeout=5):
+        """Poll until the port is (or is no longer) bound - True if that happened in time"""
+        deadline = time.monotonic() + timeout
+        while self.check_port_bound(port) != bound:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+    
     def health_check(self):
         """Check if proxy is healthy"""
         try:
@@ -111,8 +99,7 @@ class HayatProxy:
     
     def detect_config_change(self):
         """Detect if IDE config (CSRF/LSP port) has changed"""
-        new_csrf = self.get_csrf_token()
-        new_lsp = self.get_lsp_port()
+        new_csrf, new_lsp = self.get_ide_config()
         
         if new_csrf and new_csrf != self.current_csrf:
             self.log(f"[التجدد] CSRF token changed: {new_csrf[:20]}...")
@@ -133,7 +120,7 @@ class HayatProxy:
         # Kill any existing proxy
         subprocess.run(['pkill', '-9', '-f', 'tcp_forward.py'], 
                       capture_output=True, timeout=5)
-        time.sleep(2)
+        self.wait_for_port(MOBILE_PORT, bound=False, timeout=2)
         
         # Start new proxy
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -146,14 +133,13 @@ class HayatProxy:
             cwd=script_dir
         )
         
-        # Wait for it to start
-        time.sleep(3)
+        # The proxy binds before it looks for the IDE - wait for the listener, not a fixed time
+        bound = self.wait_for_port(MOBILE_PORT, bound=True, timeout=5)
         
         # Update current config
-        self.current_csrf = self.get_csrf_token()
-        self.current_lsp_port = self.get_lsp_port()
+        self.current_csrf, self.current_lsp_port = self.get_ide_config()
         
-        if self.check_port_bound(MOBILE_PORT):
+        if bound:
             self.log(f"[✓] Proxy started on ports {UI_PORT}, {MOBILE_PORT}, {LSP_PORT}")
             return True
         else:
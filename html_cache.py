@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Cache of patched Agent Tab documents
+- Keyed by request path plus the routing inputs the patch depends on
+  (IDE port, LSP port, external IP, listener / mobile flag)
+- Each entry remembers the upstream validator (ETag, else body hash) it was built from,
+  so a revalidated upstream document is served without re-patching
+- Serves our own strong ETag so browsers can get 304 Not Modified
+"""
+import hashlib
+import threading
+
+HTML_CACHE_MAX_ENTRIES = 32
+HTML_CACHE_MAX_BODY = 4 * 1024 * 1024  # Larger documents are patched but not cached
+
+ETAG_PREFIX = 'gr-'
+
+
+class PatchedDocument:
+    """One patched document and the upstream state it was built from"""
+
+    def __init__(self, status, headers, body, etag, upstream_etag=None, upstream_hash=None, last_modified=None):
+        self.status = status
+        self.headers = headers          # Upstream headers to replay (framing/validators removed)
+        self.body = body
+        self.etag = etag                # Our strong ETag for the patched bytes
+        self.upstream_etag = upstream_etag
+        self.upstream_hash = upstream_hash
+        self.last_modified = last_modified
+
+
+def make_etag(upstream_validator, routing_key, fingerprint=''):
+    """Strong ETag for a patched document - the patch is deterministic in these inputs"""
+    digest = hashlib.sha1(repr((upstream_validator, routing_key, fingerprint)).encode()).hexdigest()
+    return f'"{ETAG_PREFIX}{digest[:24]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """RFC 7232 weak comparison for If-None-Match"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or f'W/{etag}' in tags
+
+
+def is_our_etag(if_none_match):
+    return bool(if_none_match) and ETAG_PREFIX in if_none_match
+
+
+class PatchedHTMLCache:
+    """Small LRU of PatchedDocument keyed by (path, routing_key)"""
+
+    def __init__(self, max_entries=HTML_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'not_modified': 0, 'invalidations': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # Most recently used goes last
+            return entry
+
+    def store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self.stats['stores'] += 1
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def clear(self):
+        """Drop everything - called when routing changes"""
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self.stats['invalidations'] += 1
+            return dropped
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
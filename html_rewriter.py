@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Streaming HTML rewriter for the Agent Tab document
+- Injects markup right after <head> (or before <body when there is no <head>)
+- Rewrites the base64 `window.chatParams = '...'` assignment through a callback
+- Matches across chunk boundaries while holding back only a few bytes,
+  so the browser gets the first bytes of the page immediately
+"""
+import re
+import time
+
+import gravity_log as log
+
+MAX_CHAT_PARAMS_BYTES = 1024 * 1024  # Give up (pass through unpatched) beyond this
+
+CHAT_PARAMS_PREFIX = b'window.chatParams'
+# Everything after the prefix: `  =  '<base64>'` (either quote style)
+CHAT_PARAMS_TAIL = re.compile(rb"\s*=\s*(['\"])([A-Za-z0-9+/=]*)(['\"]?)")
+
+
+class HeadInjector:
+    """Insert `markup` after the first <head> (or before the first <body) of a streamed document"""
+
+    def __init__(self, markup):
+        self.markup = markup
+        self.done = not markup
+        self._held = b''
+
+    def feed(self, data):
+        if self.done:
+            return data
+        buf = self._held + data
+        head = buf.find(b'<head>')
+        body = buf.find(b'<body')
+        if head != -1 and (body == -1 or head < body):
+            self.done = True
+            self._held = b''
+            return buf[:head + 6] + self.markup + buf[head + 6:]
+        if body != -1:
+            self.done = True
+            self._held = b''
+            return buf[:body] + self.markup + buf[body:]
+        # Keep a possible partial '<head>' / '<body' for the next chunk
+        keep = min(len(buf), 5)
+        self._held = buf[len(buf) - keep:]
+        return buf[:len(buf) - keep]
+
+    def close(self):
+        held, self._held = self._held, b''
+        return held
+
+
+class ChatParamsRewriter:
+    """Replace the base64 payload of `window.chatParams = '...'` using `rewrite(old_b64) -> new_b64`"""
+
+    def __init__(self, rewrite, max_bytes=MAX_CHAT_PARAMS_BYTES):
+        self.rewrite = rewrite
+        self.max_bytes = max_bytes
+        self.done = False
+        self._held = b''
+
+    def feed(self, data):
+        if self.done:
+            return data
+        out = []
+        buf = self._held + data
+        while not self.done:
+            start = buf.find(CHAT_PARAMS_PREFIX)
+            if start == -1:
+                keep = min(len(buf), len(CHAT_PARAMS_PREFIX) - 1)
+                out.append(buf[:len(buf) - keep])
+                buf = buf[len(buf) - keep:]
+                break
+            out.append(buf[:start])
+            buf = buf[start:]
+            tail = CHAT_PARAMS_TAIL.match(buf, len(CHAT_PARAMS_PREFIX))
+            if tail is not None and tail.group(2) and tail.group(3):
+                out.append(self._rewritten(buf[:tail.end()], tail))
+                buf = buf[tail.end():]
+                self.done = True
+            elif self._may_still_match(buf) and len(buf) <= self.max_bytes:
+                break  # Assignment continues in the next chunk
+            else:
+                # Not the base64 form (or absurdly long) - pass this occurrence through untouched
+                out.append(buf[:len(CHAT_PARAMS_PREFIX)])
+                buf = buf[len(CHAT_PARAMS_PREFIX):]
+        if self.done:
+            out.append(buf)
+            buf = b''
+        self._held = buf
+        return b''.join(out)
+
+    def _may_still_match(self, buf):
+        """True if buf (starting at the prefix) is a prefix of a valid assignment"""
+        rest = buf[len(CHAT_PARAMS_PREFIX):]
+        partial = re.match(rb"\s*(=\s*(['\"][A-Za-z0-9+/=]*)?)?", rest)
+        return partial.end() == len(rest)
+
+    def _rewritten(self, original, tail):
+        try:
+            new_b64 = self.rewrite(tail.group(2))
+        except Exception as e:
+            log.error(f"[!] Patch error: {e}")
+            return original
+        if new_b64 is None:
+            return original
+        return original[:tail.start(2)] + new_b64 + original[tail.end(2):]
+
+    def close(self):
+        held, self._held = self._held, b''
+        return held
+
+
+class HTMLStreamPatcher:
+    """HeadInjector followed by ChatParamsRewriter - feed() chunks in, write what comes out"""
+
+    def __init__(self, head_markup=b'', rewrite_chat_params=None):
+        self.stages = [HeadInjector(head_markup)]
+        if rewrite_chat_params is not None:
+            self.stages.append(ChatParamsRewriter(rewrite_chat_params))
+        self.elapsed = 0.0  # Seconds spent patching, for the metrics
+
+    def feed(self, data):
+        started = time.perf_counter()
+        for stage in self.stages:
+            data = stage.feed(data)
+        self.elapsed += time.perf_counter() - started
+        return data
+
+    def close(self):
+        started = time.perf_counter()
+        data = b''
+        for stage in self.stages:
+            data = stage.feed(data) + stage.close()
+        self.elapsed += time.perf_counter() - started
+        return data
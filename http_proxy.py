@@ -2,6 +2,7 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.request
 import threading
 import socketserver
+from zerocopy import can_splice, splice_response
 
 target_url = "http://127.0.0.1:9090"
 
@@ -67,6 +68,20 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.send_header('Content-Length', str(len(content)))
                     self.end_headers()
                     self.wfile.write(content)
+                elif response.length and self.command != 'HEAD' and can_splice(response, response.length):
+                    # Large sized bodies go socket-to-socket in the kernel (no Python copies)
+                    self.send_response(response.status)
+                    for k, v in response.headers.items():
+                        if k.lower() not in ['content-encoding', 'transfer-encoding']:
+                            self.send_header(k, v)
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.end_headers()
+                    if not splice_response(response, self.connection):
+                        while True:
+                            chunk = response.read(65536)
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
                 else:
                     # For non-HTML (JSON, images, etc.), use chunked streaming to prevent buildup
                     self.send_response(response.status)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Prometheus text-format metrics for tcp_forward
+- Counters and histograms are kept per thread and only summed when scraped, so the
+  request path never takes a lock to record a sample
+- A finished thread's counts are folded into a shared base and its shard dropped
+- Gauges and subsystem statistics (pools, caches, tunnels, ...) are read by collectors at scrape time
+"""
+import bisect
+import threading
+import time
+
+import gravity_log as log
+
+# Seconds - from a sub-millisecond cached answer up to a long agent stream
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _add(into, shard):
+    """Sum one shard's counters and histograms into another dict"""
+    for key, value in dict(shard).items():  # dict() copy is atomic under the GIL
+        if isinstance(value, list):
+            old = into.get(key)
+            into[key] = list(value) if old is None else [a + b for a, b in zip(old, value)]
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []           # (thread, dict) for each live thread that recorded something
+        self._base = {}             # Counts left by threads that have exited
+        self._lock = threading.Lock()  # Only taken when a thread records for the first time, and by scrapes
+        self._meta = {}             # name -> (type, help, buckets)
+        self._collectors = []
+
+    # --- Declaration ---
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self._meta[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def collector(self, fn):
+        """fn() yields (name, labels, value) for gauges/counters read at scrape time"""
+        self._collectors.append(fn)
+        return fn
+
+    # --- Hot path ---
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_dead(self):
+        """Move the counts of exited threads into the base and drop their shards (lock held)"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _add(self._base, shard)  # A dead thread never writes again
+        self._shards = live
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        shard = self._shard()
+        key = (name, labels)
+        hist = shard.get(key)
+        buckets = self._meta[name][2]
+        if hist is None:
+            hist = shard[key] = [0] * (len(buckets) + 1) + [0.0]  # bucket counts, +Inf, sum
+        hist[bisect.bisect_left(buckets, value)] += 1
+        hist[-1] += value
+
+    # --- Scrape ---
+
+    def _merged(self):
+        with self._lock:
+            self._fold_dead()
+            shards = [shard for _, shard in self._shards]
+            merged = {}
+            _add(merged, self._base)
+        for shard in shards:
+            _add(merged, shard)
+        return merged
+
+    def render(self):
+        samples = {}
+        for key, value in self._merged().items():
+            samples.setdefault(key[0], []).append((key[1], value))
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    samples.setdefault(name, []).append((labels, value))
+            except Exception as e:
+                samples.setdefault('gravity_collector_errors_total', []).append(
+                    ((('collector', fn.__name__),), 1))
+                log.error(f"[METRICS] Collector {fn.__name__} failed: {e}")
+        lines = []
+        for name in sorted(samples):
+            kind, help, buckets = self._meta.get(name, ('untyped', None, None))
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples[name], key=lambda s: s[0]):
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _number(float(bound))
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {_number(value[-1])}')
+                    lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class CountingWriter:
+    """Wraps a handler's wfile to count the bytes written to the client (and, if timed, the time it took)"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+        self.timed = False
+        self.elapsed = 0.0
+
+    def write(self, data):
+        self.bytes += len(data)
+        if not self.timed:
+            return self.raw.write(data)
+        started = time.perf_counter()
+        try:
+            return self.raw.write(data)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+    @property
+    def closed(self):
+        return self.raw.closed
@@ -11,6 +11,7 @@ import json
 import os
 import psutil
 from urllib.parse import urlparse
+import gravity_log as log
 
 
 import random
@@ -35,11 +36,11 @@ try:
             elif isinstance(raw_data, list):
                 LISAN_CORPUS = raw_data
             
-            print(f"[Mobile Server] Loaded {len(LISAN_CORPUS)} Lisan entries")
+            log.info(f"[Mobile Server] Loaded {len(LISAN_CORPUS)} Lisan entries")
     else:
-        print("[Mobile Server] Warning: lisanclean.json not found")
+        log.warning("[Mobile Server] Warning: lisanclean.json not found")
 except Exception as e:
-    print(f"[Mobile Server] Failed to load Lisan corpus: {e}")
+    log.error(f"[Mobile Server] Failed to load Lisan corpus: {e}")
 
 class MobileHandler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
@@ -125,7 +126,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
     
     def handle_kill_ide(self):
         """Kill all Antigravity IDE processes"""
-        print("[Mobile Server] Kill IDE requested")
+        log.info("[Mobile Server] Kill IDE requested")
         
         try:
             # Kill all antigravity processes
@@ -135,7 +136,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
                 text=True
             )
             
-            print(f"[Mobile Server] pkill antigravity result: {result.returncode}")
+            log.info(f"[Mobile Server] pkill antigravity result: {result.returncode}")
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -149,7 +150,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             
         except Exception as e:
-            print(f"[Mobile Server] Kill IDE error: {e}")
+            log.error(f"[Mobile Server] Kill IDE error: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -160,7 +161,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
     
     def handle_start_ide(self):
         """Start the Antigravity IDE if not running"""
-        print("[Mobile Server] Start IDE requested")
+        log.info("[Mobile Server] Start IDE requested")
         
         try:
             # Check if IDE is already running
@@ -197,7 +198,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             
         except Exception as e:
-            print(f"[Mobile Server] Start IDE error: {e}")
+            log.error(f"[Mobile Server] Start IDE error: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -208,7 +209,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
     
     def handle_stop(self):
         """Stop the current agent operation by sending Escape key"""
-        print("[Mobile Server] Stop requested (Escape)")
+        log.info("[Mobile Server] Stop requested (Escape)")
         
         try:
             # Use xdotool to send Escape key to stop current operation
@@ -218,7 +219,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
                 text=True
             )
             
-            print(f"[Mobile Server] xdotool Escape result: {result.returncode}")
+            log.info(f"[Mobile Server] xdotool Escape result: {result.returncode}")
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -232,7 +233,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             
         except Exception as e:
-            print(f"[Mobile Server] Stop error: {e}")
+            log.error(f"[Mobile Server] Stop error: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -246,7 +247,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
     
     def handle_agent_mode(self):
         """Send Ctrl+E to open Agent Mode in IDE"""
-        print("[Mobile Server] Agent Mode requested (Ctrl+E)")
+        log.info("[Mobile Server] Agent Mode requested (Ctrl+E)")
         
         try:
             # Use xdotool to send Ctrl+E to the active window
@@ -256,7 +257,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
                 text=True
             )
             
-            print(f"[Mobile Server] xdotool result: {result.returncode}")
+            log.info(f"[Mobile Server] xdotool result: {result.returncode}")
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -270,7 +271,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             
         except Exception as e:
-            print(f"[Mobile Server] Agent mode error: {e}")
+            log.error(f"[Mobile Server] Agent mode error: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -284,7 +285,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
     
     def handle_restart_ide(self):
         """Restart the Antigravity IDE process"""
-        print("[Mobile Server] Restart IDE requested")
+        log.info("[Mobile Server] Restart IDE requested")
         
         try:
             # Find and kill language_server processes
@@ -295,7 +296,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             )
             
             # Log the result
-            print(f"[Mobile Server] pkill result: {result.returncode}")
+            log.info(f"[Mobile Server] pkill result: {result.returncode}")
             
             # Send success response
             self.send_response(200)
@@ -311,7 +312,7 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             
         except Exception as e:
-            print(f"[Mobile Server] Restart error: {e}")
+            log.error(f"[Mobile Server] Restart error: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -332,11 +333,11 @@ class MobileHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
     
     def log_message(self, format, *args):
-        print(f"[Mobile:{PORT}] {args[0]}")
+        log.info(f"[Mobile:{PORT}] {args[0]}")
 
 
 def main():
-    print(f"""
+    log.write(f"""
 ╔════════════════════════════════════════╗
 ║   GravityRemote Mobile Server          ║
 ║   Port: {PORT}                            ║
@@ -347,14 +348,14 @@ def main():
     
     socketserver.TCPServer.allow_reuse_address = True
     with socketserver.TCPServer(("", PORT), MobileHandler) as httpd:
-        print(f"[Mobile Server] Running on http://0.0.0.0:{PORT}")
-        print(f"[Mobile Server] Mobile UI: http://localhost:{PORT}/mobile")
-        print(f"[Mobile Server] Restart API: POST /api/restart-ide")
+        log.write(f"[Mobile Server] Running on http://0.0.0.0:{PORT}")
+        log.write(f"[Mobile Server] Mobile UI: http://localhost:{PORT}/mobile")
+        log.write("[Mobile Server] Restart API: POST /api/restart-ide")
         
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            print("\n[Mobile Server] Shutting down...")
+            log.write("\n[Mobile Server] Shutting down...")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Concurrent probing of candidate upstream ports under one overall deadline
+- Every candidate port is tried at once (language_server ports over HTTP and HTTPS together)
+  instead of one after another with a timeout each
+- The answer is returned as soon as it is decided, i.e. when no better-ranked candidate can
+  still beat it; probes still running are left to finish (or time out) on their own
+"""
+import http.client
+import queue
+import socket
+import threading
+import time
+
+from upstream_pool import ResumingHTTPSConnection
+
+LSP_PROBE_DEADLINE = 2.0    # Seconds for all language_server ports and both protocols together
+IDE_PROBE_DEADLINE = 0.5    # Seconds for all Agent Tab ports together
+HTTPS_REQUIRED = 'HTTP request to an HTTPS server'  # What the Go server answers plain HTTP with on a TLS port
+UNDECIDED = object()
+
+
+def run_probes(probes, deadline):
+    """Start every probe ({key: fn(timeout)}) at once - yield (key, result) as each finishes, until the deadline"""
+    results = queue.Queue()
+    timeout = max(deadline - time.monotonic(), 0.05)
+
+    def run(key, fn):
+        try:
+            result = fn(timeout)
+        except Exception:
+            result = None
+        results.put((key, result))
+    for key, fn in probes.items():
+        threading.Thread(target=run, args=(key, fn), name=f'probe-{key}', daemon=True).start()
+    for _ in probes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            yield results.get(timeout=remaining)
+        except queue.Empty:
+            return
+
+
+def first_decided(order, results, final=False):
+    """First candidate in preference order with a truthy result once every better one has failed -
+    UNDECIDED while a better one is still pending (unless final), None if none succeeded"""
+    for key in order:
+        if key not in results:
+            if final:
+                continue
+            return UNDECIDED
+        if results[key]:
+            return key
+    return None
+
+
+def probe_connect(port, timeout):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        return s.connect_ex(('127.0.0.1', port)) == 0
+
+
+def probe_http(port, timeout):
+    """'http' if the port answers plain HTTP, 'https' if it answers that it wants TLS, else None"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        body = response.read(4096).decode('utf-8', errors='ignore')
+    finally:
+        conn.close()
+    if response.status not in (200, 400, 404):
+        return None
+    return 'https' if HTTPS_REQUIRED in body else 'http'
+
+
+def probe_https(port, timeout):
+    """True if an HTTPS request gets an answer - the handshake also seeds TLS session resumption,
+    but is not counted in its stats (probes run on every health check and would skew the hit rate)"""
+    conn = ResumingHTTPSConnection('127.0.0.1', port, timeout=timeout, count=False)
+    try:
+        conn.request('GET', '/')
+        conn.getresponse().read()
+        conn.remember_session()
+    finally:
+        conn.close()
+    return True
+
+
+def find_lsp_target(ports, timeout=LSP_PROBE_DEADLINE):
+    """(port, https) of the best language_server port - the first in order that answers HTTP (a TLS
+    port's plain-HTTP error counts), else the first that answers HTTPS - or None if none answer in time"""
+    deadline = time.monotonic() + timeout
+    probes = {}
+    for port in ports:
+        probes[(port, 'http')] = lambda t, port=port: probe_http(port, t)
+        probes[(port, 'https')] = lambda t, port=port: probe_https(port, t)
+    answers = {'http': {}, 'https': {}}
+
+    def decide(final=False):
+        best = first_decided(ports, answers['http'], final)
+        if best is UNDECIDED:
+            return UNDECIDED
+        if best is not None:
+            return best, answers['http'][best] == 'https'
+        best = first_decided(ports, answers['https'], final)
+        return best if best is UNDECIDED or best is None else (best, True)
+    for (port, kind), result in run_probes(probes, deadline):
+        answers[kind][port] = result
+        best = decide()
+        if best is not UNDECIDED:
+            return best
+    return decide(final=True)
+
+
+def find_ide_port(candidates, timeout=IDE_PROBE_DEADLINE):
+    """First candidate port (in preference order) accepting connections, or None"""
+    deadline = time.monotonic() + timeout
+    accepted = {}
+    probes = {port: lambda t, port=port: probe_connect(port, t) for port in candidates}
+    for port, ok in run_probes(probes, deadline):
+        accepted[port] = ok
+        best = first_decided(candidates, accepted)
+        if best is not UNDECIDED:
+            return best
+    return first_decided(candidates, accepted, final=True)
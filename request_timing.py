@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Per-request timing breakdown and slow-request log for tcp_forward
+- A sampled fraction of requests records where its time went: reading the upload, waiting
+  for a scheduler slot, upstream connect, time to first byte, patching, writing to the client
+- Sampled requests slower than the threshold are appended to a JSON-lines file with route,
+  sizes and client, so "the agent feels slow" can be traced to a phase
+- Lines are written (and the file rotated) by a gravity_log writer thread, never by the request
+"""
+import json
+import random
+import time
+
+from gravity_log import AsyncLog
+
+SLOW_REQUEST_SECONDS = 1.0          # Sampled requests at least this slow are logged
+SLOW_SAMPLE_RATE = 0.25             # Fraction of requests timed phase by phase (1.0 = all)
+SLOW_LOG_PATH = '/tmp/gravity-slow-requests.jsonl'
+SLOW_LOG_MAX_PATH = 200             # Longer request paths are cut in the log
+
+
+class RequestTiming:
+    """Phase durations (seconds) for one sampled request"""
+    __slots__ = ('started', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class SlowRequestLog:
+    def __init__(self, path=SLOW_LOG_PATH, threshold=SLOW_REQUEST_SECONDS, sample_rate=SLOW_SAMPLE_RATE):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.sink = AsyncLog(path, name='slow-log')
+        self.stats = {'sampled': 0, 'slow': 0}
+
+    def start(self):
+        """A RequestTiming if this request is sampled, else None"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        self.stats['sampled'] += 1  # Approximate under contention - only used for the metrics
+        return RequestTiming()
+
+    def finish(self, timing, **fields):
+        """Log the request if it was slow - returns the entry or None"""
+        total = time.perf_counter() - timing.started
+        if total < self.threshold:
+            return None
+        phases = {name: round(seconds * 1000, 1) for name, seconds in timing.phases.items()}
+        phases['other'] = round(max(total - sum(timing.phases.values()), 0.0) * 1000, 1)
+        path = fields.get('path') or ''
+        if len(path) > SLOW_LOG_MAX_PATH:
+            fields['path'] = path[:SLOW_LOG_MAX_PATH] + '...'
+        entry = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), total_ms=round(total * 1000, 1),
+                     phases_ms=phases, **fields)
+        self.sink.write(json.dumps(entry, separators=(',', ':')))
+        self.stats['slow'] += 1
+        return entry
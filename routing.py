@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Versioned routing table: where requests go (Agent Tab, language_server port and scheme, CSRF token)
+- Every change publishes a new immutable Route with the next version number, swapped in whole,
+  so no request sees a new port with an old scheme or token
+- Requests pin the Route they started with for their whole life (streams and tunnels included):
+  after a switch, exchanges already under way finish against the old language_server while
+  new requests go to the new one
+- Per-version request and in-flight counts show when a superseded version has drained
+"""
+import threading
+from collections import namedtuple
+
+import gravity_log as log
+
+ROUTING_HISTORY = 8  # Drained versions kept in the per-version counts
+
+Route = namedtuple('Route', 'version ui_target lsp_port lsp_https csrf_token external_ip')
+
+
+class Lease:
+    """A request's hold on one routing version - released once, when the request is done"""
+    __slots__ = ('table', 'route')
+
+    def __init__(self, table, route):
+        self.table = table
+        self.route = route
+
+    def renew(self):
+        """Move to the current version (the request is being retried after a rediscovery)"""
+        route = self.table.pin_current()
+        self.release()
+        self.route = route
+        return route
+
+    def release(self):
+        if self.route is not None:
+            self.table.release(self.route)
+            self.route = None
+
+
+class RoutingTable:
+    def __init__(self, ui_target=('127.0.0.1', 9091), lsp_port=37417, lsp_https=True, csrf_token=None,
+                 external_ip='127.0.0.1', history=ROUTING_HISTORY):
+        self._lock = threading.Lock()
+        self.history = history
+        self.current = Route(1, ui_target, lsp_port, lsp_https, csrf_token, external_ip)
+        self._counts = {1: [0, 0]}  # version -> [requests pinned, still in flight]
+
+    def update(self, **changes):
+        """Publish a new version with these fields changed - returns (old, new); new is old if nothing changed"""
+        with self._lock:
+            old = self.current
+            new = old._replace(**changes)
+            if new == old:
+                return old, old
+            new = new._replace(version=old.version + 1)
+            self._counts[new.version] = [0, 0]
+            self.current = new  # One reference swap - readers see either version whole
+            self._prune()
+        return old, new
+
+    def pin(self):
+        """Lease on the current version for one request"""
+        return Lease(self, self.pin_current())
+
+    def pin_current(self):
+        with self._lock:
+            route = self.current
+            counts = self._counts[route.version]
+            counts[0] += 1
+            counts[1] += 1
+        return route
+
+    def release(self, route):
+        with self._lock:
+            counts = self._counts.get(route.version)
+            if counts is None:
+                return
+            counts[1] -= 1
+            drained = counts[1] == 0 and route.version != self.current.version
+            if drained:
+                self._prune()
+        if drained:
+            log.info(f"[ROUTING] v{route.version} drained after {counts[0]} requests "
+                     f"(port {route.lsp_port}) - now on v{self.current.version}")
+
+    def in_flight(self, version):
+        with self._lock:
+            counts = self._counts.get(version)
+            return counts[1] if counts else 0
+
+    def _prune(self):
+        """Forget drained versions beyond the newest `history` ones (lock held)"""
+        for version in sorted(self._counts)[:-self.history]:
+            if self._counts[version][1] == 0:
+                del self._counts[version]
+
+    def snapshot(self):
+        """{version: {'requests': ..., 'in_flight': ...}} for recent versions"""
+        with self._lock:
+            return {version: {'requests': requests, 'in_flight': in_flight}
+                    for version, (requests, in_flight) in self._counts.items()}
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Priority scheduling of upstream work in the threaded proxy
+- Three classes: interactive LSP RPCs (Stop/Cancel, unary calls), LSP streams, everything else (bulk assets)
+- Interactive and stream requests are never held back; bulk fetches share a few slots,
+  and only one while an interactive RPC is in flight
+- Waiting bulk fetches are admitted round-robin per client, so one device's cold load
+  cannot starve another's
+- Bulk bodies pause between chunks while an interactive RPC is in flight
+"""
+import collections
+import os
+import threading
+import time
+
+INTERACTIVE, STREAM, BULK = 0, 1, 2
+CLASS_NAMES = ('interactive', 'stream', 'bulk')
+
+BULK_SLOTS = 4          # Bulk upstream fetches in progress at once
+BULK_SLOTS_BUSY = 1     # ... while an interactive RPC is in flight
+ADMIT_TIMEOUT = 10      # Seconds a bulk fetch waits for a slot before it goes anyway
+PACE_MAX_WAIT = 0.05    # Longest pause between two bulk chunks
+PRIORITY_ENABLED = os.environ.get('GRAVITY_NO_PRIORITY') != '1'
+
+
+def request_priority(path, is_lsp_request, content_type=None):
+    """Class of a request, decided before it goes upstream"""
+    if not is_lsp_request:
+        return BULK
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    # Connect streaming calls are sent with an enveloped (+json / +proto) body
+    if content_type.startswith(('application/connect+', 'application/grpc')) or 'Stream' in path.rsplit('/', 1)[-1]:
+        return STREAM
+    return INTERACTIVE
+
+
+class Ticket:
+    __slots__ = ('priority', 'client', 'admitted', 'queued_at')
+
+    def __init__(self, priority, client):
+        self.priority = priority
+        self.client = client
+        self.admitted = False
+        self.queued_at = None
+
+
+class PriorityScheduler:
+    def __init__(self, bulk_slots=BULK_SLOTS, busy_slots=BULK_SLOTS_BUSY, enabled=PRIORITY_ENABLED):
+        self.bulk_slots = bulk_slots
+        self.busy_slots = busy_slots
+        self.enabled = enabled
+        self._cond = threading.Condition()
+        self._waiting = collections.OrderedDict()  # client -> deque of tickets, in round-robin order
+        self.active = [0, 0, 0]
+        self.stats = {'admitted': [0, 0, 0], 'bulk_queued': 0, 'bulk_overdue': 0, 'wait_total': 0.0,
+                      'wait_max': 0.0, 'paced': 0}
+
+    def admit(self, priority, client):
+        """Block until the request may go upstream - always pair with release()"""
+        ticket = Ticket(priority, client)
+        with self._cond:
+            if priority != BULK or not self.enabled or (not self._waiting and self._bulk_room()):
+                self._start(ticket)
+                return ticket
+            ticket.queued_at = time.monotonic()
+            self._waiting.setdefault(client, collections.deque()).append(ticket)
+            self.stats['bulk_queued'] += 1
+            self._dispatch()
+            deadline = ticket.queued_at + ADMIT_TIMEOUT
+            while not ticket.admitted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Slots held by slow downloads - better late than never
+                    self._dequeue(ticket)
+                    self.stats['bulk_overdue'] += 1
+                    self._start(ticket)
+                    break
+                self._cond.wait(remaining)
+            waited = time.monotonic() - ticket.queued_at
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+        return ticket
+
+    def release(self, ticket):
+        """Give the slot back - once the upstream is read, not after the client has it; repeats are ignored"""
+        with self._cond:
+            if not ticket.admitted:
+                return
+            ticket.admitted = False
+            self.active[ticket.priority] -= 1
+            self._dispatch()
+
+    def pace(self, ticket):
+        """Between bulk chunks: give the CPU and the link to interactive RPCs in flight"""
+        if ticket.priority != BULK or not self.enabled or not self.active[INTERACTIVE]:
+            return
+        with self._cond:
+            self.stats['paced'] += 1
+            self._cond.wait_for(lambda: not self.active[INTERACTIVE], PACE_MAX_WAIT)
+
+    def _bulk_room(self):
+        limit = self.busy_slots if self.active[INTERACTIVE] else self.bulk_slots
+        return self.active[BULK] < limit
+
+    def _start(self, ticket):
+        ticket.admitted = True
+        self.active[ticket.priority] += 1
+        self.stats['admitted'][ticket.priority] += 1
+
+    def _dequeue(self, ticket):
+        queue = self._waiting.get(ticket.client)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._waiting[ticket.client]
+
+    def _dispatch(self):
+        # Round-robin over clients: each admission sends that client to the back of the line
+        while self._waiting and self._bulk_room():
+            client, queue = next(iter(self._waiting.items()))
+            ticket = queue.popleft()
+            del self._waiting[client]
+            if queue:
+                self._waiting[client] = queue
+            self._start(ticket)
+        self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            s = dict(self.stats, admitted=dict(zip(CLASS_NAMES, self.stats['admitted'])))
+            s['active'] = dict(zip(CLASS_NAMES, self.active))
+            s['waiting'] = sum(len(q) for q in self._waiting.values())
+            return s
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical concurrent upstream GETs
+- The first request for a key (the leader) goes upstream; requests arriving while it is
+  in flight wait for its result instead of sending their own
+- The result is whatever the leader cached (patched document or asset); None means
+  "not shareable" and every waiter fetches for itself
+- Counts upstream requests saved for the health log
+"""
+import threading
+
+COALESCE_WAIT = 30  # Seconds a waiter gives the leader before fetching on its own
+
+
+class Flight:
+    """One upstream fetch in progress"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, wait=COALESCE_WAIT):
+        self.wait_timeout = wait
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'leaders': 0, 'saved': 0, 'fallbacks': 0}
+
+    def join(self, key):
+        """(flight, True) if the caller must fetch and publish(), (flight, False) if it should wait()"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.stats['leaders'] += 1
+            return flight, True
+
+    def publish(self, key, flight, result):
+        """Leader is done - wake the waiters (idempotent; only the first result counts)"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.done.is_set():
+                return
+            flight.result = result
+        flight.done.set()
+
+    def wait(self, flight):
+        """The leader's result, or None if there is none to share and the caller must fetch itself"""
+        flight.done.wait(self.wait_timeout)
+        result = flight.result
+        with self._lock:
+            self.stats['saved' if result is not None else 'fallbacks'] += 1
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights), sum(f.waiters for f in self._flights.values())
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats)
@@ -6,12 +6,34 @@ Remote Access Proxy for Antigravity v2.1
 """
 import http.server
 import http.client
-import socketserver
 import threading
-import re
 import base64
 import json
 import socket
+import ssl
+import select
+import sys
+import os
+import hashlib
+import time
+from upstream_pool import UpstreamPool, TLS_SESSIONS
+from html_rewriter import HTMLStreamPatcher
+from html_cache import PatchedHTMLCache, PatchedDocument, HTML_CACHE_MAX_BODY, make_etag, etag_matches, is_our_etag
+from asset_cache import AssetCache, ASSET_MAX_BODY
+from connect_relay import EnvelopeRelay, ConnectStreamStats, is_connect_stream
+from zerocopy import can_splice, splice_response
+from single_flight import SingleFlight
+from worker_pool import WorkerPool, PooledMixIn
+from scheduler import PriorityScheduler, request_priority, CLASS_NAMES
+from metrics import Registry, CountingWriter, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from request_timing import SlowRequestLog
+from routing import RoutingTable
+from discovery import find_language_server
+import port_probe
+import zerocopy
+import gravity_log as log
+from compression import (Compressor, choose_encoding, is_compressible, encoded_etag, strip_etag_encoding,
+                         vary_with_encoding)
 
 def get_external_ip():
     try:
@@ -23,146 +45,228 @@ def get_external_ip():
     except:
         return "127.0.0.1"
 
-EXTERNAL_IP = get_external_ip()
 UI_PORT = 8890
 LSP_PORT = 8891
 MOBILE_PORT = 8892  # Mobile-friendly interface
-UI_TARGET = ('127.0.0.1', 9091)
-LSP_TARGET_PORT = 37417
-LSP_USE_HTTPS = True  # Auto-detected based on what the LSP port accepts
-CSRF_TOKEN = None  # Will be extracted from chatParams
+# Where requests go - IDE port, LSP port and scheme (auto-detected), CSRF token, external IP (looked up
+# once the listeners are bound). One immutable, versioned snapshot, swapped whole on every change;
+# each request pins the version it started with
+ROUTING = RoutingTable(ui_target=('127.0.0.1', 9091), lsp_port=37417, lsp_https=True, csrf_token=None,
+                       external_ip='127.0.0.1')
+UPSTREAM_TIMEOUT = 600  # Seconds to wait on upstream reads (long agent streams)
+KEEPALIVE_IDLE_TIMEOUT = 75  # Seconds a browser connection may sit idle between requests
+KEEPALIVE_MAX_REQUESTS = 200  # Requests served on one browser connection before closing it
+KEEPALIVE_BUSY_TIMEOUT = 5  # Idle timeout instead, while connections are queued for a worker
+KEEPALIVE_POLL = 0.5  # Seconds between checks of the worker queue while a connection idles
+TUNNEL_IDLE_TIMEOUT = 300  # Seconds a WebSocket/Upgrade tunnel may carry no traffic before it is closed
+MAX_REQUEST_BODY = 64 * 1024 * 1024  # Larger uploads are refused with 413 (before they are sent, if possible)
+REQUEST_BUFFER_LIMIT = 64 * 1024  # Bodies up to this size are read whole; bigger or chunked ones stream upstream
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
 
-def find_lsp_port():
+# Persistent upstream connections, shared by all listeners
+UPSTREAM_POOL = UpstreamPool()
+
+# Handler threads for all three listeners - bounded, so overload gets a 503 instead of more threads
+WORKER_POOL = WorkerPool(name='proxy')
+
+# Upstream work ordering: interactive LSP RPCs, then LSP streams, then bulk assets (fair per client)
+SCHEDULER = PriorityScheduler()
+
+# Prometheus metrics, served on METRICS_PATH to loopback clients only
+METRICS = Registry()
+METRICS_PATH = '/__gravity/metrics'
+METRICS.counter('gravity_requests_total', 'Requests answered, by route and status')
+METRICS.histogram('gravity_request_duration_seconds', 'Whole request, from parsed headers to last byte written')
+METRICS.histogram('gravity_upstream_connect_seconds', 'TCP (+TLS) connect for new upstream connections')
+METRICS.histogram('gravity_upstream_ttfb_seconds', 'Request sent upstream until its response headers arrived')
+METRICS.counter('gravity_bytes_in_total', 'Request body bytes received from browsers')
+METRICS.counter('gravity_bytes_out_total', 'Bytes written to browsers (headers and bodies)')
+METRICS.gauge('gravity_connections_active', 'Browser connections currently open')
+METRICS.histogram('gravity_patch_seconds', 'Time spent patching one Agent Tab document')
+METRICS.counter('gravity_port_switches_total', 'Upstream port changes picked up by the health check')
+METRICS.counter('gravity_discovery_events_total', 'Health check runs and what they changed')
+METRICS.counter('gravity_failovers_total', 'Upstream outages (refused/reset connects) that triggered rediscovery')
+METRICS.histogram('gravity_failover_seconds', 'Outage window: first failed connect to first answer after rediscovery')
+METRICS.counter('gravity_failover_requests_total', 'Requests that hit a dead upstream, by outcome')
+
+# Phase-by-phase timing for a sample of requests; slow ones go to a JSON-lines file
+SLOW_LOG = SlowRequestLog()
+
+
+def route_name(port, is_lsp_request):
+    """Route label for metrics: ui, mobile or lsp"""
+    if is_lsp_request or port == LSP_PORT:
+        return 'lsp'
+    return 'mobile' if port == MOBILE_PORT else 'ui'
+
+
+@METRICS.collector
+def collect_subsystems():
+    """Gauges and totals the subsystems already keep, read at scrape time"""
+    yield 'gravity_threads', (), threading.active_count()
+    pool = WORKER_POOL.snapshot()
+    for key in ('size', 'busy', 'detached', 'queued', 'peak_busy', 'peak_queued'):
+        yield 'gravity_worker_pool', (('state', key),), pool[key]
+    yield 'gravity_worker_pool_served_total', (), pool['served']
+    yield 'gravity_worker_pool_shed_total', (), pool['shed']
+    sched = SCHEDULER.snapshot()
+    for name in CLASS_NAMES:
+        yield 'gravity_scheduler_active', (('class', name),), sched['active'][name]
+        yield 'gravity_scheduler_admitted_total', (('class', name),), sched['admitted'][name]
+    yield 'gravity_scheduler_waiting', (), sched['waiting']
+    yield 'gravity_scheduler_wait_seconds_total', (), sched['wait_total']
+    yield 'gravity_upstream_pool_idle', (), UPSTREAM_POOL.idle_count()
+    for key, value in UPSTREAM_POOL.stats.items():
+        yield 'gravity_upstream_pool_total', (('event', key),), value
+    tls = TLS_SESSIONS.stats()
+    yield 'gravity_tls_handshakes_total', (), tls['handshakes']
+    yield 'gravity_tls_resumed_total', (), tls['resumed']
+    with TUNNEL_STATS_LOCK:
+        tunnels = dict(TUNNEL_STATS)
+    yield 'gravity_tunnels_active', (), tunnels['active']
+    yield 'gravity_tunnels_opened_total', (), tunnels['opened']
+    yield 'gravity_tunnel_bytes_total', (('direction', 'up'),), tunnels['bytes_up']
+    yield 'gravity_tunnel_bytes_total', (('direction', 'down'),), tunnels['bytes_down']
+    for cache, stats in (('html', HTML_CACHE.stats), ('asset', ASSET_CACHE.stats)):
+        for key, value in dict(stats).items():
+            yield 'gravity_cache_events_total', (('cache', cache), ('event', key)), value
+    gz = COMPRESSION.summary()
+    for key in ('responses', 'bytes_in', 'bytes_out', 'cpu_seconds', 'cache_hits', 'skipped'):
+        yield 'gravity_compression_total', (('stat', key),), gz[key]
+    connect, _ = CONNECT_STATS.snapshot()
+    for key in ('streams', 'messages', 'bytes', 'unframed'):
+        yield 'gravity_connect_streams_total', (('stat', key),), connect[key]
+    with zerocopy.STATS_LOCK:
+        spliced = dict(zerocopy.STATS)
+    for key, value in spliced.items():
+        yield 'gravity_splice_total', (('stat', key),), value
+    for key, value in FLIGHTS.summary().items():
+        yield 'gravity_coalesce_total', (('stat', key),), value
+    yield 'gravity_requests_timed_total', (), SLOW_LOG.stats['sampled']
+    yield 'gravity_slow_requests_total', (), SLOW_LOG.stats['slow']
+    for key, value in dict(log.LOG.stats).items():
+        yield 'gravity_log_lines_total', (('event', key),), value
+    if FIRST_SERVED is not None:
+        yield 'gravity_startup_first_request_seconds', (), FIRST_SERVED
+    yield 'gravity_routing_version', (), ROUTING.current.version
+    for version, counts in ROUTING.snapshot().items():
+        yield 'gravity_routing_requests_total', (('version', str(version)),), counts['requests']
+        yield 'gravity_routing_in_flight', (('version', str(version)),), counts['in_flight']
+
+
+for _name, _help in (('gravity_threads', 'Live threads in the proxy process'),
+                     ('gravity_worker_pool', 'Handler pool size, occupancy and queue depth'),
+                     ('gravity_scheduler_active', 'Upstream exchanges in progress per priority class'),
+                     ('gravity_scheduler_waiting', 'Bulk fetches waiting for a slot'),
+                     ('gravity_upstream_pool_idle', 'Idle pooled upstream connections'),
+                     ('gravity_tunnels_active', 'Open WebSocket / Upgrade tunnels'),
+                     ('gravity_startup_first_request_seconds', 'Process start until the first request was answered'),
+                     ('gravity_routing_version', 'Current routing table version'),
+                     ('gravity_routing_in_flight', 'Requests still pinned to each recent routing version')):
+    METRICS.gauge(_name, _help)
+for _name, _help in (('gravity_worker_pool_served_total', 'Connections served by the handler pool'),
+                     ('gravity_worker_pool_shed_total', 'Connections turned away with 503'),
+                     ('gravity_scheduler_admitted_total', 'Requests admitted per priority class'),
+                     ('gravity_scheduler_wait_seconds_total', 'Time bulk fetches spent waiting for a slot'),
+                     ('gravity_upstream_pool_total', 'Upstream connection pool events'),
+                     ('gravity_tls_handshakes_total', 'TLS handshakes with the language_server'),
+                     ('gravity_tls_resumed_total', 'TLS handshakes that resumed a session'),
+                     ('gravity_tunnels_opened_total', 'WebSocket / Upgrade tunnels opened'),
+                     ('gravity_tunnel_bytes_total', 'Bytes relayed through tunnels'),
+                     ('gravity_cache_events_total', 'Patched-HTML and asset cache events'),
+                     ('gravity_compression_total', 'Downstream compression totals'),
+                     ('gravity_connect_streams_total', 'Connect / gRPC-web stream relay totals'),
+                     ('gravity_splice_total', 'Zero-copy splice relay totals'),
+                     ('gravity_coalesce_total', 'Single-flight coalescing of identical GETs'),
+                     ('gravity_requests_timed_total', 'Requests sampled for a phase breakdown'),
+                     ('gravity_slow_requests_total', 'Sampled requests written to the slow log'),
+                     ('gravity_log_lines_total', 'Log lines written, dropped (queue full) and folded as repeats'),
+                     ('gravity_routing_requests_total', 'Requests served per routing version')):
+    METRICS.counter(_name, _help)
+
+# WebSocket / Upgrade tunnels (byte counters are totals across all tunnels)
+TUNNEL_STATS = {'opened': 0, 'active': 0, 'bytes_up': 0, 'bytes_down': 0}
+TUNNEL_STATS_LOCK = threading.Lock()
+
+# Connect / gRPC-web streams from the language_server (messages, bytes, inter-message gaps)
+CONNECT_STATS = ConnectStreamStats()
+
+# Patched Agent Tab documents - rebuilt only when the upstream document or routing changes
+HTML_CACHE = PatchedHTMLCache()
+
+# gzip/brotli towards the browser (LSP traffic is never compressed - latency matters more there)
+COMPRESSION = Compressor()
+
+# JS/CSS/fonts/images from the Agent Tab - memory + disk, purged when the IDE build changes
+ASSET_CACHE = AssetCache()
+
+# Concurrent identical Agent Tab GETs share one upstream fetch (reconnect storms, IDE restarts)
+FLIGHTS = SingleFlight()
+
+# Routing refreshes: every 10s from the health check, and at once when an upstream refuses us
+ROUTING_LOCK = threading.Lock()
+ROUTING_REFRESHED = 0.0  # time.monotonic() of the last refresh
+REDISCOVERY = SingleFlight()
+REDISCOVER_DEBOUNCE = 1.0  # Seconds - failing requests trigger at most one refresh per second
+FAILOVER_DEADLINE = 5.0  # Seconds a request rides out an IDE restart before the browser gets 502
+FAILOVER_RETRY_INTERVAL = 0.25  # Pause between retries while the upstream is still coming back
+FAILOVER_WINDOWS = {}  # 'ui' / 'lsp' -> time.monotonic() of the first failure of the current outage
+FAILOVER_LOCK = threading.Lock()
+
+# Startup: listeners bind first and serve from the routing the last run saved; it is re-checked in the background
+ROUTING_STATE_PATH = os.path.expanduser('~/.cache/gravityremote/routing.json')
+STARTED = time.monotonic()
+FIRST_SERVED = None  # Seconds from start to the first answered request
+
+def find_lsp_target(server=None):
+    """(port, https) of the language_server - every port and both protocols are probed at once
+    (port_probe), preferring the first HTTP-responding port of the workspace server"""
+    server = server or find_language_server()
+    ports = server.ports if server is not None and server.ports else [37417]
+    return port_probe.find_lsp_target(ports) or (ports[0], True)  # Nothing answered: first port, HTTPS
+
+
+def find_lsp_port(server=None):
     """Find LSP port - prefer the language_server with workspace_id, select HTTP-responding port"""
-    import subprocess
-    try:
-        # First, find the PID of the workspace language_server
-        ps_result = subprocess.run(['ps', 'aux'], capture_output=True, text=True)
-        workspace_pid = None
-        fallback_pid = None
-        for line in ps_result.stdout.split('\n'):
-            if 'language_server' in line and 'csrf_token' in line:
-                pid_match = re.search(r'\s+(\d+)\s+', line)
-                if pid_match:
-                    pid = pid_match.group(1)
-                    if 'workspace_id' in line:
-                        workspace_pid = pid
-                    elif not fallback_pid:
-                        fallback_pid = pid
-        
-        target_pid = workspace_pid or fallback_pid
-        if not target_pid:
-            return 37417
-        
-        # Find ALL ports for that PID
-        ss_result = subprocess.run(['ss', '-tunlp'], capture_output=True, text=True)
-        candidate_ports = []
-        for line in ss_result.stdout.split('\n'):
-            if f'pid={target_pid}' in line:
-                match = re.search(r'127\.0\.0\.1:(\d+)', line)
-                if match:
-                    candidate_ports.append(int(match.group(1)))
-        
-        # Test each port - prefer one that responds to HTTP with 400/404 (not connection error)
-        for port in candidate_ports:
-            try:
-                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
-                conn.request('GET', '/')
-                resp = conn.getresponse()
-                conn.close()
-                # Any HTTP response means this port works for HTTP
-                if resp.status in [400, 404, 200]:
-                    return port
-            except:
-                pass
-        
-        # Return first port if none responded to HTTP
-        if candidate_ports:
-            return candidate_ports[0]
-    except:
-        pass
-    return 37417
+    return find_lsp_target(server)[0]
+
 
+def find_csrf_token(server=None):
+    """CSRF token from the language_server command line - prefer workspace server"""
+    server = server or find_language_server()
+    return server.csrf_token if server else None
 
-def find_csrf_token():
-    """Extract CSRF token from language_server command line - prefer workspace server"""
-    import subprocess
+def find_ide_build(server=None):
+    """Fingerprint of the installed IDE build - language_server binary path, size and mtime"""
+    server = server or find_language_server()
+    if server is None:
+        return None
     try:
-        result = subprocess.run(['ps', 'aux'], capture_output=True, text=True)
-        workspace_token = None
-        fallback_token = None
-        for line in result.stdout.split('\n'):
-            if 'language_server' in line and 'csrf_token' in line:
-                match = re.search(r'csrf_token\s+([a-f0-9-]+)', line)
-                if match:
-                    token = match.group(1)
-                    # Prefer the one with workspace_id (active workspace server)
-                    if 'workspace_id' in line:
-                        workspace_token = token
-                    elif not fallback_token:
-                        fallback_token = token
-        return workspace_token or fallback_token
-    except:
-        pass
-    return None
+        st = os.stat(server.exe)
+        return f'{server.exe}:{st.st_size}:{int(st.st_mtime)}'
+    except OSError:
+        return None
 
 def probe_lsp_protocol(port):
-    """Probe LSP port to determine if it uses HTTP or HTTPS"""
-    import ssl
-    # Try HTTP first (simpler and more common for newer servers)
-    try:
-        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
-        conn.request('GET', '/')
-        resp = conn.getresponse()
-        body = resp.read().decode('utf-8', errors='ignore')
-        conn.close()
-        # Check if server says it needs HTTPS
-        if 'HTTP request to an HTTPS server' in body:
-            return True  # Server says it needs HTTPS
-        return False  # HTTP works
-    except:
-        pass
-    
-    # Try HTTPS
-    try:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        conn = http.client.HTTPSConnection('127.0.0.1', port, timeout=2, context=context)
-        conn.request('GET', '/')
-        resp = conn.getresponse()
-        conn.close()
-        return True  # HTTPS works
-    except:
-        pass
-    
-    return True  # Default to HTTPS if can't determine
+    """Probe LSP port to determine if it uses HTTP or HTTPS (HTTPS if it can't be determined)"""
+    target = port_probe.find_lsp_target([port])
+    return target[1] if target else True
 
 
 def find_active_ide_port():
     """Auto-detect the active Antigravity IDE UI port (prefer newest = highest port)"""
-    for port in [9092, 9091, 9090]:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(0.5)
-            result = s.connect_ex(('127.0.0.1', port))
-            s.close()
-            if result == 0:
-                return port
-        except:
-            pass
-    return 9090  # fallback
+    return port_probe.find_ide_port([9092, 9091, 9090]) or 9090  # fallback
 
-def health_check_loop():
-    """Background thread - checks IDE port and CSRF token every 10s, auto-updates if changed"""
-    global UI_TARGET, LSP_TARGET_PORT, CSRF_TOKEN, LSP_USE_HTTPS
-    import time
-    
-    while True:
-        time.sleep(10)
+def refresh_routing(reason='health_check'):
+    """Re-check the IDE port, language_server port/protocol, CSRF token and build - True if routing changed"""
+    global ROUTING_REFRESHED
+    with ROUTING_LOCK:
+        METRICS.inc('gravity_discovery_events_total', (('event', reason),))
+        current = ROUTING.current
+        changes = {}
         
         # Check if current UI port is still active
-        current_ui_port = UI_TARGET[1]
+        current_ui_port = current.ui_target[1]
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.settimeout(1)
@@ -172,141 +276,380 @@ def health_check_loop():
                 # Port failed - find new one
                 new_port = find_active_ide_port()
                 if new_port != current_ui_port:
-                    print(f"[HEALTH] IDE port switch: {current_ui_port} -> {new_port}")
-                    UI_TARGET = ('127.0.0.1', new_port)
+                    log.info(f"[HEALTH] IDE port switch: {current_ui_port} -> {new_port}")
+                    METRICS.inc('gravity_port_switches_total', (('target', 'ui'),))
+                    changes['ui_target'] = ('127.0.0.1', new_port)
         except:
             pass
         
-        # Refresh LSP port and protocol
-        new_lsp = find_lsp_port()
-        if new_lsp != LSP_TARGET_PORT:
-            print(f"[HEALTH] LSP port switch: {LSP_TARGET_PORT} -> {new_lsp}")
-            LSP_TARGET_PORT = new_lsp
-            # Re-probe protocol for new port
-            new_https = probe_lsp_protocol(new_lsp)
-            if new_https != LSP_USE_HTTPS:
-                print(f"[HEALTH] LSP protocol: {'HTTPS' if LSP_USE_HTTPS else 'HTTP'} -> {'HTTPS' if new_https else 'HTTP'}")
-                LSP_USE_HTTPS = new_https
+        # Refresh LSP port and protocol (one /proc pass finds the server, its ports and token;
+        # all its ports are probed over HTTP and HTTPS together)
+        server = find_language_server()
+        new_lsp, new_https = find_lsp_target(server)
+        if new_lsp != current.lsp_port:
+            log.info(f"[HEALTH] LSP port switch: {current.lsp_port} -> {new_lsp}")
+            METRICS.inc('gravity_port_switches_total', (('target', 'lsp'),))
+            changes['lsp_port'] = new_lsp
+            if new_https != current.lsp_https:
+                log.info(f"[HEALTH] LSP protocol: {'HTTPS' if current.lsp_https else 'HTTP'} -> {'HTTPS' if new_https else 'HTTP'}")
+                METRICS.inc('gravity_discovery_events_total', (('event', 'protocol_change'),))
+                changes['lsp_https'] = new_https
         
         # Refresh CSRF token
-        new_token = find_csrf_token()
-        if new_token and new_token != CSRF_TOKEN:
-            print(f"[HEALTH] CSRF token updated: {new_token[:16]}...")
-            CSRF_TOKEN = new_token
+        new_token = find_csrf_token(server)
+        if new_token and new_token != current.csrf_token:
+            log.info(f"[HEALTH] CSRF token updated: {new_token[:16]}...")
+            METRICS.inc('gravity_discovery_events_total', (('event', 'csrf_token_change'),))
+            changes['csrf_token'] = new_token
+        
+        # Everything changes at once - requests pinned to the old version finish against it
+        changed = switch_routing(**changes)
+        
+        # An IDE update invalidates every cached asset
+        if ASSET_CACHE.set_build(find_ide_build(server)):
+            log.info("[HEALTH] IDE build changed - asset cache purged")
+            METRICS.inc('gravity_discovery_events_total', (('event', 'build_change'),))
+        
+        ROUTING_REFRESHED = time.monotonic()
+        return changed
 
-class ProxyHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self): self.proxy_request('GET')
-    def do_POST(self): self.proxy_request('POST')
-    def do_HEAD(self): self.proxy_request('HEAD')
-    def do_PUT(self): self.proxy_request('PUT')
-    def do_DELETE(self): self.proxy_request('DELETE')
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', '*')
-        self.send_header('Access-Control-Allow-Credentials', 'true')
-        self.end_headers()
-    
-    def log_message(self, format, *args):
-        print(f"[REQ] {self.client_address[0]} - {format % args}")
+
+def switch_routing(**changes):
+    """Publish a new routing version - idle connections to targets it left are closed (busy ones drain)
+    and the new routing is saved for the next start. True if anything changed"""
+    old, new = ROUTING.update(**changes)
+    if new is old:
+        return False
+    if new.ui_target != old.ui_target:
+        UPSTREAM_POOL.flush(port=old.ui_target[1])
+    if new.lsp_port != old.lsp_port:
+        UPSTREAM_POOL.flush(port=old.lsp_port)
+        TLS_SESSIONS.forget(port=old.lsp_port)
+    if (new.ui_target, new.lsp_port, new.external_ip) != (old.ui_target, old.lsp_port, old.external_ip):
+        HTML_CACHE.clear()
+    log.info(f"[ROUTING] v{old.version} -> v{new.version} ({ROUTING.in_flight(old.version)} requests "
+             f"still in flight on v{old.version})")
+    save_routing()
+    return True
+
+
+def save_routing(path=None):
+    """Write the current routing to disk for the next start (owner-only - it holds the CSRF token)"""
+    path = path or ROUTING_STATE_PATH
+    route = ROUTING.current
+    state = {'ui_port': route.ui_target[1], 'lsp_port': route.lsp_port, 'lsp_https': route.lsp_https,
+             'csrf_token': route.csrf_token, 'external_ip': route.external_ip, 'saved': int(time.time())}
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"[STARTUP] Cannot save routing to {path}: {e}")
+
+
+def load_routing(path=None):
+    """Adopt the routing the last run saved - False if there is none or it is unreadable"""
+    path = path or ROUTING_STATE_PATH
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        ui_port, lsp_port = int(state['ui_port']), int(state['lsp_port'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    ROUTING.update(ui_target=('127.0.0.1', ui_port), lsp_port=lsp_port,
+                   lsp_https=bool(state.get('lsp_https', True)), csrf_token=state.get('csrf_token') or None,
+                   external_ip=state.get('external_ip') or ROUTING.current.external_ip)
+    return True
+
+
+def start_routing(warm):
+    """Called once the listeners are bound - re-check saved routing in the background (warm start)
+    or detect it now (cold start: clients wait in the accept backlog instead of being refused)"""
+    if warm:
+        threading.Thread(target=startup_refresh, name='startup-refresh', daemon=True).start()
+    else:
+        ROUTING.update(external_ip=get_external_ip())
+        autodetect()
+        save_routing()
+    log.info(f"[STARTUP] Serving {(time.monotonic() - STARTED) * 1000:.0f}ms after start "
+             f"({'last known routing, re-checking' if warm else 'routing detected'})")
+
+
+def startup_refresh():
+    """Validate the routing a warm start is serving from"""
+    started = time.monotonic()
+    ip = get_external_ip()
+    moved = ip != ROUTING.current.external_ip
+    if moved:
+        log.info(f"[STARTUP] External IP changed: {ROUTING.current.external_ip} -> {ip}")
+        switch_routing(external_ip=ip)
+    changed = refresh_routing('startup')
+    log.info(f"[STARTUP] Saved routing {'updated' if changed or moved else 'confirmed'} "
+             f"in {(time.monotonic() - started) * 1000:.0f}ms")
+
+
+def first_request_served():
+    """Record (once) how long after start the first request was answered"""
+    global FIRST_SERVED
+    if FIRST_SERVED is None:
+        FIRST_SERVED = time.monotonic() - STARTED
+        log.info(f"[STARTUP] First request served {FIRST_SERVED * 1000:.0f}ms after start")
+
+
+def rediscover():
+    """Refresh routing right away (an upstream refused or reset us) - callers at the same time share one
+    refresh, and none runs if routing was refreshed less than REDISCOVER_DEBOUNCE seconds ago"""
+    flight, leader = REDISCOVERY.join('routing')
+    if not leader:
+        REDISCOVERY.wait(flight)
+        return
+    try:
+        if time.monotonic() - ROUTING_REFRESHED >= REDISCOVER_DEBOUNCE:
+            refresh_routing('upstream_failure')
+    finally:
+        REDISCOVERY.publish('routing', flight, True)
+
+
+def failover_retry(kind, target, error, method, replayable, deadline):
+    """After a refused/reset upstream connect: the deadline to keep retrying until, or None to give up
+    - the outage window only opens once a retry (and so a rediscovery) will really happen"""
+    now = time.monotonic()
+    # Refused: nothing was sent, so any request can go again. Reset: only if it is safe to repeat
+    retry = isinstance(error, ConnectionRefusedError) or (method in IDEMPOTENT_METHODS and replayable)
+    if not retry or (deadline is not None and now >= deadline):
+        if deadline is not None:
+            METRICS.inc('gravity_failover_requests_total', (('outcome', 'failed'),))
+        return None
+    if deadline is None:
+        deadline = now + FAILOVER_DEADLINE
+        failover_started(kind, target)
+    return deadline
+
+
+def failover_started(kind, target):
+    """First refused/reset connect to this upstream ('ui' or 'lsp') opens an outage window"""
+    with FAILOVER_LOCK:
+        if kind in FAILOVER_WINDOWS:
+            return
+        FAILOVER_WINDOWS[kind] = time.monotonic()
+    METRICS.inc('gravity_failovers_total', (('upstream', kind),))
+    log.warning(f"[FAILOVER] {kind} upstream {target[0]}:{target[1]} unreachable - rediscovering")
+
+
+def failover_ended(kind, target):
+    """First answer from this upstream after an outage closes its window"""
+    if kind not in FAILOVER_WINDOWS:
+        return
+    with FAILOVER_LOCK:
+        started = FAILOVER_WINDOWS.pop(kind, None)
+    if started is not None:
+        window = time.monotonic() - started
+        METRICS.observe('gravity_failover_seconds', window, (('upstream', kind),))
+        log.info(f"[FAILOVER] {kind} upstream back on {target[0]}:{target[1]} after {window:.2f}s")
+
+
+def health_check_loop():
+    """Background thread - checks IDE port and CSRF token every 10s, auto-updates if changed"""
+    last_tls_handshakes = 0
+    last_compressed = 0
+    last_saved = 0
+    last_shed = 0
     
-    def proxy_request(self, method):
-        global LSP_TARGET_PORT, CSRF_TOKEN
-        port = self.server.server_address[1]
+    while True:
+        time.sleep(10)
+        refresh_routing()
         
-        try:
-            # LSP requests can come on any port - detect by path
-            is_lsp_request = self.path.startswith('/exa.')
-            
-            if is_lsp_request:
-                # Route to LSP backend
-                target_host, target_port = '127.0.0.1', LSP_TARGET_PORT
-            elif port in (UI_PORT, MOBILE_PORT):
-                target_host, target_port = UI_TARGET
-            else:
-                target_host, target_port = '127.0.0.1', LSP_TARGET_PORT
-            
-            # Read request body
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else None
-            
-            # Forward headers
-            headers = {}
-            for k, v in self.headers.items():
-                if k.lower() not in ['host', 'accept-encoding']:
-                    headers[k] = v
-            headers['Host'] = f'{target_host}:{target_port}'
-            
-            # Inject CSRF token for LSP requests
-            if is_lsp_request and CSRF_TOKEN:
-                headers['x-codeium-csrf-token'] = CSRF_TOKEN
-            
-            # LSP backend may use HTTP or HTTPS depending on version
-            if is_lsp_request:
-                if LSP_USE_HTTPS:
-                    import ssl
-                    context = ssl.create_default_context()
-                    context.check_hostname = False
-                    context.verify_mode = ssl.CERT_NONE
-                    conn = http.client.HTTPSConnection(target_host, target_port, timeout=600, context=context)
-                else:
-                    conn = http.client.HTTPConnection(target_host, target_port, timeout=600)
-            else:
-                conn = http.client.HTTPConnection(target_host, target_port, timeout=600)
-            # Enable TCP keepalive to prevent idle disconnects
-            conn.sock = None  # Will be set on connect
-            conn.request(method, self.path, body, headers)
-            response = conn.getresponse()
-            
-            # For LSP requests: Stream response immediately for lower latency
-            # This applies to all ports since mobile sends LSP requests on 8892
-            if is_lsp_request:
-                self.send_response(response.status)
-                for k, v in response.getheaders():
-                    if k.lower() not in ['transfer-encoding', 'connection']:
-                        self.send_header(k, v)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Credentials', 'true')
-                self.end_headers()
-                
-                # Stream chunks immediately
-                while True:
-                    chunk = response.read(4096)
-                    if not chunk:
-                        break
-                    self.wfile.write(chunk)
-                    self.wfile.flush()
-            else:
-                # For UI/Mobile: Buffer for HTML patching
-                response_body = response.read()
-                
-                if port in (UI_PORT, MOBILE_PORT) and 'text/html' in response.getheader('Content-Type', ''):
-                    is_mobile = (port == MOBILE_PORT)
-                    response_body = self.patch_html(response_body, mobile=is_mobile, incoming_port=port)
-                
-                self.send_response(response.status)
-                for k, v in response.getheaders():
-                    if k.lower() not in ['content-length', 'transfer-encoding', 'content-encoding', 'connection']:
-                        self.send_header(k, v)
-                self.send_header('Content-Length', len(response_body))
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Credentials', 'true')
-                self.end_headers()
-                self.wfile.write(response_body)
-            
-            conn.close()
-        except Exception as e:
-            print(f"[ERROR] {e}")
-            self.send_error(502, str(e))
-    
-    def patch_html(self, body, mobile=False, incoming_port=None):
-        """Patch Base64-encoded chatParams for remote access"""
-        global LSP_TARGET_PORT, CSRF_TOKEN
+        # Drop pooled upstream connections that went idle or were closed by the IDE
+        UPSTREAM_POOL.evict_idle()
+        
+        # Report TLS session resumption for the HTTPS language_server hop
+        tls = TLS_SESSIONS.stats()
+        if tls['handshakes'] != last_tls_handshakes:
+            last_tls_handshakes = tls['handshakes']
+            log.info(f"[TLS] {tls['resumed']}/{tls['handshakes']} handshakes resumed ({tls['hit_rate']:.0%})")
+        
+        # Report downstream compression savings and what they cost
+        gz = COMPRESSION.summary()
+        if gz['responses'] != last_compressed:
+            last_compressed = gz['responses']
+            log.info(f"[COMPRESS] {gz['responses']} responses: {gz['bytes_in'] / 1e6:.1f} MB -> "
+                  f"{gz['bytes_out'] / 1e6:.1f} MB ({gz['ratio']:.0%}), {gz['cpu_seconds']:.2f}s CPU, "
+                  f"{gz['cache_hits']} from cache, {gz['skipped']} skipped")
+        
+        # Report upstream fetches avoided by coalescing identical concurrent GETs
+        flights = FLIGHTS.summary()
+        if flights['saved'] != last_saved:
+            last_saved = flights['saved']
+            log.info(f"[COALESCE] {flights['saved']} upstream requests saved across {flights['leaders']} fetches, "
+                  f"{flights['fallbacks']} waiters fetched themselves")
         
-        # Mobile CSS injection for better touch experience
-        if mobile:
-            mobile_css = b'''<style>
+        # Report worker pool pressure (only once something had to be turned away)
+        pool = WORKER_POOL.snapshot()
+        if pool['shed'] != last_shed:
+            last_shed = pool['shed']
+            log.info(f"[POOL] {pool['busy']}/{pool['size']} workers busy, {pool['queued']} queued "
+                  f"(peak {pool['peak_busy']} busy, {pool['peak_queued']} queued), {pool['shed']} shed with 503")
+
+def route_request(path, listen_port, route=None):
+    """Pick the upstream for a request: (host, port, is_lsp_request) - from the pinned route, else the current"""
+    route = route or ROUTING.current
+    # LSP requests can come on any port - detect by path
+    if path.startswith('/exa.'):
+        return '127.0.0.1', route.lsp_port, True
+    if listen_port in (UI_PORT, MOBILE_PORT):
+        return route.ui_target[0], route.ui_target[1], False
+    return '127.0.0.1', route.lsp_port, False
+
+
+def is_upgrade_request(items):
+    """True for WebSocket (or other HTTP Upgrade) handshakes"""
+    upgrade = connection = ''
+    for k, v in items:
+        if k.lower() == 'upgrade':
+            upgrade = v
+        elif k.lower() == 'connection':
+            connection = v
+    return bool(upgrade) and 'upgrade' in [t.strip().lower() for t in connection.split(',')]
+
+
+def forward_headers(items, target_host, target_port, is_lsp_request, upgrade=False, route=None):
+    """Build upstream request headers from the browser's (hop-by-hop ones would break upstream keep-alive)"""
+    headers = {}
+    for k, v in items:
+        if k.lower() not in ['host', 'accept-encoding', 'connection', 'keep-alive', 'proxy-connection',
+                             'transfer-encoding', 'expect']:
+            if k.lower() == 'if-none-match':
+                v = strip_etag_encoding(v)  # Upstream only knows the identity representation
+            headers[k] = v
+    headers['Host'] = f'{target_host}:{target_port}'
+    if upgrade:
+        headers['Connection'] = 'Upgrade'
+    
+    # Inject CSRF token for LSP requests
+    token = (route or ROUTING.current).csrf_token
+    if is_lsp_request and token:
+        headers['x-codeium-csrf-token'] = token
+    return headers
+
+
+def relay_sockets(client, upstream, idle_timeout=TUNNEL_IDLE_TIMEOUT):
+    """Copy bytes both ways until either side closes or the tunnel idles out - returns (bytes_up, bytes_down)"""
+    peers = {client: upstream, upstream: client}
+    counts = {client: 0, upstream: 0}  # bytes received from each side
+    last_activity = time.monotonic()
+    while True:
+        readable, _, _ = select.select(list(peers), [], [], 5)
+        if not readable:
+            if time.monotonic() - last_activity > idle_timeout:
+                break
+            continue
+        closed = False
+        for sock in readable:
+            try:
+                data = sock.recv(65536)
+                # TLS may hold more decrypted bytes than select can see
+                while isinstance(sock, ssl.SSLSocket) and sock.pending():
+                    data += sock.recv(sock.pending())
+            except ssl.SSLWantReadError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                closed = True
+                break
+            try:
+                peers[sock].sendall(data)
+            except OSError:
+                closed = True  # The other side reset the tunnel
+                break
+            counts[sock] += len(data)
+        if closed:
+            break
+        last_activity = time.monotonic()
+    return counts[client], counts[upstream]
+
+
+def read_response_head(sock, limit=65536):
+    """Read an HTTP response head from a raw socket - returns (head_bytes, status, headers, leftover)"""
+    buf = b''
+    while b'\r\n\r\n' not in buf:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionResetError('upstream closed during handshake')
+        buf += data
+        if len(buf) > limit:
+            raise ValueError('upstream response head too large')
+    head, leftover = buf.split(b'\r\n\r\n', 1)
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        k, _, v = line.partition(':')
+        headers[k.strip().lower()] = v.strip()
+    return head + b'\r\n\r\n', status, headers, leftover
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+class RequestBodyError(Exception):
+    """The browser's request body broke off or was malformed - a client fault, not an upstream outage"""
+
+
+class RequestBodyReader:
+    """Browser request body read from rfile piece by piece - Content-Length or chunked framing"""
+    
+    def __init__(self, rfile, length=None, limit=None, size=65536):
+        self.rfile = rfile
+        self.length = length  # None = chunked
+        self.limit = MAX_REQUEST_BODY if limit is None else limit
+        self.size = size
+        self.received = 0
+        self.done = False
+    
+    def __iter__(self):
+        pieces = self._chunked() if self.length is None else self._sized(self.length)
+        for piece in pieces:
+            self.received += len(piece)
+            if self.received > self.limit:
+                raise RequestBodyTooLarge(f'Request body over {self.limit} bytes')
+            yield piece
+        self.done = True
+    
+    def read_all(self):
+        return b''.join(self)
+    
+    def _sized(self, remaining):
+        while remaining > 0:
+            piece = self.rfile.read1(min(self.size, remaining))
+            if not piece:
+                raise RequestBodyError('browser closed inside request body')
+            remaining -= len(piece)
+            yield piece
+    
+    def _chunked(self):
+        while True:
+            line = self.rfile.readline(1024)
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise RequestBodyError('bad or truncated chunk header') from None
+            if size == 0:
+                # Skip trailers up to the blank line
+                while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            yield from self._sized(size)
+            self.rfile.readline(1024)  # CRLF closing the chunk
+
+
+# Mobile CSS injection for better touch experience
+MOBILE_CSS = b'''<style>
 /* Mobile-friendly adjustments */
 html, body { touch-action: manipulation; }
 * { -webkit-tap-highlight-color: transparent; }
@@ -341,14 +684,10 @@ button, input, textarea, [role="button"] {
 /* Viewport meta */
 </style>
 <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-'''  
-            if b'<head>' in body:
-                body = body.replace(b'<head>', b'<head>' + mobile_css)
-            elif b'<body' in body:
-                body = body.replace(b'<body', mobile_css + b'<body')
-        
-        # Inject crypto.randomUUID polyfill for non-HTTPS contexts
-        polyfill = b'''<script>
+'''
+
+# crypto.randomUUID polyfill for non-HTTPS contexts
+CRYPTO_POLYFILL = b'''<script>
 if (typeof crypto.randomUUID !== 'function') {
   crypto.randomUUID = function() {
     return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
@@ -358,45 +697,876 @@ if (typeof crypto.randomUUID !== 'function') {
   };
 }
 </script>'''
-        # Inject polyfill right after <head> or at start of <body>
-        if b'<head>' in body:
-            body = body.replace(b'<head>', b'<head>' + polyfill)
-        elif b'<body' in body:
-            body = body.replace(b'<body', polyfill + b'<body')
+
+
+def patch_chat_params(old_b64, incoming_port=None, route=None):
+    """Point the base64 chatParams at our proxy - returns the re-encoded base64"""
+    params = json.loads(base64.b64decode(old_b64))
+    
+    # Note: We no longer extract the port from chatParams URL as it may be stale
+    # or point to the remapped proxy. find_lsp_port() gives us the real port.
+    
+    # Note: We no longer extract CSRF token from chatParams as it may be stale
+    # after IDE restart. find_csrf_token() at startup gives us the real token.
+    
+    # Update URLs to point to our proxy
+    # For mobile: use same port (8892) to avoid CORS issues
+    # For desktop: use dedicated LSP port (8891)
+    route = route or ROUTING.current
+    lsp_port_to_use = incoming_port if incoming_port == MOBILE_PORT else LSP_PORT
+    new_url = f'http://{route.external_ip}:{lsp_port_to_use}/'
+    params['languageServerUrl'] = new_url
+    params['httpLanguageServerUrl'] = new_url
+    
+    log.info(f"[PATCH] LSP: 127.0.0.1:{route.lsp_port} -> {route.external_ip}:{LSP_PORT}")
+    return base64.b64encode(json.dumps(params).encode())
+
+
+def html_patcher(mobile=False, incoming_port=None, route=None):
+    """Streaming patcher for the Agent Tab: polyfill (+ mobile CSS) after <head>, chatParams rewritten"""
+    markup = CRYPTO_POLYFILL + (MOBILE_CSS if mobile else b'')
+    return HTMLStreamPatcher(markup, lambda old_b64: patch_chat_params(old_b64, incoming_port, route))
+
+
+def patch_html(body, mobile=False, incoming_port=None, route=None):
+    """Patch Base64-encoded chatParams for remote access"""
+    patcher = html_patcher(mobile=mobile, incoming_port=incoming_port, route=route)
+    return patcher.feed(body) + patcher.close()
+
+
+# Editing the injected markup must change every ETag we hand out
+PATCH_FINGERPRINT = hashlib.sha1(CRYPTO_POLYFILL + MOBILE_CSS).hexdigest()[:12]
+
+# Upstream headers not replayed with a cached document (framing, our own validator, per-response)
+HTML_REPLAY_SKIP = ('content-length', 'transfer-encoding', 'content-encoding', 'connection', 'keep-alive',
+                    'etag', 'date', 'server')
+
+
+def response_encoding(accept_encoding, response, length=None):
+    """Content-Encoding to apply to this response for this browser, or None"""
+    if response.status != 200 or response.getheader('Content-Range'):
+        return None
+    if length is None and response.getheader('Content-Length', '').isdigit():
+        length = int(response.getheader('Content-Length'))
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return None
+    if not is_compressible(response.getheader('Content-Type'), response.getheader('Content-Encoding'), length):
+        COMPRESSION.skipped()
+        return None
+    return encoding
+
+
+def html_routing_key(incoming_port, route=None):
+    """Everything besides the upstream document that the patched output depends on"""
+    route = route or ROUTING.current
+    return (route.ui_target, route.lsp_port, route.external_ip, incoming_port, incoming_port == MOBILE_PORT)
+
+
+def replace_validators(headers, etag=None, last_modified=None):
+    """Send the validators of our stored copy upstream instead of the browser's"""
+    for k in list(headers):
+        if k.lower() in ('if-none-match', 'if-modified-since'):
+            del headers[k]
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def upstream_validators(headers, cached):
+    """Swap the browser's validators (ours) for the ones the cached document was built from"""
+    browser_tag = next((v for k, v in headers.items() if k.lower() == 'if-none-match'), None)
+    if cached is None and not is_our_etag(browser_tag):
+        return headers
+    if cached is None:
+        return replace_validators(headers)
+    return replace_validators(headers, cached.upstream_etag, cached.last_modified)
+
+
+def log_connect_stream(relay):
+    s = relay.summary()
+    if s['passthrough']:
+        log.info(f"[STREAM] {s['path']} unframed, relayed as raw bytes ({s['duration']:.1f}s)")
+        return
+    first = f"{s['first_message'] * 1000:.0f}ms" if s['first_message'] is not None else '-'
+    log.info(f"[STREAM] {s['path']} {s['messages']} msgs, {s['bytes']} B in {s['duration']:.1f}s "
+          f"(first {first}, gap avg {s['gap_avg'] * 1000:.0f}ms max {s['gap_max'] * 1000:.0f}ms)")
+
+
+def iter_response(response, size=65536):
+    """Yield body pieces as soon as they arrive (one read each) and leave the response closed for reuse"""
+    while True:
+        chunk = response.read1(size)
+        if not chunk:
+            break
+        if response.length == 0:
+            response.read()  # Sized body complete - close it now so the connection can be released early
+        yield chunk
+    response.read()  # A fully consumed sized body only marks itself closed on a final read
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps browser connections open between requests (saves an RTT per request on mobile)
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes - don't let Nagle hold the body for a delayed ACK
+    disable_nagle_algorithm = True
+    
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+        self.wfile = CountingWriter(self.wfile)
+        METRICS.inc('gravity_connections_active')
+    
+    def finish(self):
+        METRICS.inc('gravity_connections_active', value=-1)
+        super().finish()
+    
+    def handle_one_request(self):
+        if not self.wait_for_request():
+            self.close_connection = True
+            return
+        self.connection.settimeout(KEEPALIVE_IDLE_TIMEOUT)
+        self.response_started = False
+        self.accept_encoding = None
+        self.body_encoder = None
+        self.flight = None
+        self.status = None
+        self.route = None
+        self.lease = None
+        self.timing = None
+        self.ticket = None
+        super().handle_one_request()
+    
+    def wait_for_request(self):
+        """Wait for the next request on a kept-alive connection, in short slices - False once it idled
+        past KEEPALIVE_IDLE_TIMEOUT, or past KEEPALIVE_BUSY_TIMEOUT while connections are queued for
+        a worker (re-checked every slice, so idle connections give their worker back)"""
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True  # Pipelined request already buffered
+        except OSError:
+            return False
+        started = time.monotonic()
+        while True:
+            try:
+                readable, _, _ = select.select([self.connection], [], [], KEEPALIVE_POLL)
+            except (OSError, ValueError):
+                return False
+            if readable:
+                return True
+            idle = time.monotonic() - started
+            busy = self.server.pool is not None and self.server.pool.queued()
+            if idle >= (KEEPALIVE_BUSY_TIMEOUT if busy else KEEPALIVE_IDLE_TIMEOUT):
+                return False
+    
+    def detach_worker(self):
+        """This connection is becoming a tunnel or long stream - hand its pool slot to a stand-in"""
+        if self.server.pool is not None:
+            self.server.pool.detach()
+    
+    def send_response(self, code, message=None):
+        self.status = code
+        self.close_sent = False
+        super().send_response(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection' and value.lower() == 'close':
+            self.close_sent = True  # send_error already says so - end_headers must not repeat it
+        super().send_header(keyword, value)
+    
+    def end_headers(self):
+        self.requests_handled += 1
+        if self.requests_handled >= KEEPALIVE_MAX_REQUESTS:
+            self.close_connection = True
+        if self.close_connection:
+            if not self.close_sent:
+                self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.1':
+            remaining = KEEPALIVE_MAX_REQUESTS - self.requests_handled
+            self.send_header('Keep-Alive', f'timeout={KEEPALIVE_IDLE_TIMEOUT}, max={remaining}')
+        self.response_started = True
+        super().end_headers()
+    
+    def do_GET(self): self.proxy_request('GET')
+    def do_POST(self): self.proxy_request('POST')
+    def do_HEAD(self): self.proxy_request('HEAD')
+    def do_PUT(self): self.proxy_request('PUT')
+    def do_DELETE(self): self.proxy_request('DELETE')
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', '*')
+        self.send_header('Access-Control-Allow-Credentials', 'true')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        log.info(f"[REQ] {self.client_address[0]} - {format % args}")
+    
+    def log_error(self, format, *args):
+        if format.startswith('Request timed out'):
+            return  # Idle keep-alive connection expired - routine, not an error
+        super().log_error(format, *args)
+    
+    def proxy_request(self, method):
+        if self.path == METRICS_PATH and method == 'GET':
+            return self.send_metrics()
+        port = self.server.server_address[1]
+        # The routing version this request sticks to, even if the health check switches meanwhile
+        self.lease = ROUTING.pin()
+        conn = body = None
+        started, sent_before, written_before = time.perf_counter(), self.wfile.bytes, self.wfile.elapsed
+        self.timing = SLOW_LOG.start()
+        self.wfile.timed = self.timing is not None
+        # Upstream reads can take minutes on agent streams
+        self.connection.settimeout(UPSTREAM_TIMEOUT)
         
         try:
-            match = re.search(b"window\\.chatParams\\s*=\\s*['\"]([A-Za-z0-9+/=]+)['\"]", body)
-            if match:
-                old_b64 = match.group(1)
-                params = json.loads(base64.b64decode(old_b64))
-                
-                # Note: We no longer extract the port from chatParams URL as it may be stale
-                # or point to the remapped proxy. find_lsp_port() gives us the real port.
-                
-                # Note: We no longer extract CSRF token from chatParams as it may be stale
-                # after IDE restart. find_csrf_token() at startup gives us the real token.
-                
-                # Update URLs to point to our proxy
-                # For mobile: use same port (8892) to avoid CORS issues
-                # For desktop: use dedicated LSP port (8891)
-                lsp_port_to_use = incoming_port if incoming_port == MOBILE_PORT else LSP_PORT
-                new_url = f'http://{EXTERNAL_IP}:{lsp_port_to_use}/'
-                params['languageServerUrl'] = new_url
-                params['httpLanguageServerUrl'] = new_url
-                
-                # Re-encode
-                new_b64 = base64.b64encode(json.dumps(params).encode()).decode()
-                old_full = b"window.chatParams = '" + old_b64 + b"'"
-                new_full = b"window.chatParams = '" + new_b64.encode() + b"'"
-                body = body.replace(old_full, new_full)
-                print(f"[PATCH] LSP: 127.0.0.1:{LSP_TARGET_PORT} -> {EXTERNAL_IP}:{LSP_PORT}")
+            target_host, target_port, is_lsp_request = route_request(self.path, port, self.lease.route)
+            self.route = route_name(port, is_lsp_request)
+            
+            if is_upgrade_request(self.headers.items()):
+                # WebSocket handshake - becomes a raw tunnel after the upstream's 101
+                use_https = is_lsp_request and self.lease.route.lsp_https
+                return self.tunnel_upgrade(method, target_host, target_port, is_lsp_request, use_https)
+            
+            # Small bodies are read whole (retryable); large or chunked ones stream upstream as they arrive
+            phase_started = time.perf_counter()
+            body = self.request_body()
+            self.phase('request_body', phase_started)
+            
+            headers = forward_headers(self.headers.items(), target_host, target_port, is_lsp_request,
+                                      route=self.lease.route)
+            if not is_lsp_request:
+                self.accept_encoding = self.headers.get('Accept-Encoding')
+            
+            # Agent Tab document: a cached patch is revalidated with the upstream's own validators
+            html_key = cached_html = None
+            if method == 'GET' and not is_lsp_request and port in (UI_PORT, MOBILE_PORT):
+                html_key = (self.path, html_routing_key(port, self.lease.route))
+                cached_html = HTML_CACHE.get(html_key)
+                upstream_validators(headers, cached_html)
+            
+            # Static assets: fresh copies are answered locally, stale ones revalidated with our validators
+            asset = None
+            if html_key is not None and cached_html is None:
+                asset = ASSET_CACHE.get(self.path)
+                if asset is not None and asset.is_fresh():
+                    ASSET_CACHE.count('negative_hits' if asset.status == 404 else 'hits')
+                    return self.send_asset(asset)
+                if asset is not None and asset.status == 200:
+                    replace_validators(headers, asset.etag, asset.last_modified)
+                else:
+                    asset = None
+                    ASSET_CACHE.count('misses')
+            
+            # Identical GETs already on their way upstream are answered from that one fetch
+            if html_key is not None and 'Range' not in self.headers:
+                flight, leader = FLIGHTS.join(html_key)
+                if leader:
+                    self.flight = (html_key, flight)
+                else:
+                    phase_started = time.perf_counter()
+                    shared = FLIGHTS.wait(flight)
+                    self.phase('coalesce_wait', phase_started)
+                    if shared is not None:
+                        return self.send_shared(shared)
+            
+            # Bulk fetches wait here while slots are taken; LSP traffic goes straight through
+            phase_started = time.perf_counter()
+            self.ticket = SCHEDULER.admit(
+                request_priority(self.path, is_lsp_request, self.headers.get('Content-Type')), self.client_address[0])
+            self.phase('queue', phase_started)
+            
+            # LSP backend may use HTTP or HTTPS depending on version (re-read if the upstream moved meanwhile)
+            conn, response, use_https = self.open_upstream_failover(method, port, is_lsp_request, body, headers)
+            
+            has_body = method != 'HEAD' and response.status not in (204, 304) and response.status >= 200
+            is_html = port in (UI_PORT, MOBILE_PORT) and 'text/html' in response.getheader('Content-Type', '')
+            
+            # For LSP requests: Stream response immediately for lower latency
+            # This applies to all ports since mobile sends LSP requests on 8892
+            if is_lsp_request:
+                # Connect streams are relayed one whole message at a time, the moment each completes
+                relay = None
+                if has_body and is_connect_stream(response.getheader('Content-Type')):
+                    relay = EnvelopeRelay(self.path, CONNECT_STATS)
+                    self.detach_worker()
+                # Without a Content-Length the body is re-framed as chunked so the connection survives
+                chunked = self.start_stream(response, has_body, keep_length=True)
+                if has_body:
+                    for chunk in iter_response(response, 65536 if relay else 4096):
+                        if conn is not None and response.isclosed():
+                            UPSTREAM_POOL.release(conn, response, https=use_https)
+                            conn = None
+                        self.write_piece(relay.feed(chunk) if relay else chunk, chunked)
+                    if relay is not None:
+                        self.write_piece(relay.close(), chunked)
+                        log_connect_stream(relay)
+                    self.finish_pieces(chunked)
+                if conn is not None:
+                    UPSTREAM_POOL.release(conn, response, https=use_https)
+                    conn = None
+            elif asset is not None and response.status == 304:
+                # Asset unchanged on the IDE side - serve our copy and restart its freshness clock
+                response.read()
+                UPSTREAM_POOL.release(conn, response, https=use_https)
+                conn = None
+                self.release_slot()
+                ASSET_CACHE.count('revalidated')
+                asset = ASSET_CACHE.refresh(self.path, asset, response.getheaders())
+                self.publish_flight(asset)
+                self.send_asset(asset)
+            elif cached_html is not None and response.status == 304:
+                # Upstream document unchanged - serve the cached patch
+                response.read()
+                UPSTREAM_POOL.release(conn, response, https=use_https)
+                conn = None
+                self.release_slot()
+                HTML_CACHE.count('hits')
+                self.publish_flight(cached_html)
+                self.send_patched(cached_html)
+            elif is_html and has_body and html_key is not None and response.status == 200:
+                self.serve_agent_tab(response, port, html_key, cached_html)
+                UPSTREAM_POOL.release(conn, response, https=use_https)
+                conn = None
+            elif is_html and has_body:
+                # Agent Tab document: stream through the rewriter so the browser starts parsing right away
+                self.publish_flight(None)  # Not cacheable - release identical waiters at once
+                patcher = html_patcher(mobile=(port == MOBILE_PORT), incoming_port=port, route=self.lease.route)
+                encoding = response_encoding(self.accept_encoding, response)
+                chunked = self.start_stream(response, has_body, keep_length=False, encoding=encoding)
+                for chunk in iter_response(response):
+                    self.write_piece(patcher.feed(chunk), chunked)
+                self.write_piece(patcher.close(), chunked)
+                self.note_patch(patcher)
+                self.finish_pieces(chunked)
+                UPSTREAM_POOL.release(conn, response, https=use_https)
+                conn = None
+            else:
+                # Everything else streams straight through - cacheable assets are copied aside on the way
+                kept = stored = None
+                if html_key is not None and not is_html and has_body:
+                    length = response.getheader('Content-Length', '')
+                    if ASSET_CACHE.may_store(response.status, response.getheaders(),
+                                             int(length) if length.isdigit() else None):
+                        kept, size = [], 0
+                if kept is None:
+                    # Known from the headers alone: nothing to share, so waiters fetch for themselves now
+                    self.publish_flight(None)
+                if not has_body or response.getheader('Content-Length') == '0':
+                    response.read()
+                    stored = self.finish_upstream(conn, response, use_https, kept, asset is not None)
+                    conn = None
+                encoding = response_encoding(self.accept_encoding, response) if has_body else None
+                chunked = self.start_stream(response, has_body, keep_length=not encoding,
+                                            etag=response.getheader('ETag') if encoding else None,
+                                            encoding=encoding, progressive=False)
+                encoder = self.body_encoder
+                if encoder is not None and kept is not None:
+                    encoder.output = []  # Becomes the cached compressed variant if the asset is stored
+                # Large bodies nobody needs to look at move socket-to-socket in the kernel
+                def upstream_done():
+                    nonlocal conn
+                    UPSTREAM_POOL.release(conn, response, https=use_https)
+                    conn = None
+                    self.release_slot()
+                length = response.getheader('Content-Length', '')
+                counted = self.wfile.bytes
+                spliced = (has_body and not encoding and kept is None and not use_https and length.isdigit()
+                           and can_splice(response, int(length))
+                           and splice_response(response, self.connection, UPSTREAM_TIMEOUT, upstream_done,
+                                               write=self.wfile.write))
+                if spliced:
+                    # Only the already-buffered head went through the counting writer, the rest socket-to-socket
+                    self.wfile.bytes = counted + int(length)
+                if has_body and not spliced:
+                    for chunk in iter_response(response):
+                        if kept is not None:
+                            kept.append(chunk)
+                            size += len(chunk)
+                            if size > ASSET_MAX_BODY:
+                                kept = None
+                                if encoder is not None:
+                                    encoder.output = None  # Too big to cache, so stop collecting the compressed copy
+                                self.publish_flight(None)
+                        if conn is not None and response.isclosed():
+                            # Upstream side done - pool the connection and cache the asset before the last write
+                            stored = self.finish_upstream(conn, response, use_https, kept, asset is not None)
+                            conn = None
+                        SCHEDULER.pace(self.ticket)
+                        self.write_piece(chunk, chunked)
+                    if stored is not None and encoder is not None and encoder.output is not None:
+                        # Cache the compressed copy before the last bytes go out, so the next request finds it
+                        self.body_encoder = None
+                        tail = encoder.finish()
+                        self.adopt_encoded(stored, encoder)
+                        self.write_raw(tail, chunked)
+                    self.finish_pieces(chunked)
+                if conn is not None:
+                    stored = self.finish_upstream(conn, response, use_https, kept, asset is not None)
+                    conn = None
+                if stored is not None and encoder is not None and encoder.output is not None:
+                    self.adopt_encoded(stored, encoder)
+        except RequestBodyTooLarge as e:
+            log.error(f"[ERROR] {e}")
+            self.close_connection = True  # The rest of the upload is never read
+            if not self.response_started:
+                self.send_error(413, str(e))
+        except RequestBodyError as e:
+            log.error(f"[ERROR] {self.client_address[0]} {self.path}: {e}")
+            self.close_connection = True  # Where the next request starts is unknown
+            if not self.response_started:
+                self.send_error(400, str(e))
         except Exception as e:
-            print(f"[!] Patch error: {e}")
-        return body
+            log.error(f"[ERROR] {e}")
+            if isinstance(body, RequestBodyReader) and not body.done:
+                self.close_connection = True  # Unread upload bytes would be parsed as the next request
+            if self.response_started:
+                # Too late for an error page - drop the connection so the client sees a truncated body
+                self.close_connection = True
+            else:
+                self.send_error(502, str(e))
+        finally:
+            self.publish_flight(None)  # Nothing shareable - waiters fetch for themselves
+            self.release_slot()
+            if conn is not None:
+                UPSTREAM_POOL.discard(conn)
+            self.lease.release()
+            self.record_request(method, started, sent_before, written_before, body)
+    
+    def record_request(self, method, started, sent_before, written_before, body):
+        first_request_served()
+        labels = (('route', self.route),)
+        METRICS.inc('gravity_requests_total', labels + (('status', str(self.status or 0)),))
+        METRICS.observe('gravity_request_duration_seconds', time.perf_counter() - started, labels)
+        received = len(body) if isinstance(body, bytes) else getattr(body, 'received', 0)
+        if received:
+            METRICS.inc('gravity_bytes_in_total', labels, received)
+        sent = self.wfile.bytes - sent_before
+        METRICS.inc('gravity_bytes_out_total', labels, sent)
+        if self.timing is not None:
+            self.timing.add('client_write', self.wfile.elapsed - written_before)
+            SLOW_LOG.finish(self.timing, client=self.client_address[0], method=method, path=self.path,
+                            route=self.route, status=self.status, bytes_in=received, bytes_out=sent)
+            self.timing = None
+    
+    def phase(self, name, started):
+        """Add the time since started to this request's breakdown (if it is sampled)"""
+        if self.timing is not None:
+            self.timing.add(name, time.perf_counter() - started)
+    
+    def note_patch(self, patcher):
+        METRICS.observe('gravity_patch_seconds', patcher.elapsed)
+        if self.timing is not None:
+            self.timing.add('patch', patcher.elapsed)
+    
+    def send_metrics(self):
+        """Prometheus scrape - only for clients on this machine"""
+        if not self.client_address[0].startswith(('127.', '::1', '::ffff:127.')):
+            return self.send_error(404)
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_agent_tab(self, response, port, key, cached):
+        """Answer a GET for the Agent Tab document from the patch cache, or patch it and remember the result"""
+        mobile = port == MOBILE_PORT
+        upstream_etag = response.getheader('ETag')
+        if cached is not None and not upstream_etag:
+            # No upstream validator - the body hash tells whether the cached patch still applies
+            raw = response.read()
+            digest = hashlib.sha256(raw).hexdigest()
+            if digest == cached.upstream_hash:
+                HTML_CACHE.count('hits')
+                self.publish_flight(cached)
+                return self.send_patched(cached)
+            HTML_CACHE.count('misses')
+            patcher = html_patcher(mobile=mobile, incoming_port=port, route=self.lease.route)
+            patched = patcher.feed(raw) + patcher.close()
+            self.note_patch(patcher)
+            doc = self.remember_patched(key, response, patched, None, digest)
+            self.publish_flight(doc)
+            return self.send_patched(doc)
+        
+        # With an upstream ETag our ETag is known before the body is patched
+        etag = make_etag(upstream_etag, key[1], PATCH_FINGERPRINT) if upstream_etag else None
+        if etag and etag_matches(self.browser_etag(), etag):
+            response.read()
+            HTML_CACHE.count('not_modified')
+            return self.send_not_modified(etag, response.getheader('Cache-Control'))
+        
+        # Stream through the rewriter, keeping a copy of the output for the cache
+        HTML_CACHE.count('misses')
+        patcher = html_patcher(mobile=mobile, incoming_port=port, route=self.lease.route)
+        digest = hashlib.sha256()
+        kept, size = [], 0
+        length = response.getheader('Content-Length', '')
+        if length.isdigit() and int(length) > HTML_CACHE_MAX_BODY:
+            kept = None
+            self.publish_flight(None)  # Won't be cached - waiters need not sit through the download
+        encoding = response_encoding(self.accept_encoding, response)
+        chunked = self.start_stream(response, True, keep_length=False, etag=etag, encoding=encoding)
+        for chunk in iter_response(response):
+            digest.update(chunk)
+            out = patcher.feed(chunk)
+            self.write_piece(out, chunked)
+            if kept is not None:
+                kept.append(out)
+                size += len(out)
+                if size > HTML_CACHE_MAX_BODY:
+                    kept = None
+                    self.publish_flight(None)
+        tail = patcher.close()
+        self.note_patch(patcher)
+        if kept is not None:
+            # Cached and shared before the last bytes go out, so the browser's next request finds it
+            kept.append(tail)
+            self.publish_flight(self.remember_patched(key, response, b''.join(kept), upstream_etag,
+                                                      digest.hexdigest()))
+        self.write_piece(tail, chunked)
+        self.finish_pieces(chunked)
+    
+    def remember_patched(self, key, response, body, upstream_etag, upstream_hash):
+        validator = upstream_etag or upstream_hash
+        doc = PatchedDocument(
+            response.status,
+            [(k, v) for k, v in response.getheaders() if k.lower() not in HTML_REPLAY_SKIP],
+            body,
+            make_etag(validator, key[1], PATCH_FINGERPRINT),
+            upstream_etag=upstream_etag,
+            upstream_hash=upstream_hash,
+            last_modified=response.getheader('Last-Modified'),
+        )
+        HTML_CACHE.store(key, doc)
+        return doc
+    
+    def send_patched(self, doc):
+        """Serve a cached patched document (304 if the browser already has these bytes)"""
+        if etag_matches(self.browser_etag(), doc.etag):
+            HTML_CACHE.count('not_modified')
+            cache_control = next((v for k, v in doc.headers if k.lower() == 'cache-control'), None)
+            return self.send_not_modified(doc.etag, cache_control)
+        self.send_stored(doc.status, doc.headers, doc.body, doc.etag, compress_key=doc.etag)
+    
+    def send_shared(self, shared):
+        """Answer a coalesced request with what its leader fetched"""
+        if isinstance(shared, PatchedDocument):
+            return self.send_patched(shared)
+        return self.send_asset(shared)
+    
+    def publish_flight(self, result):
+        """Hand this request's result to identical requests waiting on it (None = fetch yourselves)"""
+        if self.flight is not None:
+            key, flight = self.flight
+            self.flight = None
+            FLIGHTS.publish(key, flight, result)
+    
+    def send_asset(self, asset):
+        """Serve a cached asset (304 if the browser's validators still match)"""
+        if asset.status == 200:
+            browser_etag = self.browser_etag()
+            if etag_matches(browser_etag, asset.etag) or (
+                    not browser_etag and asset.last_modified
+                    and self.headers.get('If-Modified-Since') == asset.last_modified):
+                return self.send_not_modified(asset.etag, asset.header('cache-control'))
+        self.send_stored(asset.status, asset.headers, asset.body, asset.etag, self.asset_compress_key(asset))
+    
+    def asset_compress_key(self, asset):
+        # ETags are only unique per path; without one the body digest is used
+        return f'{self.path}|{asset.etag}' if asset.etag else None
+    
+    def send_stored(self, status, headers, body, etag, compress_key=None):
+        """Send a response held in one of the caches, compressed for this browser if worthwhile"""
+        content_type = next((v for k, v in headers if k.lower() == 'content-type'), None)
+        vary = ', '.join(v for k, v in headers if k.lower() == 'vary') or None
+        encoding = None
+        if status == 200 and is_compressible(content_type, None, len(body)):
+            encoding = choose_encoding(self.accept_encoding)
+        if encoding:
+            body = COMPRESSION.encode(body, encoding, cache_key=compress_key)
+        self.send_response(status)
+        for k, v in headers:
+            if k.lower() != 'vary':
+                self.send_header(k, v)
+        if etag:
+            self.send_header('ETag', encoded_etag(etag, encoding))
+        self.send_encoding_headers(encoding, content_type, vary)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Credentials', 'true')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def browser_etag(self):
+        """The browser's If-None-Match with our per-encoding suffixes removed"""
+        return strip_etag_encoding(self.headers.get('If-None-Match'))
+    
+    def send_encoding_headers(self, encoding, content_type, vary=None):
+        """Content-Encoding, and the upstream Vary (None if absent) with Accept-Encoding added for compressible types"""
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if is_compressible(content_type):
+            vary = vary_with_encoding(vary)
+        if vary:
+            self.send_header('Vary', vary)
+    
+    def send_not_modified(self, etag, cache_control=None):
+        self.send_response(304)
+        if etag:
+            self.send_header('ETag', encoded_etag(etag, choose_encoding(self.accept_encoding)))
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Credentials', 'true')
+        self.end_headers()
+    
+    def adopt_encoded(self, stored, encoder):
+        COMPRESSION.adopt(stored.body, encoder.encoding, b''.join(encoder.output),
+                          cache_key=self.asset_compress_key(stored))
+        encoder.output = None
+    
+    def release_slot(self):
+        """Hand the scheduler slot back once this request is done with the upstream (safe to repeat)"""
+        if self.ticket is not None:
+            SCHEDULER.release(self.ticket)
+    
+    def finish_upstream(self, conn, response, https, kept, forget_stale):
+        """Upstream body fully read: pool the connection and store the asset copy - returns the cache entry"""
+        UPSTREAM_POOL.release(conn, response, https=https)
+        self.release_slot()  # The rest goes at the client's pace - let the next bulk fetch start
+        stored = None
+        if kept is not None:
+            stored = ASSET_CACHE.store(self.path, response.status, response.getheaders(), b''.join(kept))
+        if stored is None and forget_stale:
+            ASSET_CACHE.forget(self.path)  # No longer cacheable
+        self.publish_flight(stored)
+        return stored
+    
+    def request_body(self):
+        """None, the whole body as bytes, or a RequestBodyReader to stream it upstream"""
+        transfer_encoding = self.headers.get('Transfer-Encoding', '').lower()
+        if transfer_encoding:
+            if transfer_encoding.split(',')[-1].strip() != 'chunked':
+                self.close_connection = True  # Unknown framing - can't tell where the body ends
+                return None
+            return RequestBodyReader(self.rfile)
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_REQUEST_BODY:
+            raise RequestBodyTooLarge(f'Request body of {length} bytes over {MAX_REQUEST_BODY}')
+        if length <= 0:
+            return None
+        reader = RequestBodyReader(self.rfile, length)
+        return reader.read_all() if length <= REQUEST_BUFFER_LIMIT else reader
+    
+    def handle_expect_100(self):
+        # Refuse an oversized upload before the browser sends it
+        length = self.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > MAX_REQUEST_BODY:
+            self.close_connection = True
+            self.send_error(413, f'Request body of {length} bytes over {MAX_REQUEST_BODY}')
+            return False
+        # Interim response - bypass end_headers() so it is not counted as the answer
+        self.send_response_only(100)
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+        return True
+    
+    def start_stream(self, response, has_body, keep_length, etag=None, encoding=None, progressive=True):
+        """Send the upstream's status and headers for a streamed body - returns True if chunked framing is used"""
+        length = response.getheader('Content-Length') if keep_length else None
+        chunked = has_body and length is None
+        if chunked and self.request_version != 'HTTP/1.1':
+            self.close_connection = True  # HTTP/1.0 client - end of body is signalled by close
+            chunked = False
+        
+        self.send_response(response.status)
+        for k, v in response.getheaders():
+            if k.lower() not in ['transfer-encoding', 'connection', 'keep-alive']:
+                if k.lower() == 'content-length' and not keep_length:
+                    continue
+                if k.lower() == 'etag' and not keep_length:
+                    continue  # Validates the unpatched upstream bytes, not what we send
+                if k.lower() == 'vary':
+                    continue  # Merged with our own Accept-Encoding below
+                self.send_header(k, v)
+        if etag:
+            self.send_header('ETag', encoded_etag(etag, encoding))
+        if encoding and has_body:
+            self.body_encoder = COMPRESSION.streaming(encoding, progressive=progressive)
+        self.send_encoding_headers(encoding if has_body else None, response.getheader('Content-Type'),
+                                   response.getheader('Vary'))
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Credentials', 'true')
+        self.end_headers()
+        return chunked
+    
+    def write_piece(self, data, chunked):
+        if self.body_encoder is not None:
+            data = self.body_encoder.feed(data)
+        self.write_raw(data, chunked)
+    
+    def write_raw(self, data, chunked):
+        # An empty chunk would end a chunked body early
+        if not data:
+            return
+        if chunked:
+            self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+    
+    def finish_pieces(self, chunked):
+        if self.body_encoder is not None:
+            self.write_raw(self.body_encoder.finish(), chunked)
+            self.body_encoder = None
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+    
+    def tunnel_upgrade(self, method, host, port, is_lsp_request, https):
+        """Forward an Upgrade handshake, then relay raw bytes both ways (WebSocket push channels)"""
+        self.close_connection = True  # This connection belongs to the tunnel from now on
+        upstream = socket.create_connection((host, port), timeout=UPSTREAM_TIMEOUT)
+        try:
+            if https:
+                from upstream_pool import lsp_ssl_context
+                upstream = lsp_ssl_context().wrap_socket(upstream, server_hostname=host)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            headers = forward_headers(self.headers.items(), host, port, is_lsp_request, upgrade=True,
+                                      route=self.lease.route)
+            head = f'{method} {self.path} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+            upstream.sendall((head + '\r\n').encode('latin-1'))
+            
+            response_head, status, response_headers, leftover = read_response_head(upstream)
+            self.response_started = True
+            self.status = status
+            self.wfile.write(response_head + leftover)
+            self.log_request(status)
+            
+            if status != 101:
+                # Upstream refused to switch - relay its (close-delimited or sized) answer and hang up
+                remaining = int(response_headers.get('content-length', -1)) - len(leftover)
+                while remaining != 0:
+                    data = upstream.recv(65536)
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                return
+            
+            # Bytes the browser pipelined behind its handshake are still in rfile's buffer
+            self.connection.settimeout(0)
+            pipelined = self.rfile.read1(65536) or b''
+            self.connection.settimeout(None)
+            if pipelined:
+                upstream.sendall(pipelined)
+            upstream.settimeout(None)
+            
+            self.detach_worker()
+            with TUNNEL_STATS_LOCK:
+                TUNNEL_STATS['opened'] += 1
+                TUNNEL_STATS['active'] += 1
+            started = time.monotonic()
+            bytes_up, bytes_down = len(pipelined), len(leftover)
+            try:
+                relayed_up, relayed_down = relay_sockets(self.connection, upstream)
+                bytes_up += relayed_up
+                bytes_down += relayed_down
+            finally:
+                with TUNNEL_STATS_LOCK:
+                    TUNNEL_STATS['active'] -= 1
+                    TUNNEL_STATS['bytes_up'] += bytes_up
+                    TUNNEL_STATS['bytes_down'] += bytes_down
+            log.info(f"[TUNNEL] {self.client_address[0]} {self.path} closed after {time.monotonic() - started:.0f}s "
+                  f"(up {bytes_up} B, down {bytes_down} B)")
+        finally:
+            upstream.close()
+    
+    def open_upstream_failover(self, method, listen_port, is_lsp_request, body, headers):
+        """open_upstream, riding out an IDE / language_server restart: a refused or reset connect triggers
+        rediscovery, and the request is retried against the new target until FAILOVER_DEADLINE"""
+        kind = 'lsp' if is_lsp_request else 'ui'
+        deadline = None
+        while True:
+            route = self.lease.route
+            host, port, _ = route_request(self.path, listen_port, route)
+            https = is_lsp_request and route.lsp_https
+            headers['Host'] = f'{host}:{port}'
+            if is_lsp_request and route.csrf_token:
+                headers['x-codeium-csrf-token'] = route.csrf_token
+            try:
+                conn, response = self.open_upstream(method, host, port, https, body, headers)
+            except (ConnectionRefusedError, ConnectionResetError, http.client.RemoteDisconnected) as e:
+                deadline = failover_retry(kind, (host, port), e, method,
+                                          not isinstance(body, RequestBodyReader), deadline)
+                if deadline is None:
+                    raise
+                phase_started = time.perf_counter()
+                rediscover()
+                # Nothing was relayed yet, so the retry moves to the newest routing version
+                if route_request(self.path, listen_port, self.lease.renew())[:2] == (host, port):
+                    time.sleep(FAILOVER_RETRY_INTERVAL)  # Not back yet - the next refresh may find it
+                self.phase('failover', phase_started)
+                continue
+            if deadline is not None:
+                METRICS.inc('gravity_failover_requests_total', (('outcome', 'recovered'),))
+            failover_ended(kind, (host, port))
+            return conn, response, https
+    
+    def open_upstream(self, method, host, port, https, body, headers):
+        """Send the request on a pooled connection, retrying once if a reused one went stale"""
+        conn, reused = UPSTREAM_POOL.acquire(host, port, https=https, timeout=UPSTREAM_TIMEOUT)
+        try:
+            return conn, self.send_upstream(conn, method, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            UPSTREAM_POOL.discard(conn)
+            # The IDE may close an idle keep-alive connection just as we reuse it
+            # (a streamed body is already partly consumed and cannot be sent again)
+            if not reused or method not in IDEMPOTENT_METHODS or isinstance(body, RequestBodyReader):
+                raise
+        except Exception:
+            UPSTREAM_POOL.discard(conn)
+            raise
+        conn, _ = UPSTREAM_POOL.acquire(host, port, https=https, timeout=UPSTREAM_TIMEOUT, fresh=True)
+        try:
+            return conn, self.send_upstream(conn, method, body, headers)
+        except Exception:
+            UPSTREAM_POOL.discard(conn)
+            raise
+    
+    def send_upstream(self, conn, method, body, headers):
+        """Send the request and wait for the response headers, timing connect (new connections) and TTFB"""
+        labels = (('route', self.route),)
+        if conn.sock is None:
+            started = time.perf_counter()
+            conn.connect()
+            METRICS.observe('gravity_upstream_connect_seconds', time.perf_counter() - started, labels)
+            self.phase('connect', started)
+        started = time.perf_counter()
+        conn.request(method, self.path, body, headers)
+        response = conn.getresponse()
+        METRICS.observe('gravity_upstream_ttfb_seconds', time.perf_counter() - started, labels)
+        self.phase('ttfb', started)
+        return response
+    
+    def patch_html(self, body, mobile=False, incoming_port=None):
+        return patch_html(body, mobile=mobile, incoming_port=incoming_port,
+                          route=self.lease.route if self.lease is not None else None)
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+class ThreadedHTTPServer(PooledMixIn, http.server.HTTPServer):
     allow_reuse_address = True
-    daemon_threads = True
+    pool = WORKER_POOL
+    request_queue_size = 128  # Kernel accept backlog in front of the pool's own queue
     timeout = 600  # Socket timeout for long-idle connections
     
     def server_bind(self):
@@ -411,35 +1581,50 @@ class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
             pass  # Not all platforms support these
         super().server_bind()
 
+def autodetect():
+    """Auto-detect IDE port, LSP port/protocol and CSRF token at startup"""
+    server = find_language_server()
+    # IDE and language_server probes run side by side - startup waits for the slower one only
+    found = dict(port_probe.run_probes({'ide': lambda t: find_active_ide_port(),
+                                        'lsp': lambda t: find_lsp_target(server)},
+                                       time.monotonic() + port_probe.LSP_PROBE_DEADLINE + 0.5))
+    ide_port = found.get('ide') or 9090
+    lsp_port, lsp_https = found.get('lsp') or (37417, True)
+    ROUTING.update(ui_target=('127.0.0.1', ide_port), lsp_port=lsp_port, lsp_https=lsp_https,
+                   csrf_token=find_csrf_token(server))
+    ASSET_CACHE.set_build(find_ide_build(server))
+    return ide_port
+
 def main():
-    global LSP_TARGET_PORT, CSRF_TOKEN, UI_TARGET, LSP_USE_HTTPS
-    
-    # Auto-detect ports and CSRF at startup
-    ide_port = find_active_ide_port()
-    UI_TARGET = ('127.0.0.1', ide_port)
-    LSP_TARGET_PORT = find_lsp_port()
-    LSP_USE_HTTPS = probe_lsp_protocol(LSP_TARGET_PORT)
-    CSRF_TOKEN = find_csrf_token()
-    
-    lsp_protocol = 'https' if LSP_USE_HTTPS else 'http'
-    print("=" * 60)
-    print("Antigravity Remote Access Proxy v2.5 (Auto Protocol)")
-    print("=" * 60)
-    print(f"External IP: {EXTERNAL_IP}")
-    print(f"IDE Port: {ide_port} (auto-detected)")
-    print(f"LSP Port: {LSP_TARGET_PORT} ({lsp_protocol})")
-    print(f"CSRF Token: {CSRF_TOKEN[:16] if CSRF_TOKEN else 'NOT FOUND'}...")
-    print(f"\nUI:     http://0.0.0.0:{UI_PORT} -> http://127.0.0.1:{ide_port}")
-    print(f"Mobile: http://0.0.0.0:{MOBILE_PORT} -> http://127.0.0.1:{ide_port} (mobile-optimized)")
-    print(f"LSP:    http://0.0.0.0:{LSP_PORT} -> {lsp_protocol}://127.0.0.1:{LSP_TARGET_PORT}")
-    print(f"\nAccess:")
-    print(f"  Desktop: http://{EXTERNAL_IP}:{UI_PORT}")
-    print(f"  Mobile:  http://{EXTERNAL_IP}:{MOBILE_PORT}")
-    print(f"\n[AUTO] Health check thread monitors IDE/LSP ports every 10s")
+    if '--async' in sys.argv:
+        # Single event loop engine - imports this file as a module, so run it from there
+        import async_forward
+        return async_forward.main()
     
+    # Bind first, so clients queue in the accept backlog instead of being refused while routing is found
+    warm = load_routing()
     ui_server = ThreadedHTTPServer(('0.0.0.0', UI_PORT), ProxyHandler)
     mobile_server = ThreadedHTTPServer(('0.0.0.0', MOBILE_PORT), ProxyHandler)
     lsp_server = ThreadedHTTPServer(('0.0.0.0', LSP_PORT), ProxyHandler)
+    start_routing(warm)
+    route = ROUTING.current
+    ide_port = route.ui_target[1]
+    
+    lsp_protocol = 'https' if route.lsp_https else 'http'
+    log.write("=" * 60)
+    log.write("Antigravity Remote Access Proxy v2.5 (Auto Protocol)")
+    log.write("=" * 60)
+    log.write(f"External IP: {route.external_ip}")
+    log.write(f"IDE Port: {ide_port} ({'last known' if warm else 'auto-detected'})")
+    log.write(f"LSP Port: {route.lsp_port} ({lsp_protocol})")
+    log.write(f"CSRF Token: {route.csrf_token[:16] if route.csrf_token else 'NOT FOUND'}...")
+    log.write(f"\nUI:     http://0.0.0.0:{UI_PORT} -> http://127.0.0.1:{ide_port}")
+    log.write(f"Mobile: http://0.0.0.0:{MOBILE_PORT} -> http://127.0.0.1:{ide_port} (mobile-optimized)")
+    log.write(f"LSP:    http://0.0.0.0:{LSP_PORT} -> {lsp_protocol}://127.0.0.1:{route.lsp_port}")
+    log.write("\nAccess:")
+    log.write(f"  Desktop: http://{route.external_ip}:{UI_PORT}")
+    log.write(f"  Mobile:  http://{route.external_ip}:{MOBILE_PORT}")
+    log.write("\n[AUTO] Health check thread monitors IDE/LSP ports every 10s")
     
     t1 = threading.Thread(target=ui_server.serve_forever, daemon=True)
     t2 = threading.Thread(target=mobile_server.serve_forever, daemon=True)
@@ -450,11 +1635,11 @@ def main():
     t3.start()
     t4.start()
     
-    print("\nPress Ctrl+C to stop\n")
+    log.write("\nPress Ctrl+C to stop\n")
     try:
         t1.join()
     except KeyboardInterrupt:
-        print("Stopping...")
+        log.write("Stopping...")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1271 @@
+import asyncio
+import base64
+import http.client
+import http.server
+import json
+import os
+import re
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import async_forward
+import antigravity_sim
+import asset_cache
+import compression
+import connect_relay
+import discovery
+import gravity_log
+import metrics
+import port_probe
+import request_timing
+import routing
+import scheduler
+import tcp_forward
+import upstream_pool
+import worker_pool
+import zerocopy
+
+CHAT_PARAMS = {
+    'languageServerUrl': 'https://127.0.0.1:37417/',
+    'httpLanguageServerUrl': 'https://127.0.0.1:37417/',
+    'csrfToken': 'stale-token',
+}
+BUNDLE_JS = b'export function f(n) { return n * 2; }\n' * 2000
+BLOB = bytes(range(256)) * 4096  # 1 MiB, not cacheable
+
+
+def envelope(payload, flags=0):
+    return bytes([flags]) + len(payload).to_bytes(4, 'big') + payload
+
+
+CHAT_MESSAGES = [envelope(b'{"token":"hel"}'), envelope(b'{"token":"lo"}'), envelope(b'{}', flags=2)]
+AGENT_TAB_HTML = (
+    "<html><head><title>Agent</title></head><body><script>window.chatParams = '"
+    + base64.b64encode(json.dumps(CHAT_PARAMS).encode()).decode()
+    + "';</script>" + "<div class=\"chat-message\"></div>" * 60 + "</body></html>"
+).encode()
+
+
+def restore_routing(route):
+    """Publish a saved Route again (as a new version)"""
+    fields = route._asdict()
+    del fields['version']
+    tcp_forward.ROUTING.update(**fields)
+
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """Stands in for both the Agent Tab (9090) and the language_server"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/missing.png':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('Upgrade') == 'websocket':
+            # Raw echo after the handshake, with a greeting sent right behind the 101
+            self.send_response(101)
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.end_headers()
+            self.wfile.write(b'welcome')
+            self.close_connection = True
+            if self.path == '/ws-reset':
+                # Abort with a RST right after the handshake
+                self.wfile.flush()
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b'\x01\0\0\0\0\0\0\0')
+                return
+            while True:
+                data = self.connection.recv(65536)
+                if not data:
+                    return
+                self.connection.sendall(data)
+        if self.path == '/slow.js':
+            # Second half is only sent once the test has seen the first
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/javascript')
+            self.send_header('Content-Length', str(2 * len(BUNDLE_JS)))
+            self.end_headers()
+            self.wfile.write(BUNDLE_JS)
+            self.wfile.flush()
+            self.server.slow_release.wait(5)
+            self.wfile.write(BUNDLE_JS)
+            return
+        if self.path == '/poll.json':
+            # Uncacheable long poll: headers at once, body half a second later
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.flush()
+            time.sleep(0.5)
+            self.wfile.write(b'{}')
+            return
+        if self.path == '/static/gated.js':
+            self.server.gate.wait(5)  # Held until the test has queued up its concurrent requests
+        if self.path == '/rev.js' and self.headers.get('If-None-Match') == '"r1"':
+            self.server.validators.append('"r1"')
+            self.send_response(304)
+            self.send_header('ETag', '"r1"')
+            self.end_headers()
+            return
+        if self.path == '/versioned':
+            # Agent Tab variant that carries an ETag and honours If-None-Match
+            self.server.validators.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+        if self.path in ('/', '/versioned'):
+            body, content_type = AGENT_TAB_HTML, 'text/html; charset=utf-8'
+        elif self.path == '/blob.bin':
+            body, content_type = BLOB, 'application/octet-stream'
+        elif self.path.endswith('/bundle.js'):
+            body, content_type = BUNDLE_JS, 'application/javascript'
+        else:
+            body, content_type = b'console.log("asset");', 'application/javascript'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/versioned':
+            self.send_header('ETag', '"v1"')
+        elif self.path == '/rev.js':
+            self.send_header('ETag', '"r1"')
+        elif self.path.startswith('/static/'):
+            self.send_header('Cache-Control', 'public, max-age=3600')
+            self.send_header('ETag', '"s1"')
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.upload_started.set()
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            request_body = b''
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return  # Proxy gave up on the upload (over the size limit)
+                size = int(line, 16)
+                request_body += self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+        else:
+            request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/StreamChat'):
+            # Envelope-framed Connect stream, with the second message split across two writes
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/connect+json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            stream = b''.join(CHAT_MESSAGES)
+            cut = len(CHAT_MESSAGES[0]) + 7
+            for piece in (stream[:cut], stream[cut:]):
+                self.wfile.write(b'%X\r\n%s\r\n' % (len(piece), piece))
+                self.wfile.flush()
+                time.sleep(0.05)
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        if self.path.endswith('/Stream'):
+            # Connect streaming responses arrive chunked, without a Content-Length
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/connect+json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for token in (b'hello ', b'from ', b'the agent'):
+                self.wfile.write(b'%X\r\n%s\r\n' % (len(token), token))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        body = json.dumps({
+            'echo': request_body.decode(),
+            'csrf': self.headers.get('x-codeium-csrf-token'),
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUpstreamServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.connections = 0
+        self.validators = []
+        self.paths = []
+        self.slow_release = threading.Event()
+        self.gate = threading.Event()
+        self.upload_started = threading.Event()
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+
+
+class QuietProxyHandler(tcp_forward.ProxyHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietAsyncProxy(async_forward.AsyncProxy):
+    def log_request(self, client_ip, start_line, status):
+        pass
+
+
+class ProxyTestMixin:
+    """Fake upstream plus routing globals pointed at it - subclasses start the proxy engine"""
+
+    @classmethod
+    def start_proxy(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def stop_proxy(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = FakeUpstreamServer()
+        threading.Thread(target=cls.upstream.serve_forever, daemon=True).start()
+        cls.proxy_port = cls.start_proxy()
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.saved_asset_cache = tcp_forward.ASSET_CACHE
+        tcp_forward.ASSET_CACHE = asset_cache.AssetCache(directory=cls.cache_dir)
+        tcp_forward.ASSET_CACHE.set_build('build-1')
+        cls.saved_routing_path = tcp_forward.ROUTING_STATE_PATH
+        tcp_forward.ROUTING_STATE_PATH = os.path.join(cls.cache_dir, 'routing.json')
+
+        cls.saved = (tcp_forward.UI_PORT, tcp_forward.ROUTING.current)
+        tcp_forward.UI_PORT = cls.proxy_port
+        tcp_forward.ROUTING.update(ui_target=('127.0.0.1', cls.upstream.server_address[1]),
+                                   lsp_port=cls.upstream.server_address[1], lsp_https=False, csrf_token='live-token')
+
+    @classmethod
+    def tearDownClass(cls):
+        tcp_forward.UI_PORT, saved_route = cls.saved
+        restore_routing(saved_route)
+        tcp_forward.ASSET_CACHE = cls.saved_asset_cache
+        tcp_forward.ROUTING_STATE_PATH = cls.saved_routing_path
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+        cls.stop_proxy()
+        cls.upstream.shutdown()
+        tcp_forward.UPSTREAM_POOL.flush()
+
+    def setUp(self):
+        tcp_forward.UPSTREAM_POOL.flush()
+        tcp_forward.HTML_CACHE.clear()
+        tcp_forward.ASSET_CACHE.purge()
+        self.upstream.connections = 0
+        self.upstream.validators = []
+        self.upstream.paths = []
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response, data
+
+    @unittest.skipUnless(os.path.isdir('/proc/net'), 'discovery reads /proc')
+    def test_language_server_restart_is_ridden_out(self):
+        sim = antigravity_sim.Simulator(ui_ports=(antigravity_sim.free_port(),), tokens_per_sec=0,
+                                        stream_tokens=1, asset_kb=1).start()
+        saved = tcp_forward.ROUTING.current
+        call = ('POST', '/exa.language_server_pb.LanguageServerService/GetStatus', b'{}',
+                {'Content-Type': 'application/json'})
+        try:
+            tcp_forward.ROUTING.update(lsp_port=sim.lsp_port, csrf_token=sim.csrf_token)
+            tcp_forward.ROUTING_REFRESHED = 0.0
+            self.assertEqual(self.request(*call)[0].status, 200)
+            sim.restart('lsp')  # Old port now refuses, and the old token is no longer accepted
+            response, data = self.request(*call)
+            self.assertEqual((response.status, data), (200, b'{}'))
+            route = tcp_forward.ROUTING.current
+            self.assertEqual((route.lsp_port, route.csrf_token), (sim.lsp_port, sim.csrf_token))
+            self.assertRegex(tcp_forward.METRICS.render().decode(), r'gravity_failover_seconds_count\{upstream="lsp"\} [1-9]')
+        finally:
+            restore_routing(saved)
+            tcp_forward.ASSET_CACHE.set_build('build-1')
+            sim.stop()
+
+    def test_routing_switch_lets_pinned_requests_drain(self):
+        other = FakeUpstreamServer()
+        threading.Thread(target=other.serve_forever, daemon=True).start()
+        self.addCleanup(other.shutdown)
+        saved = tcp_forward.ROUTING.current
+        self.upstream.slow_release.clear()
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        conn.request('GET', '/slow.js')
+        try:
+            deadline = time.monotonic() + 5
+            while tcp_forward.ROUTING.in_flight(saved.version) < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(tcp_forward.switch_routing(ui_target=('127.0.0.1', other.server_address[1])))
+            self.assertEqual(self.request('GET', '/app.js')[0].status, 200)  # New requests: new upstream
+            self.assertEqual(other.paths, ['/app.js'])
+            self.upstream.slow_release.set()
+            self.assertEqual(len(conn.getresponse().read()), 2 * len(BUNDLE_JS))  # Old one finished there
+            while tcp_forward.ROUTING.in_flight(saved.version) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            counts = tcp_forward.ROUTING.snapshot()
+            self.assertEqual(counts[saved.version]['in_flight'], 0)
+            self.assertEqual(counts[saved.version + 1]['requests'], 1)
+            self.assertIn(f'gravity_routing_requests_total{{version="{saved.version + 1}"}} 1',
+                          tcp_forward.METRICS.render().decode())
+        finally:
+            self.upstream.slow_release.set()
+            conn.close()
+            restore_routing(saved)
+
+    def test_warm_start_serves_saved_routing(self):
+        tcp_forward.save_routing()
+        self.assertEqual(os.stat(tcp_forward.ROUTING_STATE_PATH).st_mode & 0o777, 0o600)
+        live = tcp_forward.ROUTING.current
+        tcp_forward.ROUTING.update(ui_target=('127.0.0.1', 9), lsp_port=9, csrf_token=None)
+        self.assertTrue(tcp_forward.load_routing())
+        self.assertEqual(tcp_forward.ROUTING.current[1:], live[1:])
+        response, data = self.request('POST', '/exa.Service/Call', b'{}', {'Content-Type': 'application/json'})
+        self.assertEqual(json.loads(data)['csrf'], 'live-token')
+        self.assertIsNotNone(tcp_forward.FIRST_SERVED)
+        self.assertFalse(tcp_forward.load_routing(os.path.join(self.cache_dir, 'missing.json')))
+
+    def test_html_is_patched(self):
+        response, data = self.request('GET', '/')
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'crypto.randomUUID', data)
+        encoded = data.split(b"window.chatParams = '")[1].split(b"'")[0]
+        params = json.loads(base64.b64decode(encoded))
+        self.assertTrue(params['languageServerUrl'].endswith(f':{tcp_forward.LSP_PORT}/'))
+
+    def test_lsp_request_gets_csrf_token(self):
+        response, data = self.request('POST', '/exa.Service/Call', b'{"x":1}',
+                                      {'Content-Type': 'application/json'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(data), {'echo': '{"x":1}', 'csrf': 'live-token'})
+
+    def test_browser_connection_is_kept_alive(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        for path in ('/', '/app.js'):
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.version, 11)
+            self.assertFalse(response.will_close)
+        sock = conn.sock
+        conn.request('POST', '/exa.Service/Stream', b'{}')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(response.read(), b'hello from the agent')
+        conn.request('POST', '/exa.Service/Call', b'{}')
+        self.assertEqual(conn.getresponse().status, 200)
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+
+    def test_websocket_upgrade_is_tunneled(self):
+        opened = tcp_forward.TUNNEL_STATS['opened']
+        bytes_up = tcp_forward.TUNNEL_STATS['bytes_up']
+        sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+        sock.sendall(b'GET /ws HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+        received = b''
+        while b'welcome' not in received:
+            received += sock.recv(4096)
+        self.assertTrue(received.startswith(b'HTTP/1.1 101'))
+        for message in (b'ping', b'x' * 100000):
+            sock.sendall(message)
+            echoed = b''
+            while len(echoed) < len(message):
+                echoed += sock.recv(65536)
+            self.assertEqual(echoed, message)
+        sock.close()
+        for _ in range(50):
+            if tcp_forward.TUNNEL_STATS['bytes_up'] > bytes_up:
+                break
+            time.sleep(0.05)
+        self.assertEqual(tcp_forward.TUNNEL_STATS['opened'], opened + 1)
+        self.assertEqual(tcp_forward.TUNNEL_STATS['bytes_up'], bytes_up + 100004)
+
+    def test_reset_tunnel_is_accounted(self):
+        active = tcp_forward.TUNNEL_STATS['active']
+        sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+        sock.sendall(b'GET /ws-reset HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+        received = b''
+        while b'welcome' not in received:
+            received += sock.recv(4096)
+        try:
+            for _ in range(50):
+                sock.sendall(b'x' * 1000)  # Browser still writing while the upstream is gone
+                time.sleep(0.01)
+        except OSError:
+            pass
+        sock.close()
+        for _ in range(100):
+            if tcp_forward.TUNNEL_STATS['active'] == active:
+                break
+            time.sleep(0.02)
+        self.assertEqual(tcp_forward.TUNNEL_STATS['active'], active)
+
+    def test_chunked_request_body_is_forwarded(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        conn.request('POST', '/exa.Service/Call', iter([b'{"a":', b'2}']), encode_chunked=True)
+        self.assertEqual(json.loads(conn.getresponse().read())['echo'], '{"a":2}')
+        # The whole body was consumed, so the connection is still usable
+        conn.request('POST', '/exa.Service/Call', b'{}')
+        self.assertEqual(conn.getresponse().status, 200)
+        conn.close()
+
+    def test_large_request_body_is_forwarded(self):
+        payload = json.dumps({'prompt': 'x' * 300000})
+        response, data = self.request('POST', '/exa.Service/Call', payload.encode(),
+                                      {'Content-Type': 'application/json'})
+        self.assertEqual(json.loads(data)['echo'], payload)
+
+    def test_assets_are_streamed_not_buffered(self):
+        self.upstream.slow_release.clear()
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        conn.request('GET', '/slow.js')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Content-Length'), str(2 * len(BUNDLE_JS)))
+        self.assertEqual(response.read(len(BUNDLE_JS)), BUNDLE_JS)
+        self.upstream.slow_release.set()
+        self.assertEqual(response.read(), BUNDLE_JS)
+        conn.close()
+
+    def test_large_upload_streams_upstream(self):
+        self.upstream.upload_started.clear()
+        part = b'x' * (2 * tcp_forward.REQUEST_BUFFER_LIMIT)
+        sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+        sock.sendall(b'POST /exa.Service/Call HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n' % (2 * len(part))
+                     + part)
+        # The upstream has the request while half the body is still to come
+        self.assertTrue(self.upstream.upload_started.wait(5))
+        sock.sendall(part)
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        self.assertEqual(len(json.loads(response.read())['echo']), 2 * len(part))
+        sock.close()
+
+    def test_broken_upload_is_not_an_upstream_outage(self):
+        sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+        sock.sendall(b'POST /exa.Service/Call HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'2\r\n{}\r\nzz\r\n')
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        self.assertEqual(response.status, 400)
+        sock.close()
+        self.assertNotIn('lsp', tcp_forward.FAILOVER_WINDOWS)
+
+    def test_oversized_upload_is_refused_before_it_is_sent(self):
+        saved = tcp_forward.MAX_REQUEST_BODY
+        tcp_forward.MAX_REQUEST_BODY = 1000
+        try:
+            sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+            sock.sendall(b'POST /exa.Service/Call HTTP/1.1\r\nHost: x\r\nContent-Length: 5000\r\n'
+                         b'Expect: 100-continue\r\n\r\n')
+            head = sock.recv(4096)
+            self.assertTrue(head.startswith(b'HTTP/1.1 413'))
+            self.assertEqual(head.lower().count(b'connection: close'), 1)
+            sock.close()
+            # Chunked uploads are cut off once they pass the limit
+            conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+            conn.request('POST', '/exa.Service/Call', iter([b'x' * 600] * 3), encode_chunked=True)
+            self.assertEqual(conn.getresponse().status, 413)
+            conn.close()
+        finally:
+            tcp_forward.MAX_REQUEST_BODY = saved
+
+    def test_connect_stream_is_relayed_by_message(self):
+        streams = tcp_forward.CONNECT_STATS.snapshot()[0]['streams']
+        response, data = self.request('POST', '/exa.Chat/StreamChat', b'{}',
+                                      {'Content-Type': 'application/connect+json'})
+        self.assertEqual(data, b''.join(CHAT_MESSAGES))
+        totals, recent = tcp_forward.CONNECT_STATS.snapshot()
+        self.assertEqual(totals['streams'], streams + 1)
+        self.assertEqual((recent[-1]['messages'], recent[-1]['ended']), (2, True))
+
+    def test_expect_continue_is_answered(self):
+        sock = socket.create_connection(('127.0.0.1', self.proxy_port), timeout=5)
+        sock.sendall(b'POST /exa.Service/Call HTTP/1.1\r\nHost: x\r\nContent-Length: 7\r\n'
+                     b'Expect: 100-continue\r\n\r\n')
+        self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.1 100'))
+        sock.sendall(b'{"x":1}')
+        received = b''
+        while b'"csrf"' not in received:
+            received += sock.recv(4096)
+        self.assertIn(b'HTTP/1.1 200', received)
+        sock.close()
+
+
+class TestProxy(ProxyTestMixin, unittest.TestCase):
+    @classmethod
+    def start_proxy(cls):
+        cls.proxy = tcp_forward.ThreadedHTTPServer(('127.0.0.1', 0), QuietProxyHandler)
+        threading.Thread(target=cls.proxy.serve_forever, daemon=True).start()
+        return cls.proxy.server_address[1]
+
+    @classmethod
+    def stop_proxy(cls):
+        cls.proxy.shutdown()
+
+    def test_upstream_connections_are_reused(self):
+        for _ in range(5):
+            response, _ = self.request('GET', '/app.js')
+            self.assertEqual(response.status, 200)
+        for _ in range(3):
+            self.request('POST', '/exa.Service/Call', b'{}')
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(tcp_forward.UPSTREAM_POOL.idle_count(), 1)
+
+    def test_stale_pooled_connection_is_replaced(self):
+        self.request('GET', '/app.js')
+        # Simulate the IDE closing the idle keep-alive connection
+        for idle in tcp_forward.UPSTREAM_POOL._idle.values():
+            for conn, _ in idle:
+                conn.sock.shutdown(2)
+        response, data = self.request('GET', '/app.js')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(data, b'console.log("asset");')
+
+    def test_connection_closes_after_request_limit(self):
+        saved = tcp_forward.KEEPALIVE_MAX_REQUESTS
+        tcp_forward.KEEPALIVE_MAX_REQUESTS = 2
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+            conn.request('GET', '/app.js')
+            first = conn.getresponse()
+            first.read()
+            conn.request('GET', '/app.js')
+            second = conn.getresponse()
+            second.read()
+            self.assertFalse(first.will_close)
+            self.assertEqual(second.getheader('Connection'), 'close')
+            conn.close()
+        finally:
+            tcp_forward.KEEPALIVE_MAX_REQUESTS = saved
+
+    def test_flush_closes_idle_connections(self):
+        self.request('GET', '/app.js')
+        port = self.upstream.server_address[1]
+        self.assertEqual(tcp_forward.UPSTREAM_POOL.flush(port=port + 1), 0)
+        self.assertEqual(tcp_forward.UPSTREAM_POOL.flush(port=port), 1)
+        self.assertEqual(tcp_forward.UPSTREAM_POOL.idle_count(), 0)
+
+    def test_patched_html_is_cached_by_body_hash(self):
+        _, first = self.request('GET', '/')
+        hits = tcp_forward.HTML_CACHE.stats['hits']
+        response, second = self.request('GET', '/')
+        self.assertEqual(second, first)
+        self.assertEqual(tcp_forward.HTML_CACHE.stats['hits'], hits + 1)
+        etag = response.getheader('ETag')
+        self.assertTrue(etag.startswith('"gr-'))
+        response, data = self.request('GET', '/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(data, b'')
+
+    def test_upstream_etag_is_revalidated(self):
+        response, first = self.request('GET', '/versioned')
+        etag = response.getheader('ETag')
+        self.assertNotEqual(etag, '"v1"')
+        response, data = self.request('GET', '/versioned')
+        self.assertEqual((response.status, data), (200, first))
+        response, _ = self.request('GET', '/versioned', headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        # First fetch unconditional, then the upstream's own validator - never ours
+        self.assertEqual(self.upstream.validators, [None, '"v1"', '"v1"'])
+
+    def test_routing_change_changes_the_document(self):
+        response, _ = self.request('GET', '/')
+        response, _ = self.request('GET', '/')
+        etag = response.getheader('ETag')
+        saved = tcp_forward.ROUTING.current
+        tcp_forward.ROUTING.update(external_ip='192.0.2.7')
+        try:
+            response, data = self.request('GET', '/', headers={'If-None-Match': etag})
+        finally:
+            restore_routing(saved)
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'192.0.2.7', base64.b64decode(data.split(b"window.chatParams = '")[1].split(b"'")[0]))
+
+    def test_text_responses_are_compressed_once(self):
+        before = dict(tcp_forward.COMPRESSION.stats)
+        for _ in range(3):
+            response, data = self.request('GET', '/static/bundle.js', headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+            self.assertEqual(response.getheader('ETag'), '"s1-gr-gzip"')
+            self.assertEqual(zlib.decompress(data, 31), BUNDLE_JS)
+        self.assertEqual(tcp_forward.COMPRESSION.stats['responses'], before['responses'] + 1)
+        self.assertEqual(tcp_forward.COMPRESSION.stats['cache_hits'], before['cache_hits'] + 2)
+        # Too small to bother, and clients that did not ask get identity
+        response, data = self.request('GET', '/app.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        response, data = self.request('GET', '/bundle.js')
+        self.assertEqual(data, BUNDLE_JS)
+
+    def test_agent_tab_is_compressed_and_streamed(self):
+        for _ in range(2):  # streamed on the first load, served from the patch cache after
+            response, data = self.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            self.assertIn(b'crypto.randomUUID', zlib.decompress(data, 31))
+        etag = response.getheader('ETag')
+        self.assertTrue(etag.endswith('-gr-gzip"'))
+        response, _ = self.request('GET', '/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader('ETag'), etag)
+
+    def test_fresh_assets_are_served_from_memory_then_disk(self):
+        for _ in range(3):
+            response, data = self.request('GET', '/static/app.css')
+            self.assertEqual((response.status, response.getheader('ETag')), (200, '"s1"'))
+        self.assertEqual(self.upstream.paths, ['/static/app.css'])
+        # A restarted proxy (same IDE build) starts warm from the disk tier
+        restarted = asset_cache.AssetCache(directory=self.cache_dir)
+        self.assertFalse(restarted.set_build('build-1'))
+        self.assertEqual(restarted.get('/static/app.css').body, b'console.log("asset");')
+        # A new IDE build purges both tiers
+        self.assertTrue(restarted.set_build('build-2'))
+        self.assertIsNone(restarted.get('/static/app.css'))
+
+    def test_stale_assets_are_revalidated(self):
+        for _ in range(2):
+            response, data = self.request('GET', '/rev.js')
+            self.assertEqual((response.status, data), (200, b'console.log("asset");'))
+        self.assertEqual(self.upstream.validators, ['"r1"'])
+        response, _ = self.request('GET', '/rev.js', headers={'If-None-Match': '"r1"'})
+        self.assertEqual(response.status, 304)
+
+    @unittest.skipUnless(zerocopy.SPLICE_ENABLED, 'os.splice not available')
+    def test_large_passthrough_body_is_spliced(self):
+        bodies = zerocopy.STATS['bodies']
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port, timeout=5)
+        for _ in range(2):  # same browser connection stays usable afterwards
+            conn.request('GET', '/blob.bin')
+            response = conn.getresponse()
+            self.assertEqual(response.read(), BLOB)
+        conn.close()
+        for _ in range(50):  # Counted once the last splice returns, which can be after the client has read it
+            if zerocopy.STATS['bodies'] == bodies + 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(zerocopy.STATS['bodies'], bodies + 2)
+        self.assertEqual(self.upstream.connections, 1)
+
+    def test_saturated_pool_sheds_with_503(self):
+        class Server(tcp_forward.ThreadedHTTPServer):
+            pool = worker_pool.WorkerPool(size=1, queue_size=1, name='test')
+        server = Server(('127.0.0.1', 0), QuietProxyHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        self.upstream.slow_release.clear()
+        try:
+            busy = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            busy.request('GET', '/slow.js')
+            held = busy.getresponse()  # The only worker is now inside this response
+            waiting = socket.create_connection(('127.0.0.1', port))  # Takes the only queue slot
+            deadline = time.time() + 5
+            while Server.pool.queued() != 1 and time.time() < deadline:
+                time.sleep(0.01)
+            shed = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            shed.request('GET', '/')
+            response = shed.getresponse()
+            self.assertEqual(response.status, 503)
+            self.assertEqual(response.getheader('Retry-After'), str(worker_pool.SHED_RETRY_AFTER))
+            self.assertEqual(Server.pool.snapshot()['shed'], 1)
+            self.upstream.slow_release.set()
+            self.assertEqual(len(held.read()), 2 * len(BUNDLE_JS))
+            busy.close()
+            waiting.close()
+            shed.close()
+        finally:
+            self.upstream.slow_release.set()
+            server.shutdown()
+            server.server_close()
+
+    @unittest.skipUnless(zerocopy.SPLICE_ENABLED, 'os.splice not available')
+    def test_splice_fallback_counts_every_byte(self):
+        def bytes_out():
+            match = re.search(r'gravity_bytes_out_total\{route="ui"\} (\d+)', tcp_forward.METRICS.render().decode())
+            return int(match.group(1)) if match else 0
+
+        def refuse(*args, **kwargs):
+            raise zerocopy.SpliceUnsupported('refused')
+        original, zerocopy.splice_socket = zerocopy.splice_socket, refuse
+        try:
+            before = bytes_out()
+            response, data = self.request('GET', '/blob.bin')
+            self.assertEqual(data, BLOB)
+            deadline = time.time() + 5
+            while bytes_out() < before + len(BLOB) and time.time() < deadline:
+                time.sleep(0.01)  # Counted once the handler is done
+            self.assertGreater(bytes_out() - before, len(BLOB))  # Body plus headers
+        finally:
+            zerocopy.splice_socket = original
+
+    def start_pooled_server(self, **pool_args):
+        class Server(tcp_forward.ThreadedHTTPServer):
+            pool = worker_pool.WorkerPool(name='test', **pool_args)
+        server = Server(('127.0.0.1', 0), QuietProxyHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_idle_keepalive_gives_worker_back_to_queue(self):
+        server = self.start_pooled_server(size=1, queue_size=4)
+        port = server.server_address[1]
+        original, tcp_forward.KEEPALIVE_BUSY_TIMEOUT = tcp_forward.KEEPALIVE_BUSY_TIMEOUT, 0.5
+        try:
+            idle = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            idle.request('GET', '/app.js')
+            idle.getresponse().read()
+            time.sleep(0.2)  # The only worker is now waiting for this connection's next request
+            started = time.monotonic()
+            other = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            other.request('GET', '/app.js')
+            self.assertEqual(other.getresponse().status, 200)
+            self.assertLess(time.monotonic() - started, 3)
+            idle.close()
+            other.close()
+        finally:
+            tcp_forward.KEEPALIVE_BUSY_TIMEOUT = original
+
+    def test_tunnel_does_not_hold_a_worker(self):
+        server = self.start_pooled_server(size=1, queue_size=4, stream_threads=1)
+        port = server.server_address[1]
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall(b'GET /ws HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+        received = b''
+        while b'welcome' not in received:
+            received += sock.recv(4096)
+        deadline = time.time() + 5
+        while not server.pool.snapshot()['detached'] and time.time() < deadline:
+            time.sleep(0.01)  # The tunnel detaches just after passing the 101 on
+        self.assertEqual(server.pool.snapshot()['detached'], 1)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/app.js', headers={'Connection': 'close'})
+        self.assertEqual(conn.getresponse().status, 200)
+        conn.close()
+        sock.close()
+        deadline = time.time() + 5
+        while server.pool.snapshot()['detached'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(server.pool.snapshot()['detached'], 0)
+
+    def test_metrics_endpoint(self):
+        self.request('GET', '/app.js')
+        self.request('POST', '/exa.Service/Call', b'{"x":1}', {'Content-Type': 'application/json'})
+        response, data = self.request('GET', tcp_forward.METRICS_PATH)
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.getheader('Content-Type').startswith('text/plain; version=0.0.4'))
+        text = data.decode()
+        self.assertIn('# TYPE gravity_request_duration_seconds histogram', text)
+        self.assertRegex(text, r'gravity_requests_total\{route="ui",status="200"\} \d+')
+        self.assertRegex(text, r'gravity_upstream_ttfb_seconds_count\{route="lsp"\} [1-9]')
+        self.assertRegex(text, r'gravity_bytes_in_total\{route="lsp"\} [1-9]')
+        self.assertIn('gravity_worker_pool{state="size"}', text)
+        # Scrapes are not forwarded upstream
+        self.assertNotIn(tcp_forward.METRICS_PATH, self.upstream.paths)
+
+    def test_slow_request_log(self):
+        path = os.path.join(self.cache_dir, 'slow.jsonl')
+        log = request_timing.SlowRequestLog(path, threshold=0, sample_rate=1.0)
+        original, tcp_forward.SLOW_LOG = tcp_forward.SLOW_LOG, log
+        try:
+            self.request('POST', '/exa.Service/Call', b'{"x":1}', {'Content-Type': 'application/json'})
+            # Logged once the handler is done, which can be just after the client has its answer
+            deadline = time.time() + 5
+            while not log.stats['slow'] and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(log.sink.flush())
+        finally:
+            tcp_forward.SLOW_LOG = original
+        with open(path) as f:
+            entry = json.loads(f.readline())
+        self.assertEqual((entry['route'], entry['status'], entry['method']), ('lsp', 200, 'POST'))
+        self.assertEqual(entry['bytes_in'], 7)
+        self.assertGreater(entry['bytes_out'], 0)
+        self.assertIn('ttfb', entry['phases_ms'])
+        self.assertIn('client_write', entry['phases_ms'])
+        self.assertAlmostEqual(sum(entry['phases_ms'].values()), entry['total_ms'], delta=1)
+
+    def test_concurrent_identical_gets_share_one_fetch(self):
+        self.upstream.gate.clear()
+        saved = tcp_forward.FLIGHTS.summary()['saved']
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.request('GET', '/static/gated.js')))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 5
+        while tcp_forward.FLIGHTS.in_flight() != (1, 4) and time.time() < deadline:
+            time.sleep(0.01)
+        self.upstream.gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.upstream.paths, ['/static/gated.js'])
+        self.assertEqual([(r.status, data) for r, data in results], [(200, b'console.log("asset");')] * 5)
+        self.assertEqual(tcp_forward.FLIGHTS.summary()['saved'] - saved, 4)
+
+    def test_uncacheable_gets_do_not_wait_for_each_other(self):
+        timings = []
+
+        def fetch():
+            started = time.monotonic()
+            response, data = self.request('GET', '/poll.json')
+            timings.append((response.status, data, time.monotonic() - started))
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([t[:2] for t in timings], [(200, b'{}')] * 3)
+        self.assertLess(max(t[2] for t in timings), 0.9)  # Not one long poll after another
+
+    def test_not_found_is_cached_briefly(self):
+        for _ in range(3):
+            response, _ = self.request('GET', '/missing.png')
+            self.assertEqual(response.status, 404)
+        self.assertEqual(self.upstream.paths, ['/missing.png'])
+
+    def test_lsp_responses_are_not_compressed(self):
+        response, data = self.request('POST', '/exa.Service/Call', b'{"x":1}' * 400, {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(json.loads(data)['csrf'], 'live-token')
+
+
+class TestAsyncProxy(ProxyTestMixin, unittest.TestCase):
+    @classmethod
+    def start_proxy(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.engine = QuietAsyncProxy()
+        started = threading.Event()
+        ports = []
+
+        def ready(servers):
+            ports.append(servers[0].sockets[0].getsockname()[1])
+            started.set()
+
+        def run():
+            asyncio.set_event_loop(cls.loop)
+            try:
+                cls.loop.run_until_complete(async_forward.serve([0], host='127.0.0.1', proxy=cls.engine, ready=ready))
+            except asyncio.CancelledError:
+                pass
+
+        cls.thread = threading.Thread(target=run, daemon=True)
+        cls.thread.start()
+        started.wait(5)
+        return ports[0]
+
+    @classmethod
+    def stop_proxy(cls):
+        def cancel_all():
+            for task in asyncio.all_tasks(cls.loop):
+                task.cancel()
+        cls.loop.call_soon_threadsafe(cancel_all)
+        cls.thread.join(5)
+
+    def setUp(self):
+        super().setUp()
+        # Drop idle upstream connections left by earlier tests (on the loop's own thread)
+        done = threading.Event()
+        self.loop.call_soon_threadsafe(lambda: (self.engine.pool.evict(live_ports=set()), done.set()))
+        done.wait(5)
+
+    def test_upstream_connections_are_reused(self):
+        for _ in range(4):
+            response, _ = self.request('GET', '/app.js')
+            self.assertEqual(response.status, 200)
+        self.request('POST', '/exa.Service/Call', b'{}')
+        self.assertEqual(self.upstream.connections, 1)
+
+    def test_metrics_endpoint(self):
+        self.request('GET', '/app.js')
+        response, data = self.request('GET', tcp_forward.METRICS_PATH)
+        self.assertEqual(response.status, 200)
+        self.assertRegex(data.decode(), r'gravity_requests_total\{route="ui",status="200"\} \d+')
+        self.assertNotIn(tcp_forward.METRICS_PATH, self.upstream.paths)
+
+
+class TestHTMLRewriter(unittest.TestCase):
+    def patch_in_pieces(self, document, size, mobile=False):
+        patcher = tcp_forward.html_patcher(mobile=mobile, incoming_port=tcp_forward.UI_PORT)
+        out = b''.join(patcher.feed(document[i:i + size]) for i in range(0, len(document), size))
+        return out + patcher.close()
+
+    def test_any_chunking_matches_whole_document(self):
+        expected = tcp_forward.patch_html(AGENT_TAB_HTML, mobile=True, incoming_port=tcp_forward.UI_PORT)
+        self.assertIn(tcp_forward.MOBILE_CSS, expected)
+        for size in (1, 2, 3, 7, 16, 64, len(AGENT_TAB_HTML)):
+            self.assertEqual(self.patch_in_pieces(AGENT_TAB_HTML, size, mobile=True), expected)
+
+    def test_first_bytes_are_not_held_back(self):
+        patcher = tcp_forward.html_patcher()
+        first = patcher.feed(b'<!DOCTYPE html><html><head><title>Agent</title>')
+        self.assertTrue(first.startswith(b'<!DOCTYPE html><html><head>' + tcp_forward.CRYPTO_POLYFILL))
+
+    def test_body_fallback_and_unrelated_assignments(self):
+        document = b"<html><body><script>window.chatParams = JSON.parse(x);</script></body></html>"
+        patched = self.patch_in_pieces(document, 5)
+        self.assertEqual(patched, document.replace(b'<body', tcp_forward.CRYPTO_POLYFILL + b'<body'))
+
+
+class TestConnectRelay(unittest.TestCase):
+    def test_only_whole_messages_are_released(self):
+        stream = b''.join(CHAT_MESSAGES)
+        for size in (1, 3, 5, 8, len(stream)):
+            relay = connect_relay.EnvelopeRelay()
+            out = []
+            for i in range(0, len(stream), size):
+                piece = relay.feed(stream[i:i + size])
+                if piece:
+                    out.append(piece)
+            self.assertEqual(b''.join(out) + relay.close(), stream)
+            # Every write boundary falls on an envelope boundary
+            boundaries = {len(CHAT_MESSAGES[0]), len(CHAT_MESSAGES[0]) + len(CHAT_MESSAGES[1]), len(stream)}
+            self.assertTrue({len(b''.join(out[:i + 1])) for i in range(len(out))} <= boundaries)
+            self.assertEqual((relay.messages, relay.ended), (2, True))
+
+    def test_unframed_body_passes_through(self):
+        relay = connect_relay.EnvelopeRelay()
+        self.assertEqual(relay.feed(b'hello '), b'hello ')
+        self.assertTrue(relay.passthrough)
+        self.assertEqual(relay.feed(b'world') + relay.close(), b'world')
+
+    def test_content_types(self):
+        self.assertTrue(connect_relay.is_connect_stream('application/connect+proto'))
+        self.assertTrue(connect_relay.is_connect_stream('application/grpc-web+proto; charset=x'))
+        self.assertFalse(connect_relay.is_connect_stream('application/grpc-web-text'))
+        self.assertFalse(connect_relay.is_connect_stream('application/json'))
+
+
+class TestAsyncLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'proxy.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return f.read()
+
+    def test_level_filter_and_raw_lines(self):
+        log = gravity_log.AsyncLog(self.path, level='WARNING')
+        log.info('[REQ] hidden')
+        log.error('[ERROR] shown')
+        log.write('{"raw": true}')
+        self.assertTrue(log.flush())
+        text = self.read()
+        self.assertNotIn('hidden', text)
+        self.assertRegex(text, r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d \[ERROR\] shown\n')
+        self.assertIn('{"raw": true}\n', text)
+
+    def test_repeats_are_folded(self):
+        log = gravity_log.AsyncLog(self.path, repeat_burst=3, repeat_window=0.2)
+        for _ in range(10):
+            log.error('[ERROR] Connection refused')
+        log.info('[HEALTH] other')
+        self.assertTrue(log.flush())
+        self.assertEqual(self.read().count('Connection refused'), 3)
+        self.assertEqual(log.stats['suppressed'], 7)
+        time.sleep(0.25)
+        log.error('[ERROR] Connection refused')
+        self.assertTrue(log.flush())
+        self.assertIn('repeated 7 more times', self.read())
+
+    def test_rotation(self):
+        log = gravity_log.AsyncLog(self.path, max_bytes=200, backups=2, repeat_burst=0)
+        for i in range(20):
+            log.info(f'[REQ] line {i:02} ' + 'x' * 40)
+            self.assertTrue(log.flush())
+        self.assertEqual(sorted(os.listdir(self.dir)), ['proxy.log', 'proxy.log.1', 'proxy.log.2'])
+        self.assertLessEqual(os.path.getsize(self.path), 200)
+        self.assertIn('line 19', self.read())
+        self.assertGreater(log.stats['rotations'], 2)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        log = gravity_log.AsyncLog(self.path, queue_size=1)
+        log._thread = threading.current_thread()  # No writer: the queue never drains
+        started = time.perf_counter()
+        for _ in range(5):
+            log.info('[REQ] x')
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(log.stats['dropped'], 4)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_samples_from_all_threads_are_summed(self):
+        registry = metrics.Registry()
+        registry.counter('hits_total', 'Hits')
+        registry.histogram('wait_seconds', 'Waits', buckets=(0.1, 1))
+
+        def record():
+            registry.inc('hits_total', (('route', 'ui'),))
+            registry.observe('wait_seconds', 0.5)
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        registry.observe('wait_seconds', 0.1)
+        text = registry.render().decode()
+        self.assertIn('hits_total{route="ui"} 4', text)
+        self.assertIn('wait_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('wait_seconds_bucket{le="1"} 5', text)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 5', text)
+        self.assertIn('wait_seconds_sum 2.1', text)
+        # Exited threads leave their counts behind, not their shards
+        self.assertEqual(len(registry._shards), 1)
+        self.assertEqual(registry.render().decode(), text)
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_versions_leases_and_counts(self):
+        table = routing.RoutingTable(lsp_port=1000, csrf_token='a')
+        lease = table.pin()
+        old, new = table.update(lsp_port=2000, csrf_token='b')
+        self.assertEqual((old.version, new.version), (1, 2))
+        self.assertEqual(table.update(lsp_port=2000), (new, new))  # No change, no new version
+        self.assertEqual((lease.route.lsp_port, lease.route.csrf_token), (1000, 'a'))  # Pinned whole
+        self.assertEqual(lease.renew(), new)
+        self.assertEqual(table.snapshot(), {1: {'requests': 1, 'in_flight': 0}, 2: {'requests': 1, 'in_flight': 1}})
+        lease.release()
+        lease.release()  # Once only
+        self.assertEqual(table.in_flight(2), 0)
+        for port in range(3000, 3020):
+            table.update(lsp_port=port)
+        self.assertEqual(len(table.snapshot()), routing.ROUTING_HISTORY)
+
+
+class TestAssetCache(unittest.TestCase):
+    def test_disk_total_is_kept_and_trimmed_past_limit(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        cache = asset_cache.AssetCache(directory=directory, disk_max=10000)
+        cache.set_build('b1')
+        trims = []
+        trim = cache._trim_disk
+        cache._trim_disk = lambda: (trims.append(1), trim())
+
+        def on_disk():
+            return sum(size for _, size, _ in cache._disk_files())
+        headers = [('Cache-Control', 'max-age=60')]
+        for i in range(4):
+            cache.store(f'/a{i}.js', 200, headers, b'x' * 2000)
+        cache.store('/a0.js', 200, headers, b'y' * 1000)  # Replaced, not added
+        cache.forget('/a1.js')
+        self.assertEqual(cache._disk_bytes, on_disk())
+        self.assertEqual(trims, [])
+        for i in range(4, 8):
+            cache.store(f'/a{i}.js', 200, headers, b'x' * 2000)
+        self.assertEqual(trims, [1])
+        self.assertEqual(cache._disk_bytes, on_disk())
+        self.assertLessEqual(on_disk(), 10000)
+
+    def test_no_store_and_private_are_never_kept(self):
+        self.assertTrue(asset_cache.AssetCache.may_store(404, []))
+        for value in ('no-store', 'private, max-age=60'):
+            headers = [('Cache-Control', value)]
+            self.assertFalse(asset_cache.AssetCache.may_store(404, headers))
+            self.assertFalse(asset_cache.AssetCache.may_store(200, headers + [('ETag', '"e"')]))
+
+
+class TestCompression(unittest.TestCase):
+    def test_only_proxy_etags_lose_their_encoding(self):
+        ours = compression.encoded_etag('"abc"', 'gzip')
+        self.assertEqual(compression.strip_etag_encoding(ours), '"abc"')
+        # The IDE's own validators pass through, even when they look like an encoded variant
+        self.assertEqual(compression.strip_etag_encoding('"build-gzip"'), '"build-gzip"')
+        mixed = 'W/"v-br", ' + compression.encoded_etag('"x"', 'br')
+        self.assertEqual(compression.strip_etag_encoding(mixed), 'W/"v-br", "x"')
+
+    def test_vary_lists_accept_encoding_once(self):
+        self.assertEqual(compression.vary_with_encoding(None), 'Accept-Encoding')
+        self.assertEqual(compression.vary_with_encoding('Origin'), 'Origin, Accept-Encoding')
+        self.assertEqual(compression.vary_with_encoding('origin, accept-encoding'), 'origin, accept-encoding')
+        self.assertEqual(compression.vary_with_encoding('*'), '*')
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    def queue_bulk(self, sched, client, order):
+        """Start a bulk admission in a thread and return once it is waiting"""
+        waiting = sched.snapshot()['waiting']
+
+        def run():
+            ticket = sched.admit(scheduler.BULK, client)
+            order.append(client)
+            sched.release(ticket)
+        threading.Thread(target=run, daemon=True).start()
+        deadline = time.time() + 5
+        while sched.snapshot()['waiting'] == waiting and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_bulk_is_admitted_round_robin_per_client(self):
+        sched = scheduler.PriorityScheduler(bulk_slots=1, enabled=True)
+        held = sched.admit(scheduler.BULK, 'phone')
+        order = []
+        for client in ('laptop', 'laptop', 'laptop', 'phone'):
+            self.queue_bulk(sched, client, order)
+        sched.release(held)
+        deadline = time.time() + 5
+        while len(order) < 4 and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(order, ['laptop', 'phone', 'laptop', 'laptop'])
+
+    def test_lsp_traffic_is_never_held_back(self):
+        sched = scheduler.PriorityScheduler(bulk_slots=1, busy_slots=0, enabled=True)
+        bulk = sched.admit(scheduler.BULK, 'laptop')
+        rpc = sched.admit(scheduler.INTERACTIVE, 'phone')
+        stream = sched.admit(scheduler.STREAM, 'phone')
+        self.assertEqual(sched.snapshot()['active'], {'interactive': 1, 'stream': 1, 'bulk': 1})
+        for ticket in (bulk, rpc, stream):
+            sched.release(ticket)
+
+    def test_release_is_idempotent(self):
+        sched = scheduler.PriorityScheduler(bulk_slots=1, enabled=True)
+        first = sched.admit(scheduler.BULK, 'laptop')
+        sched.release(first)
+        second = sched.admit(scheduler.BULK, 'phone')
+        sched.release(first)  # Early release, then the handler's finally - must not free the phone's slot
+        self.assertEqual(sched.snapshot()['active']['bulk'], 1)
+        sched.release(second)
+        self.assertEqual(sched.snapshot()['active']['bulk'], 0)
+
+    def test_request_classes(self):
+        self.assertEqual(scheduler.request_priority('/app.js', False), scheduler.BULK)
+        self.assertEqual(scheduler.request_priority('/exa.Svc/CancelCascade', True, 'application/json'),
+                         scheduler.INTERACTIVE)
+        self.assertEqual(scheduler.request_priority('/exa.Svc/StreamCascade', True, 'application/connect+json'),
+                         scheduler.STREAM)
+
+
+@unittest.skipUnless(os.path.isdir('/proc/net'), 'discovery reads /proc')
+class TestSimulator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = antigravity_sim.Simulator(ui_ports=(antigravity_sim.free_port(),), tokens_per_sec=0,
+                                            stream_tokens=3, asset_kb=1).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sim.stop()
+
+    def lsp_call(self, method, token, content_type='application/json'):
+        conn = http.client.HTTPConnection('127.0.0.1', self.sim.lsp_port, timeout=5)
+        conn.request('POST', f'/exa.language_server_pb.LanguageServerService/{method}', b'{}',
+                     {'Content-Type': content_type, 'x-codeium-csrf-token': token})
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_discovery_finds_the_simulated_language_server(self):
+        self.assertEqual(tcp_forward.find_csrf_token(), self.sim.csrf_token)
+        self.assertEqual(tcp_forward.find_lsp_port(), self.sim.lsp_port)  # Not the extension server port
+        self.assertFalse(tcp_forward.probe_lsp_protocol(self.sim.lsp_port))
+        conn = http.client.HTTPConnection('127.0.0.1', self.sim.ui_port, timeout=5)
+        conn.request('GET', '/')
+        html = conn.getresponse().read()
+        b64 = html.split(b"window.chatParams = '")[1].split(b"'")[0]
+        self.assertEqual(json.loads(base64.b64decode(b64))['csrfToken'], self.sim.csrf_token)
+
+    def test_proc_discovery(self):
+        finder = discovery.Discovery()
+        server = finder.find_language_server()
+        self.assertEqual((server.pid, server.csrf_token, server.workspace_id),
+                         (self.sim.process.pid, self.sim.csrf_token, antigravity_sim.WORKSPACE_ID))
+        self.assertEqual(sorted(server.ports), sorted([self.sim.lsp_port, self.sim.extension_port]))
+        parsed = finder.stats['parsed']
+        self.assertEqual(finder.find_language_server().pid, server.pid)
+        self.assertLess(finder.stats['parsed'] - parsed, 5)  # Command lines come from the cache
+
+    def test_ports_are_probed_together(self):
+        dead = antigravity_sim.free_port()
+        silent = socket.socket()  # Accepts connections but never answers
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        self.addCleanup(silent.close)
+        started = time.monotonic()
+        target = port_probe.find_lsp_target([dead, self.sim.extension_port, self.sim.lsp_port,
+                                             silent.getsockname()[1]])
+        self.assertEqual(target, (self.sim.lsp_port, False))
+        self.assertEqual(port_probe.find_ide_port([dead, self.sim.ui_port, self.sim.lsp_port]), self.sim.ui_port)
+        self.assertLess(time.monotonic() - started, 0.5)  # Decided without waiting on the silent port
+        self.assertIsNone(port_probe.find_lsp_target([dead, silent.getsockname()[1]], timeout=0.2))
+
+    def test_stream_csrf_and_restart(self):
+        status, data = self.lsp_call('StreamCascade', self.sim.csrf_token, 'application/connect+json')
+        self.assertEqual(status, 200)
+        relay = connect_relay.EnvelopeRelay()
+        relay.feed(data)
+        self.assertEqual((relay.messages, relay.ended), (3, True))
+        self.assertEqual(self.lsp_call('GetStatus', 'wrong')[0], 403)
+        old_port, old_token = self.sim.lsp_port, self.sim.csrf_token
+        self.sim.restart('lsp')
+        self.assertNotEqual((self.sim.lsp_port, self.sim.csrf_token), (old_port, old_token))
+        self.assertEqual(tcp_forward.find_csrf_token(), self.sim.csrf_token)
+        self.assertEqual(self.lsp_call('GetStatus', self.sim.csrf_token), (200, b'{}'))
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to make a test certificate')
+class TestTLSResumption(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cert, key = os.path.join(cls.tmpdir, 'cert.pem'), os.path.join(cls.tmpdir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key,
+                        '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1'],
+                       capture_output=True, check=True)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        cls.upstream = FakeUpstreamServer()
+        cls.upstream.socket = context.wrap_socket(cls.upstream.socket, server_side=True)
+        threading.Thread(target=cls.upstream.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.upstream.shutdown()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_sessions_are_resumed_across_connections(self):
+        port = self.upstream.server_address[1]
+        sessions = upstream_pool.TLSSessionCache()
+        for _ in range(3):
+            conn = upstream_pool.ResumingHTTPSConnection('127.0.0.1', port, timeout=5, session_cache=sessions)
+            conn.request('GET', '/app.js')
+            conn.getresponse().read()
+            conn.remember_session()
+            conn.close()
+        self.assertEqual(sessions.stats()['handshakes'], 3)
+        self.assertEqual(sessions.stats()['resumed'], 2)
+
+    def test_probes_are_not_counted_as_handshakes(self):
+        before = upstream_pool.TLS_SESSIONS.stats()['handshakes']
+        self.assertTrue(port_probe.probe_https(self.upstream.server_address[1], 5))
+        self.assertEqual(upstream_pool.TLS_SESSIONS.stats()['handshakes'], before)
+
+    def test_context_is_shared(self):
+        self.assertIs(upstream_pool.lsp_ssl_context(), upstream_pool.lsp_ssl_context())
+        self.assertTrue(tcp_forward.probe_lsp_protocol(self.upstream.server_address[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
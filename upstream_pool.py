@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Upstream connection pool for tcp_forward.py
+- Keeps idle keep-alive connections to the Agent Tab and language_server
+- Keyed by (scheme, host, port) so HTTP and HTTPS never mix
+- Evicts idle connections and drops ones the upstream has closed
+- One shared TLS client context with session resumption for the HTTPS language_server
+"""
+import http.client
+import select
+import ssl
+import threading
+import time
+
+POOL_MAX_IDLE_PER_TARGET = 8   # Idle connections kept per (scheme, host, port)
+POOL_IDLE_TIMEOUT = 30         # Seconds an idle connection may sit in the pool
+
+
+_LSP_SSL_CONTEXT = None
+_LSP_SSL_CONTEXT_LOCK = threading.Lock()
+
+
+def lsp_ssl_context():
+    """Client context for the language_server's self-signed cert - built once per process"""
+    global _LSP_SSL_CONTEXT
+    if _LSP_SSL_CONTEXT is None:
+        with _LSP_SSL_CONTEXT_LOCK:
+            if _LSP_SSL_CONTEXT is None:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                _LSP_SSL_CONTEXT = context
+    return _LSP_SSL_CONTEXT
+
+
+class TLSSessionCache:
+    """Last TLS session per (host, port), offered on the next handshake to skip the full exchange"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def get(self, host, port):
+        with self._lock:
+            return self._sessions.get((host, port))
+
+    def remember(self, host, port, sock):
+        # TLS 1.3 tickets arrive after the handshake, so this is called once data has been read
+        session = getattr(sock, 'session', None)
+        if session is not None and (session.has_ticket or session.id):
+            with self._lock:
+                self._sessions[(host, port)] = session
+
+    def record_handshake(self, sock):
+        with self._lock:
+            self.handshakes += 1
+            if sock.session_reused:
+                self.resumed += 1
+
+    def forget(self, host=None, port=None):
+        with self._lock:
+            for key in list(self._sessions):
+                if (host is None or key[0] == host) and (port is None or key[1] == port):
+                    del self._sessions[key]
+
+    def stats(self):
+        with self._lock:
+            rate = (self.resumed / self.handshakes) if self.handshakes else 0.0
+            return {'handshakes': self.handshakes, 'resumed': self.resumed, 'hit_rate': rate}
+
+
+TLS_SESSIONS = TLSSessionCache()
+
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that resumes the cached TLS session for its host:port
+    (count=False keeps its handshakes out of the resumption stats, e.g. for port probes)"""
+
+    def __init__(self, host, port=None, session_cache=TLS_SESSIONS, count=True, **kwargs):
+        kwargs.setdefault('context', lsp_ssl_context())
+        super().__init__(host, port, **kwargs)
+        self.session_cache = session_cache
+        self.count = count
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        session = self.session_cache.get(self.host, self.port)
+        try:
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+        except ssl.SSLError:
+            if session is None:
+                raise
+            # Stale session from a restarted language_server - retry with a full handshake
+            self.session_cache.forget(self.host, self.port)
+            http.client.HTTPConnection.connect(self)
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+        if self.count:
+            self.session_cache.record_handshake(self.sock)
+
+    def remember_session(self):
+        if self.sock is not None:
+            self.session_cache.remember(self.host, self.port, self.sock)
+
+
+def connection_is_alive(conn):
+    """An idle connection is healthy if the peer has not closed it or sent stray data"""
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    # Nothing should arrive on an idle HTTP connection - readable means EOF or junk
+    return not readable
+
+
+class UpstreamPool:
+    """Per-target pool of persistent http.client connections"""
+
+    def __init__(self, max_idle_per_target=POOL_MAX_IDLE_PER_TARGET, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle_per_target = max_idle_per_target
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # (scheme, host, port) -> [(conn, last_used), ...]
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'discarded': 0}
+
+    @staticmethod
+    def key(host, port, https=False):
+        return ('https' if https else 'http', host, port)
+
+    def _new_connection(self, host, port, https, timeout):
+        if https:
+            return ResumingHTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def acquire(self, host, port, https=False, timeout=600, fresh=False):
+        """Return (conn, reused) - an idle pooled connection if a healthy one exists"""
+        key = self.key(host, port, https)
+        stale = []
+        conn = None
+        if not fresh:
+            now = time.monotonic()
+            with self._lock:
+                idle = self._idle.get(key, [])
+                while idle:
+                    candidate, last_used = idle.pop()
+                    if now - last_used > self.idle_timeout:
+                        self.stats['evicted'] += 1
+                        stale.append(candidate)
+                    elif not connection_is_alive(candidate):
+                        self.stats['discarded'] += 1
+                        stale.append(candidate)
+                    else:
+                        conn = candidate
+                        self.stats['reused'] += 1
+                        break
+        for old in stale:
+            old.close()
+        if conn is not None:
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+        with self._lock:
+            self.stats['created'] += 1
+        return self._new_connection(host, port, https, timeout), False
+
+    def release(self, conn, response, https=False):
+        """Return a connection after use - only kept if the response was fully consumed"""
+        if https:
+            conn.remember_session()
+        if conn.sock is None or response is None or not response.isclosed() or response.will_close:
+            self.discard(conn)
+            return
+        key = self.key(conn.host, conn.port, https)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_target:
+                idle.append((conn, time.monotonic()))
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def discard(self, conn):
+        """Close a connection that must not be reused"""
+        with self._lock:
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def evict_idle(self):
+        """Close idle connections past their timeout or closed by the upstream"""
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for conn, last_used in idle:
+                    if now - last_used > self.idle_timeout or not connection_is_alive(conn):
+                        stale.append(conn)
+                    else:
+                        keep.append((conn, last_used))
+                self._idle[key] = keep
+            self.stats['evicted'] += len(stale)
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def flush(self, host=None, port=None):
+        """Close idle connections (all, or only those to host:port) after a routing switch"""
+        stale = []
+        with self._lock:
+            for key in list(self._idle):
+                _, key_host, key_port = key
+                if (host is None or key_host == host) and (port is None or key_port == port):
+                    stale.extend(conn for conn, _ in self._idle.pop(key))
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def idle_count(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
@@ -2,6 +2,7 @@ import asyncio
 import websockets
 import json
 import os
+import gravity_log as log
 
 connected_clients = set()
 WORKSPACE = "/root/Documents/REMOTEGRAVITY"
@@ -10,7 +11,7 @@ current_cwd = WORKSPACE
 
 async def tail_log_file():
     """Continuously checks the log file for new content and broadcasts it."""
-    print(f"Monitoring {LOG_FILE}")
+    log.info(f"Monitoring {LOG_FILE}")
     last_pos = 0
     
     if not os.path.exists(LOG_FILE):
@@ -31,7 +32,7 @@ async def tail_log_file():
             
             await asyncio.sleep(0.2)
         except Exception as e:
-            print(f"Error tailing file: {e}")
+            log.error(f"Error tailing file: {e}")
             await asyncio.sleep(1)
 
 async def execute_command(websocket, command):
@@ -109,7 +110,7 @@ async def execute_command(websocket, command):
 
 async def handler(websocket):
     connected_clients.add(websocket)
-    print(f"Client connected. Total: {len(connected_clients)}")
+    log.info(f"Client connected. Total: {len(connected_clients)}")
     
     # Send welcome message
     await websocket.send(json.dumps({
@@ -126,7 +127,7 @@ async def handler(websocket):
                 
                 if msg_type == "chat":
                     content = data.get("content", "").strip()
-                    print(f"User: {content}")
+                    log.info(f"User: {content}")
                     
                     # Log to file
                     with open(LOG_FILE, "a") as f:
@@ -165,23 +166,23 @@ async def handler(websocket):
                         await websocket.send(json.dumps({"type": "error", "message": str(e)}))
                 
             except json.JSONDecodeError as e:
-                print(f"JSON error: {e}")
+                log.error(f"JSON error: {e}")
             except Exception as e:
-                print(f"Error handling message: {e}")
+                log.error(f"Error handling message: {e}")
                 
     finally:
         connected_clients.remove(websocket)
-        print(f"Client disconnected. Total: {len(connected_clients)}")
+        log.info(f"Client disconnected. Total: {len(connected_clients)}")
 
 async def main():
-    print("=" * 50)
-    print("Antigravity IDE - WebSocket Server")
-    print("=" * 50)
-    print(f"Listening on ws://0.0.0.0:8888")
-    print(f"Workspace: {WORKSPACE}")
-    print(f"Log File: {LOG_FILE}")
-    print("Commands are executed and output returned.")
-    print("=" * 50)
+    log.write("=" * 50)
+    log.write("Antigravity IDE - WebSocket Server")
+    log.write("=" * 50)
+    log.write("Listening on ws://0.0.0.0:8888")
+    log.write(f"Workspace: {WORKSPACE}")
+    log.write(f"Log File: {LOG_FILE}")
+    log.write("Commands are executed and output returned.")
+    log.write("=" * 50)
     
     asyncio.create_task(tail_log_file())
     
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Bounded worker pool for the threaded proxy servers
+- A fixed number of handler threads (with small stacks) instead of one thread per connection
+- Accepted connections wait in a bounded queue; when that is full they get an immediate
+  503 + Retry-After and are closed, so a reconnect storm cannot grow memory without limit
+- Tunnels and long LSP streams detach from the pool: a stand-in thread takes over their slot
+  (up to STREAM_THREADS of them), so long-lived connections cannot starve ordinary requests
+- Occupancy, queue depth and shed counts for the health log
+"""
+import queue
+import threading
+
+import gravity_log as log
+
+WORKER_THREADS = 64               # Connections served at once (idle keep-alive connections each hold one)
+STREAM_THREADS = 64               # Extra threads for tunnels and long streams that detached from the pool
+ACCEPT_QUEUE = 64                 # Accepted connections waiting for a worker before new ones are shed
+WORKER_STACK_SIZE = 512 * 1024    # Handlers need far less than the 8 MiB default
+SHED_RETRY_AFTER = 2              # Seconds browsers are asked to wait after a 503
+
+SHED_BODY = b'Proxy busy, retry shortly\n'
+SHED_RESPONSE = (f'HTTP/1.1 503 Service Unavailable\r\nRetry-After: {SHED_RETRY_AFTER}\r\n'
+                 f'Content-Type: text/plain\r\nContent-Length: {len(SHED_BODY)}\r\nConnection: close\r\n'
+                 'Access-Control-Allow-Origin: *\r\n\r\n').encode() + SHED_BODY
+
+
+class WorkerPool:
+    """Fixed set of threads running submitted jobs from a bounded queue (threads start on first use)"""
+
+    def __init__(self, size=WORKER_THREADS, queue_size=ACCEPT_QUEUE, stack_size=WORKER_STACK_SIZE,
+                 name='worker', stream_threads=STREAM_THREADS):
+        self.size = size
+        self.stream_threads = stream_threads
+        self.stack_size = stack_size
+        self.name = name
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._spawned = 0
+        self._local = threading.local()
+        self.busy = 0
+        self.detached = 0
+        self.stats = {'served': 0, 'shed': 0, 'peak_busy': 0, 'peak_queued': 0}
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._spawn(self.size)
+
+    def _spawn(self, count):
+        """Start `count` more worker threads (lock held)"""
+        previous = threading.stack_size()
+        try:
+            threading.stack_size(self.stack_size)
+        except (ValueError, RuntimeError):
+            pass  # Platform refuses custom stack sizes - keep the default
+        try:
+            for _ in range(count):
+                t = threading.Thread(target=self._run, name=f'{self.name}-{self._spawned}', daemon=True)
+                t.start()
+                self._threads.append(t)
+                self._spawned += 1
+        finally:
+            threading.stack_size(previous)
+
+    def detach(self):
+        """Called from a job that will hold its thread for long (tunnel, stream): a stand-in thread
+        takes over its pool slot, and this thread exits when the job ends - False if the stream
+        allowance is used up (the job then keeps its slot)"""
+        if getattr(self._local, 'detached', False):
+            return True
+        with self._lock:
+            if self.detached >= self.stream_threads:
+                return False
+            self.detached += 1
+            self.busy -= 1  # Counted as detached from here on
+            self._threads = [t for t in self._threads if t.is_alive()]
+            self._spawn(1)
+        self._local.detached = True
+        return True
+
+    def submit(self, fn, *args):
+        """Queue a job - False (and counted as shed) if the queue is full"""
+        if not self._threads:
+            self._start()
+        try:
+            self._queue.put_nowait((fn, args))
+        except queue.Full:
+            with self._lock:
+                self.stats['shed'] += 1
+            return False
+        with self._lock:
+            self.stats['peak_queued'] = max(self.stats['peak_queued'], self._queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            with self._lock:
+                self.busy += 1
+                self.stats['peak_busy'] = max(self.stats['peak_busy'], self.busy)
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error(f"[ERROR] {self.name}: {e}")
+            finally:
+                with self._lock:
+                    if getattr(self._local, 'detached', False):
+                        self.detached -= 1
+                    else:
+                        self.busy -= 1
+                    self.stats['served'] += 1
+            if getattr(self._local, 'detached', False):
+                return  # The stand-in keeps the slot
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=self.size, busy=self.busy, queued=self._queue.qsize(),
+                        detached=self.detached)
+
+
+class PooledMixIn:
+    """Drop-in for socketserver.ThreadingMixIn that hands connections to a WorkerPool (set `pool`)"""
+
+    pool = None
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit(self.process_request_thread, request, client_address):
+            self.shed_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shed_request(self, request):
+        """Saturated - answer from the accept thread without reading the request, then hang up"""
+        try:
+            request.settimeout(1)
+            request.sendall(SHED_RESPONSE)
+            # Unread request bytes would turn the close into a reset that can discard the 503
+            request.setblocking(False)
+            request.recv(65536)
+        except OSError:
+            pass
+        self.shutdown_request(request)
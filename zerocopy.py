@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Zero-copy body relay (Linux)
+- Moves a sized response body from the upstream socket to the browser socket with os.splice
+  through a pipe, so payload bytes never become Python objects
+- Only for plain-TCP passthrough bodies: anything inspected, rewritten, compressed or cached is copied as before
+- Falls back to the copy loop when splice is unavailable or refused for these sockets
+"""
+import errno
+import os
+import select
+import socket
+import ssl
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SPLICE_MIN_BYTES = 256 * 1024  # Below this the pipe setup costs more than the copies it saves
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+SPLICE_AVAILABLE = hasattr(os, 'splice') and sys.platform.startswith('linux')
+SPLICE_ENABLED = SPLICE_AVAILABLE and os.environ.get('GRAVITY_NO_SPLICE') != '1'
+
+STATS = {'bodies': 0, 'bytes': 0, 'fallbacks': 0}
+STATS_LOCK = threading.Lock()
+
+
+class SpliceUnsupported(Exception):
+    """splice refused these descriptors before any byte moved - copy instead"""
+
+
+def response_socket(response):
+    """The plain TCP socket under an http.client response, or None (TLS, or not reachable)"""
+    raw = getattr(response.fp, 'raw', None)
+    sock = getattr(raw, '_sock', None)
+    if not isinstance(sock, socket.socket) or isinstance(sock, ssl.SSLSocket):
+        return None
+    return sock
+
+
+def can_splice(response, length):
+    return SPLICE_ENABLED and length >= SPLICE_MIN_BYTES and response_socket(response) is not None
+
+
+def _wait(sock, event, timeout):
+    poller = select.poll()
+    poller.register(sock, event)
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout('splice timed out')
+
+
+def splice_socket(src, dst, count, timeout=None, on_drained=None):
+    """Move exactly count bytes src -> dst through a pipe - returns count
+
+    on_drained() runs once everything has left src, before the last bytes reach dst"""
+    r, w = os.pipe()
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.fcntl(w, F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass  # Default 64 KiB pipe still works
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        sent = in_pipe = 0
+        while sent < count:
+            if sent + in_pipe < count:
+                try:
+                    n = os.splice(src.fileno(), w, count - sent - in_pipe, flags=flags)
+                    if n == 0:
+                        raise ConnectionResetError('upstream closed inside body')
+                    in_pipe += n
+                    if sent + in_pipe == count and on_drained is not None:
+                        on_drained()
+                except BlockingIOError:
+                    if not in_pipe:
+                        _wait(src, select.POLLIN, timeout)
+                        continue
+                except OSError as e:
+                    if sent or in_pipe or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    raise SpliceUnsupported(str(e))
+            try:
+                n = os.splice(r, dst.fileno(), in_pipe, flags=flags)
+                in_pipe -= n
+                sent += n
+            except BlockingIOError:
+                _wait(dst, select.POLLOUT, timeout)
+        return sent
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def splice_response(response, dst, timeout=None, upstream_done=None, write=None):
+    """Send the rest of a sized http.client body to dst - False if splice is refused and the caller must copy the rest
+
+    upstream_done() runs as soon as the body has been read off the upstream socket; write(data) sends
+    the bytes http.client already buffered (default dst.sendall), so a counting writer sees them either way"""
+    src = response_socket(response)
+
+    def drained():
+        response.length = 0
+        response.read()  # Marks the response closed so the connection can go back to the pool
+        if upstream_done is not None:
+            upstream_done()
+
+    # Bytes http.client already buffered go out the normal way first
+    head = response.read1(65536)
+    remaining = response.length or 0
+    if not remaining:
+        drained()
+    if head:
+        (write or dst.sendall)(head)
+    if remaining:
+        try:
+            splice_socket(src, dst, remaining, timeout, on_drained=drained)
+        except SpliceUnsupported:
+            with STATS_LOCK:
+                STATS['fallbacks'] += 1
+            return False  # Nothing past `head` was consumed - the caller copies the rest
+    with STATS_LOCK:  # Counted only once the client has taken every byte
+        STATS['bodies'] += 1
+        STATS['bytes'] += len(head) + remaining
+    return True